@@ -0,0 +1,51 @@
+# Cost of what a selection change asks of the model (ancestry text, text offsets, context window) on a deep story,
+# walking the ancestry every time (old behaviour) vs. the memoized ancestry index
+# usage: python -m benchmarks.ancestry [depth]
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.util_tree import node_ancestry, ancestry_plaintext, ancestor_text_indices
+
+
+def uncached(model, node):
+    ancestry = node_ancestry(node, model.tree_node_dict)
+    ancestry_plaintext(ancestry, text_callback=model.text)
+    ancestor_text_indices(ancestry, text_callback=model.text)
+    ancestor_text_indices(ancestry, text_callback=model.text)
+
+
+def cached(model, node):
+    model.ancestry_text(node)
+    model.ancestor_text_indices(node)
+    model.context_window_index(node)
+
+
+def main(depth):
+    model = synthetic_model(depth, chain=True, text_length=400)
+    path = model.nodes
+    leaf = path[-1]
+    print(f'{depth:,} ancestors, {len(model.ancestry_text(leaf)):,} characters')
+    report('walk ancestry per call (old)', time_call(lambda: uncached(model, leaf), 50))
+    model.ancestry_index.clear()
+    report('memoized, first lookup', time_call(lambda: cached(model, leaf), 1))
+    report('memoized, repeated lookup', time_call(lambda: cached(model, leaf), 200))
+
+    # selecting each node from the middle of the story down to the leaf
+    steps = path[depth // 2:]
+    def walk_down(lookup):
+        for node in steps:
+            lookup(model, node)
+    report(f'select {len(steps)} nodes down the path (old)', time_call(lambda: walk_down(uncached), 1))
+    report(f'select {len(steps)} nodes down the path', time_call(lambda: walk_down(cached), 1))
+
+    # editing a node near the leaf invalidates only its subtree
+    edited = path[-5]
+    def edit():
+        model.update_text(edited, edited['text'] + 'x', refresh_nav=False)
+        cached(model, leaf)
+    report('edit near leaf, then lookup', time_call(edit, 50))
+    print(model.ancestry_index.info())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 800)
@@ -0,0 +1,65 @@
+# Stress test of the traversal primitives in util_tree on deep (single chain) and wide trees. Checks that each one
+# visits every node and reports its time, next to the old recursive subtree_list where that doesn't overflow.
+# usage: python -m benchmarks.deep_trees [num_nodes]
+import sys
+
+from benchmarks.synthetic import synthetic_tree, time_call, report
+from util.util_tree import flatten_tree, subtree_list, tree_subset, height, depth, search, overwrite_subtree, \
+    make_simple_tree, fix_tree, filtered_children, postorder, walk
+
+
+def old_subtree_list(root, filter=None, depth_limit=None):
+    if depth_limit == 0:
+        return []
+    sub_list = [root]
+    for child in filtered_children(root, filter):
+        sub_list += old_subtree_list(child, filter, depth_limit - 1 if depth_limit else None)
+    return sub_list
+
+
+def star_tree(n):
+    return {"root": {"id": "root", "text": "", "children": [{"id": str(i), "text": f" node {i}", "children": []}
+                                                            for i in range(n - 1)]}}
+
+
+def check(name, expected, actual):
+    if expected != actual:
+        raise AssertionError(f'{name}: expected {expected}, got {actual}')
+
+
+def stress(name, root, n, expected_height):
+    print(f'\n{name}: {n:,} nodes, height {expected_height:,}')
+    flat = flatten_tree(root)
+    node_dict = {d["id"]: d for d in flat}
+    check('flatten_tree', n, len(flat))
+    report('flatten_tree', time_call(lambda: flatten_tree(root), 3))
+    check('subtree_list', n, len(subtree_list(root)))
+    report('subtree_list', time_call(lambda: subtree_list(root), 3))
+    try:
+        report('subtree_list, recursive (old)', time_call(lambda: old_subtree_list(root), 3))
+    except RecursionError:
+        print(f'{"subtree_list, recursive (old)":<48} RecursionError')
+    check('postorder', n, sum(1 for _ in postorder(root)))
+    check('height', expected_height, height(root))
+    report('height', time_call(lambda: height(root), 3))
+    deepest, _, level = max(walk(root), key=lambda item: item[2])
+    check('depth', expected_height - 1, depth(deepest, node_dict))
+    check('tree_subset', n, len(flatten_tree(tree_subset(root, lambda node: True))))
+    report('tree_subset', time_call(lambda: tree_subset(root, lambda node: True), 3))
+    check('search', n - 1, len(search(root, 'node')))
+    report('search', time_call(lambda: search(root, 'node'), 3))
+    check('make_simple_tree', n, sum(1 for _ in postorder(make_simple_tree(root))))
+    report('make_simple_tree', time_call(lambda: make_simple_tree(root), 3))
+    report('fix_tree', time_call(lambda: fix_tree(root), 3))
+    check('overwrite_subtree', [], overwrite_subtree(root, 'open', True))
+    report('overwrite_subtree', time_call(lambda: overwrite_subtree(root, 'open', True), 3))
+
+
+def main(n):
+    stress('chain', synthetic_tree(n, chain=True)['root'], n, n)
+    stress('random', synthetic_tree(n)['root'], n, height(synthetic_tree(n)['root']))
+    stress('star', star_tree(n)['root'], n, 2)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
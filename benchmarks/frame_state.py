@@ -0,0 +1,64 @@
+# Cost of reading settings through TreeModel.state on a deep story with frames along the ancestry: merging the
+# defaults and every ancestor frame on each access (old behaviour) vs. the cached state and accumulated frames
+# usage: python -m benchmarks.frame_state [depth] [frame_every]
+import sys
+from copy import deepcopy
+
+import model as tree_model
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.frames_util import frame_merger
+
+
+def old_state(model):
+    state = {}
+    state["memories"] = {}
+    state["vars"] = deepcopy(tree_model.DEFAULT_VARS)
+    state["preferences"] = deepcopy(tree_model.DEFAULT_PREFERENCES)
+    state["generation_settings"] = deepcopy(tree_model.DEFAULT_GENERATION_SETTINGS)
+    state["inline_generation_settings"] = deepcopy(tree_model.DEFAULT_INLINE_GENERATION_SETTINGS)
+    state["workspace"] = deepcopy(tree_model.DEFAULT_WORKSPACE)
+    state["module_settings"] = deepcopy(tree_model.DEFAULT_MODULE_SETTINGS)
+    state["model_config"] = deepcopy(tree_model.DEFAULT_MODEL_CONFIG)
+    frames = {}
+    for ancestor in model.ancestry(model.selected_node):
+        if 'frame' in ancestor:
+            frame_merger.merge(frames, deepcopy(ancestor['frame']))
+    frame_merger.merge(state, frames)
+    frame_merger.merge(state, model.user_frame)
+    return state
+
+
+def main(depth, frame_every):
+    model = synthetic_model(depth, chain=True)
+    nodes = model.nodes
+    for i in range(0, depth, frame_every):
+        model.update_frame(nodes[i], {'generation_settings': {'temperature': i / depth}, 'vars': {f'v{i}': i}})
+    model.update_user_frame({'preferences': {'font_size': 14}})
+    model.select_node(nodes[-1]['id'])
+    assert old_state(model) == model.state
+    print(f'depth {depth:,}, a frame every {frame_every} nodes')
+
+    report('generation_settings, old state', time_call(lambda: old_state(model)['generation_settings'], 200))
+    report('generation_settings, cached', time_call(lambda: model.generation_settings, 200))
+    report('state (full copy), cached', time_call(lambda: model.state, 200))
+
+    def select_other():
+        select_other.i = (select_other.i + 1) % 50
+        model.select_node(nodes[-1 - select_other.i]['id'])
+        return model.generation_settings
+    select_other.i = 0
+    report('select another node, then read', time_call(select_other, 200))
+
+    def edit_frame():
+        model.set_frame_partial(nodes[depth // 2], 0.5, ['generation_settings', 'top_p'])
+        return model.generation_settings
+    report('edit a frame halfway down, then read', time_call(edit_frame, 200))
+
+    def edit_user_frame():
+        model.set_user_frame_partial(0.5, ['generation_settings', 'top_p'])
+        return model.generation_settings
+    report('edit the user frame, then read', time_call(edit_user_frame, 200))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,78 @@
+# Pressing Generate many times while a tree expansion is running, against a stub backend which serves 4 requests at a
+# time: a thread per request (old behaviour) vs. the shared generation executor. Reports the threads alive, the
+# requests waiting at the backend, the backend calls made for repeated identical requests and how long an inline
+# (interactive) request submitted last takes.
+# usage: python -m benchmarks.generation_executor [requests]
+import sys
+import threading
+import time
+
+from benchmarks.synthetic import report
+from util.generation_executor import GenerationExecutor, INTERACTIVE, NORMAL, BATCH
+
+SERVICE_TIME = 0.01
+BACKEND_CONCURRENCY = 4
+
+
+class StubBackend:
+    def __init__(self):
+        self.slots = threading.Semaphore(BACKEND_CONCURRENCY)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waiting = 0
+        self.max_waiting = 0
+
+    def generate(self, prompt):
+        with self.lock:
+            self.calls += 1
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+            time.sleep(SERVICE_TIME)
+        return {'completions': [{'text': prompt}]}, None
+
+
+def run(n, submit):
+    backend = StubBackend()
+    threads = threading.active_count()
+    start = time.perf_counter()
+    waits = [submit(backend.generate, f'batch {i}', BATCH, None) for i in range(n)]
+    # the same request sent again and again, e.g. by pressing a button repeatedly
+    waits += [submit(backend.generate, 'repeated', NORMAL, 'repeated') for _ in range(n // 4)]
+    max_threads = threading.active_count() - threads
+    inline_start = time.perf_counter()
+    submit(backend.generate, 'inline', INTERACTIVE, None)()
+    inline_time = time.perf_counter() - inline_start
+    for wait in waits:
+        wait()
+    return {'inline': inline_time, 'total': time.perf_counter() - start, 'threads': max_threads,
+            'max_waiting': backend.max_waiting, 'calls': backend.calls}
+
+
+# returns a function which waits for the request
+def thread_per_request(function, prompt, priority, key):
+    thread = threading.Thread(target=function, args=(prompt,))
+    thread.start()
+    return thread.join
+
+
+def main(n):
+    executor = GenerationExecutor()
+
+    def executor_submit(function, prompt, priority, key):
+        return executor.submit('stub', function, (prompt,), priority=priority, key=key,
+                               max_concurrency=BACKEND_CONCURRENCY).wait
+
+    print(f'{n:,} batch requests, {n // 4:,} repeated requests, backend serves {BACKEND_CONCURRENCY} at a time')
+    for name, submit in [('thread per request (old)', thread_per_request), ('generation executor', executor_submit)]:
+        stats = run(n, submit)
+        report(f'{name}: inline request submitted last', stats['inline'])
+        report(f'{name}: all requests', stats['total'])
+        print(f"    {stats['threads']} threads alive after submitting, "
+              f"{stats['max_waiting']} requests waiting at the backend at most, {stats['calls']} backend calls")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
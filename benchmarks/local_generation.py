@@ -0,0 +1,59 @@
+# Latency of gpt.generate for a local Ollama-style server, one request at a time vs. concurrent continuations
+# usage: python -m benchmarks.local_generation [delay_seconds] [num_continuations]
+import json
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from gpt import generate
+from benchmarks.synthetic import report
+
+
+# Answers /api/generate after a fixed delay, like a local model would
+def stub_server(delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(delay)
+            payload = json.dumps({'response': body['prompt'][-10:]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(api_base, max_concurrency, num_continuations):
+    config = {'models': {'stub': {'model': 'stub', 'type': 'ollama', 'api_base': api_base,
+                                  'max_concurrency': max_concurrency}}}
+    start = time.perf_counter()
+    response, error = generate(config, prompt='Once upon a time', model='stub', num_continuations=num_continuations,
+                               temperature=0.9, top_p=1)
+    assert error is None, error
+    assert len(response['completions']) == num_continuations
+    return time.perf_counter() - start
+
+
+def main(delay=0.5, num_continuations=4):
+    server = stub_server(delay)
+    api_base = f'http://127.0.0.1:{server.server_address[1]}'
+    print(f'{num_continuations} continuations, {delay}s per request')
+    report('max_concurrency=1 (sequential)', run(api_base, 1, num_continuations))
+    report(f'max_concurrency={num_continuations}', run(api_base, num_continuations, num_continuations))
+    report('max_concurrency=2', run(api_base, 2, num_continuations))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(float(args[0]) if args else 0.5, int(args[1]) if len(args) > 1 else 4)
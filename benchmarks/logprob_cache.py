@@ -0,0 +1,57 @@
+# Repeated wavefunction propagation with the persistent logprob cache: cold, warm, and after reopening the cache file
+# The model is replaced by a stub that sleeps for a fixed latency and returns deterministic top logprobs.
+# usage: python -m benchmarks.logprob_cache [latency_ms]
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+import util.multiverse_util as multiverse_util
+from util.logprob_cache import configure_logprob_cache
+
+
+def stub_generate(latency):
+    calls = []
+
+    def generate(prompt, engine, api_base, api_key):
+        calls.append(prompt)
+        time.sleep(latency)
+        rng = random.Random(prompt)
+        weights = sorted((rng.random() ** 3 for _ in range(8)), reverse=True)
+        total = sum(weights)
+        top = {f' w{i}': math.log(w / total) for i, w in enumerate(weights)}
+        return {'choices': [{'logprobs': {'top_logprobs': [top]}}]}
+    return generate, calls
+
+
+def propagate():
+    start = time.perf_counter()
+    multiverse_util.greedy_word_multiverse('Once upon a time', ground_truth=[], max_depth=4,
+                                           unnormalized_threshold=0.05, model_type='local',
+                                           api_base='http://stub')
+    return time.perf_counter() - start
+
+
+def main():
+    latency = (float(sys.argv[1]) if len(sys.argv) > 1 else 20) / 1000
+    multiverse_util.generate, calls = stub_generate(latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'logprobs.sqlite')
+        cache = configure_logprob_cache(path)
+        for name in ('cold', 'warm'):
+            calls.clear()
+            print(f'{name:>24}: {propagate() * 1000:9.1f}ms, {len(calls)} model calls')
+        cache.db.close()
+        configure_logprob_cache(path)
+        calls.clear()
+        print(f'{"reopened cache file":>24}: {propagate() * 1000:9.1f}ms, {len(calls)} model calls')
+
+        small = configure_logprob_cache(os.path.join(tmp, 'small.sqlite'), max_entries=10)
+        propagate()
+        print(f'{"bounded to 10 entries":>24}: {small.info()}')
+
+
+if __name__ == "__main__":
+    main()
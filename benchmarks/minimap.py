@@ -0,0 +1,48 @@
+# Minimap refresh after selection changes and edits: deleting and redrawing every node and line (old behaviour,
+# clear() before refresh()) vs. the incremental refresh, which lays out again only when the pruned tree's shape
+# changes and moves, adds and recolors only what changed. Runs MiniMap against the stub canvas of
+# benchmarks.tree_vis. Needs the app's requirements (PIL, ttkthemes) but no display.
+# usage: python -m benchmarks.minimap [num_nodes ...]
+import random
+import sys
+
+from benchmarks.synthetic import synthetic_model
+from benchmarks.tree_vis import StubCanvas, frame
+import view.tree_vis
+from components.modules import MiniMap
+
+
+def make_minimap(model):
+    callbacks = {"In nav": {"callback": lambda node: True},
+                 "Node open": {"callback": lambda node: node.get('open', False)},
+                 "Text": {"callback": lambda node_id: ''},
+                 "Nav Select": {"callback": lambda **kwargs: None}}
+    minimap = MiniMap(callbacks, model)
+    minimap.canvas = StubCanvas()
+    return minimap
+
+
+def main(sizes):
+    for n in sizes:
+        for prune_mode in ['in_nav', 'selection_dist']:
+            print(f'{n} nodes, prune_mode {prune_mode}')
+            rng = random.Random(n)
+            model = synthetic_model(n)
+            model.user_frame['module_settings'] = {'minimap': {'prune_mode': prune_mode}}
+            model.frames_changed()
+            minimap = make_minimap(model)
+            minimap.refresh()
+
+            def select():
+                model.select_node(rng.choice(model.nodes)['id'])
+            def add():
+                model.create_child(rng.choice(model.nodes), expand=False)
+
+            for name, change in [('select another node', select), ('add a child', add)]:
+                frame(f'redraw: {name}', minimap, lambda: (change(), minimap.clear(), minimap.refresh()))
+                frame(f'incremental: {name}', minimap, lambda: (change(), minimap.refresh()))
+            print()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,47 @@
+# Opening a tree whose model responses (with per-token counterfactuals) are stored inline in the tree file (old
+# behaviour) vs. in the responses sidecar, and reading back one response
+# usage: python -m benchmarks.model_responses [num_responses]
+import json
+import os
+import random
+import sys
+import tempfile
+
+from benchmarks.synthetic import StubApp, synthetic_tree, time_call, report
+from model import TreeModel
+from util.response_store import migrate_tree_file
+
+
+def synthetic_response(rng, num_tokens=64):
+    tokens = [{'generatedToken': {'token': f' w{i}', 'logprob': -rng.random()},
+               'position': {'start': i * 3, 'end': i * 3 + 3},
+               'counterfactuals': {f' c{j}': -rng.random() * 10 for j in range(10)}} for i in range(num_tokens)]
+    return {'prompt': {'text': 'x' * 4000, 'tokens': None},
+            'completions': [{'text': ''.join(t['generatedToken']['token'] for t in tokens), 'tokens': tokens}] * 4}
+
+
+def main(num_responses):
+    rng = random.Random(0)
+    tree = synthetic_tree(2000)
+    tree['model_responses'] = {str(i): synthetic_response(rng) for i in range(num_responses)}
+    filename = os.path.join(tempfile.mkdtemp(), 'tree.json')
+    with open(filename, 'w') as f:
+        json.dump(tree, f)
+    print(f'{num_responses:,} responses, tree file {os.path.getsize(filename) / 1e6:.1f} MB')
+
+    def open_tree():
+        model = TreeModel(StubApp())
+        model.open_tree(filename)
+        return model
+    report('open, responses inline (old)', time_call(open_tree, 3))
+    migrate_tree_file(filename)
+    print(f'migrated, tree file {os.path.getsize(filename) / 1e6:.1f} MB')
+    report('open, responses in sidecar', time_call(open_tree, 3))
+    model = open_tree()
+    ids = list(tree['model_responses'])
+    report('read one response', time_call(lambda: model.model_responses.get(rng.choice(ids)), 100))
+    print(model.model_responses.info())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
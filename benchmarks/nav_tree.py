@@ -0,0 +1,116 @@
+# Treeview work to build the nav tree and to change the selection: inserting every visible node and polling every
+# item's open state on each selection (old behaviour) vs. NavTree, which inserts only the items below open nodes.
+# Runs against a stub Treeview which counts calls; each call into a real Treeview costs a Tcl round trip on top.
+# usage: python -m benchmarks.nav_tree [num_nodes]
+import random
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_model, report
+from view.nav_tree import NavTree
+
+
+class StubTreeview:
+    def __init__(self):
+        self.items = {'': []}
+        self.options = {}
+        self.calls = 0
+
+    def bind(self, *args, **kwargs):
+        pass
+
+    def focus(self):
+        return ''
+
+    def exists(self, iid):
+        self.calls += 1
+        return iid in self.items
+
+    def get_children(self, iid=''):
+        self.calls += 1
+        return list(self.items[iid])
+
+    def insert(self, parent, index, iid, **options):
+        self.calls += 1
+        self.items[iid] = []
+        self.options[iid] = dict(options, parent=parent)
+        children = self.items[parent]
+        children.insert(len(children) if index == 'end' else index, iid)
+
+    def delete(self, *iids):
+        self.calls += 1
+        for iid in iids:
+            if iid in self.options:
+                self.items[self.options[iid]['parent']].remove(iid)
+                stack = [iid]
+                while stack:
+                    item = stack.pop()
+                    stack.extend(self.items.pop(item, ()))
+                    self.options.pop(item, None)
+
+    def item(self, iid, option=None, **options):
+        self.calls += 1
+        if option is not None:
+            return self.options[iid].get(option)
+        self.options[iid].update(options)
+
+
+def item_options(node):
+    return dict(text=node['text'][:25], tags=['visited' if node.get('visited') else 'not visited'])
+
+
+def old_build(model, treeview):
+    for node in model.nodes:
+        parent_id = node.get('parent_id', '')
+        if parent_id and not treeview.exists(parent_id):
+            continue
+        treeview.insert(parent=parent_id, index='end', iid=node['id'], open=node.get('open', False),
+                        **item_options(node))
+
+
+def old_select(model, treeview, node):
+    for d in model.nodes:
+        if treeview.exists(d['id']):
+            d['open'] = treeview.item(d['id'], 'open')
+    treeview.item(node['id'], open=True, **item_options(node))
+
+
+def measure(name, func):
+    treeview = func.treeview
+    calls = treeview.calls
+    start = time.perf_counter()
+    func()
+    report(f'{name} ({treeview.calls - calls:,} calls)', time.perf_counter() - start)
+
+
+def main(n):
+    rng = random.Random(0)
+    model = synthetic_model(n)
+    for node in model.nodes:
+        node['open'] = rng.random() < 0.05
+    model.root()['open'] = True
+    target = max(rng.sample(model.nodes, 200), key=lambda node: len(model.ancestry(node)))
+    print(f'{n:,} nodes')
+
+    old = StubTreeview()
+    build = lambda: old_build(model, old)
+    build.treeview = old
+    measure('build, old', build)
+    select = lambda: old_select(model, old, target)
+    select.treeview = old
+    measure('select, old', select)
+
+    stub = StubTreeview()
+    nav = NavTree(stub, model.node, item_options)
+    build = lambda: nav.build(model.nodes)
+    build.treeview = stub
+    measure('build', build)
+    select = lambda: nav.reveal(target['id'])
+    select.treeview = stub
+    measure('select a deep node', select)
+    measure('select it again', select)
+    print(f'{len(stub.options):,} of {len(nav.members):,} nav nodes have items')
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
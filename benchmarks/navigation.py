@@ -0,0 +1,54 @@
+# Cost of one next/prev keypress on a large tree: filtering and indexing the whole preorder per call (old behaviour)
+# vs. the cached preorder positions, stepping from the selected node and bisecting tagged positions
+# usage: python -m benchmarks.navigation [num_nodes]
+import random
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+
+
+def old_find_next(model, node, filter=None, visible_filter=None):
+    nodes = model.nodes_list(visible_filter) if visible_filter else model.nodes
+    current_idx = nodes.index(node)
+    true_indices = model.filter_indices(nodes, filter)
+    if len(true_indices) < 1:
+        return
+    try:
+        go_to_true = next(i for i, idx in enumerate(true_indices.keys()) if idx > current_idx)
+    except StopIteration:
+        go_to_true = 0
+    return list(true_indices.values())[go_to_true]["id"]
+
+
+def main(n):
+    rng = random.Random(0)
+    model = synthetic_model(n)
+    nodes = model.nodes
+    for node in rng.sample(nodes, max(1, n // 1000)):
+        model.tag_node(node, 'bookmark')
+    # stands in for the nav tree's exists(), which is true for most nodes
+    hidden = {node['id'] for node in rng.sample(nodes, n // 10)}
+    in_nav = lambda node: node['id'] not in hidden
+    start = next(node for node in nodes[n // 2:] if in_nav(node))
+    is_bookmark = lambda node: model.has_tag_attribute(node, 'bookmark')
+    assert old_find_next(model, start, visible_filter=in_nav) == model.find_next(start, visible_filter=in_nav)
+    assert old_find_next(model, start, is_bookmark, in_nav) == model.find_next_tag(start, 'bookmark', in_nav)
+    print(f'{n:,} nodes')
+
+    report('next, old', time_call(lambda: old_find_next(model, start, visible_filter=in_nav), 5))
+    report('next', time_call(lambda: model.find_next(start, visible_filter=in_nav), 200))
+    report('next bookmark, old', time_call(lambda: old_find_next(model, start, is_bookmark, in_nav), 5))
+    report('next bookmark', time_call(lambda: model.find_next_tag(start, 'bookmark', in_nav), 200))
+    report('tree_traversal_idx, old', time_call(lambda: model.nodes.index(start), 5))
+    model.select_node(start['id'])
+    report('tree_traversal_idx', time_call(lambda: model.tree_traversal_idx, 200))
+
+    def hold_next():
+        node = start
+        for _ in range(100):
+            node = model.node(model.find_next(node, visible_filter=in_nav))
+    report('100 next presses', time_call(hold_next, 5))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
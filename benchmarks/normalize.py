@@ -0,0 +1,48 @@
+# Cost of Miro/HTML normalization on a large tree: fix_miro_tree on every rebuild_tree and indexed subtree (old
+# behaviour) vs. once when the tree is opened, recorded by tree["normalized"]
+# usage: python -m benchmarks.normalize [num_nodes]
+import sys
+
+import html2text
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.util_tree import flatten_tree, normalize_tree
+
+
+def old_fix_miro_tree(flat_data, node_dict=None):
+    h = html2text.HTML2Text()
+    h.body_width = 0
+    id_to_node = node_dict if node_dict is not None else {d["id"]: d for d in flat_data}
+    for d in flat_data:
+        if "text" not in d or all([tag not in d["text"] for tag in ["<p>", "</p"]]):
+            continue
+        d["text"] = h.handle(d["text"])
+
+
+def main(n):
+    model = synthetic_model(n)
+    print(f'{n:,} nodes')
+
+    def old_rebuild():
+        model.rebuild_tree()
+        old_fix_miro_tree(model.nodes)
+    report('rebuild_tree + fix_miro_tree (old)', time_call(old_rebuild, 5))
+    report('rebuild_tree', time_call(model.rebuild_tree, 5))
+
+    parent = model.nodes[n // 2]
+    def old_create_child():
+        child = model.create_child(parent)
+        old_fix_miro_tree(flatten_tree(child), node_dict=model.tree_node_dict)
+    report('create_child, fix_miro_tree on the subtree (old)', time_call(old_create_child, 200))
+    report('create_child', time_call(lambda: model.create_child(parent), 200))
+
+    nodes = model.nodes
+    model.tree_raw_data.pop('normalized')
+    report('normalize on first open', time_call(lambda: normalize_tree(model.tree_raw_data, nodes,
+                                                                        model.tree_node_dict), 1))
+    report('normalize on later opens', time_call(lambda: normalize_tree(model.tree_raw_data, nodes,
+                                                                         model.tree_node_dict), 5))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,62 @@
+# Search dialog latency on a large tree: running the pattern over every node's text with util_tree.search (old
+# behaviour) vs. TreeModel.search_text, which runs it only over the candidate nodes from the search index, for the
+# whole result list and for the first page, and searching while the index is built in the background. Node text is
+# made of words drawn from a Zipf-like distribution.
+# usage: python -m benchmarks.search [num_nodes]
+import itertools
+import random
+import re
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.util_tree import search
+
+
+def vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(size)]
+
+
+def main(n):
+    rng = random.Random(0)
+    words = vocabulary(20000, rng)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    model = synthetic_model(n)
+    for node in model.nodes:
+        node['text'] = ' ' + ' '.join(rng.choices(words, weights, k=rng.randint(5, 60))) + '.'
+    model.search_index.reset(model.tree_node_dict)
+    root = model.root()
+    print(f'{n:,} nodes, {sum(len(node["text"]) for node in model.nodes):,} characters')
+    report('build search index', time_call(lambda: model.search_index.update(), 1))
+    model.node_positions
+
+    queries = [('common word', words[0], False), ('rare word', words[5000], False),
+               ('phrase', f'{words[3]} {words[40]}', False), ('word prefix', words[300][:4], False),
+               ('regex with literals', rf'\b{words[200]}\b.*{words[10]}', True),
+               ('regex without literals (no prefilter)', r'\b[aeiou]{4}\b', True)]
+    for name, pattern, regex in queries:
+        expression = pattern if regex else re.escape(pattern)
+        matches = search(root, expression)
+        report(f'{name}, {len(matches):,} matches (old)', time_call(lambda: search(root, expression), 3))
+        report(f'{name}, indexed', time_call(lambda: list(model.search_text(root, pattern, regex=regex)), 3))
+        report(f'{name}, indexed, first page',
+               time_call(lambda: list(itertools.islice(model.search_text(root, pattern, regex=regex), 5)), 3))
+
+    node = rng.choice(model.nodes)
+    def edit():
+        model.update_text(node, node['text'] + ' ' + rng.choice(words))
+        list(model.search_text(root, words[5000]))
+    report('edit a node, then search', time_call(edit, 10))
+
+    # the search dialog starts building the index when it opens and searches without it until it is built
+    model.search_index.reset(model.tree_node_dict)
+    report('start building the index in the background', time_call(model.search_index.build_in_background, 1))
+    report('search while the index is built', time_call(lambda: list(model.search_text(root, words[5000])), 1))
+    while not model.search_index.ready():
+        time.sleep(0.01)
+    report('first search once the index is built', time_call(lambda: list(model.search_text(root, words[5000])), 1))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
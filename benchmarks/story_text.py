@@ -0,0 +1,117 @@
+# Read mode textbox work when moving to a sibling or a child at the end of a long story: deleting all text and
+# inserting and tagging the whole ancestry (old behaviour) vs. StoryText, which keeps the text shared with the previous
+# ancestry. Runs against a stub Text widget which keeps its text in a string and counts calls and inserted characters;
+# a real Text widget also lays out every inserted character, so the old behaviour costs much more than shown here.
+# usage: python -m benchmarks.story_text [depth]
+import random
+import re
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from view.story_text import StoryText
+
+
+class StubText:
+    def __init__(self):
+        self.text = ''
+        self.tags = {}
+        self.modified = False
+        self.calls = 0
+        self.inserted = 0
+
+    def offset(self, index):
+        if index == '1.0':
+            return 0
+        if index in ('end', 'end-1c'):
+            return len(self.text)
+        return int(re.match(r'1\.0 \+ (\d+) chars', index).group(1))
+
+    def delete(self, start, end):
+        self.calls += 1
+        self.text = self.text[:self.offset(start)] + self.text[self.offset(end):]
+        self.modified = True
+
+    def insert(self, index, text, tags=()):
+        self.calls += 1
+        self.inserted += len(text)
+        offset = self.offset(index)
+        self.text = self.text[:offset] + text + self.text[offset:]
+        self.modified = True
+
+    def tag_add(self, tag, start, end):
+        self.calls += 1
+        self.tags.setdefault(tag, []).append((self.offset(start), self.offset(end)))
+
+    def tag_remove(self, tag, start, end):
+        self.calls += 1
+
+    def tag_names(self):
+        return list(self.tags)
+
+    def edit_modified(self, value=None):
+        if value is None:
+            return self.modified
+        self.modified = value
+
+
+# what refresh_textbox shows for node: segments and tag ranges, every third ancestor written by the user
+def rendering(model, node, prompt_length=8000):
+    texts = model.ancestor_text_list(node)
+    history_length = sum(len(text) for text in texts[:-1])
+    in_context_start = min(max(history_length - (prompt_length - len(texts[-1])), 0), history_length)
+    prompt_ranges = model.ancestor_text_indices(node)[::3]
+    return texts[:-1] + [texts[-1], ''], {'ooc_history': [(0, in_context_start)],
+                                          'history': [(in_context_start, history_length)],
+                                          'prompt': prompt_ranges}
+
+
+def old_render(textbox, segments, tag_ranges):
+    textbox.delete('1.0', 'end')
+    history_length = tag_ranges['history'][0][1]
+    text = ''.join(segments)
+    in_context_start = tag_ranges['history'][0][0]
+    textbox.insert('end-1c', text[:in_context_start], 'ooc_history')
+    textbox.insert('end-1c', text[in_context_start:history_length], 'history')
+    textbox.insert('end-1c', text[history_length:])
+    textbox.tag_remove('prompt', '1.0', 'end')
+    for start, end in tag_ranges['prompt']:
+        textbox.tag_add('prompt', f'1.0 + {start} chars', f'1.0 + {end} chars')
+
+
+def main(depth):
+    model = synthetic_model(depth, chain=True, text_length=400)
+    leaf = model.nodes[-1]
+    parent = model.nodes[-2]
+    siblings = [leaf] + [model.create_child(parent, expand=False) for _ in range(3)]
+    for i, sibling in enumerate(siblings):
+        sibling['text'] = f'sibling {i} ' * 40
+    rng = random.Random(0)
+    print(f'{depth:,} ancestors, {len(model.ancestry_text(leaf)):,} characters')
+
+    for name, render in [('delete and insert everything (old)', old_render), ('StoryText', None)]:
+        textbox = StubText()
+        story_text = StoryText(textbox)
+        show = render or story_text.render
+        args = lambda node: (textbox, *rendering(model, node)) if render else rendering(model, node)
+        show(*args(leaf))
+
+        def sibling():
+            show(*args(rng.choice(siblings)))
+        calls, inserted = textbox.calls, textbox.inserted
+        report(f'{name}: select a sibling', time_call(sibling, 50))
+        print(f'    {(textbox.calls - calls) / 50:.0f} calls, {(textbox.inserted - inserted) // 50:,} characters inserted')
+
+        def child():
+            node = rng.choice(siblings)
+            if not node['children']:
+                model.create_child(node, expand=False)['text'] = 'child ' * 40
+            child = node['children'][0]
+            show(*args(node))
+            show(*args(child))
+        calls, inserted = textbox.calls, textbox.inserted
+        report(f'{name}: select a node, then its child', time_call(child, 50))
+        print(f'    {(textbox.calls - calls) / 50:.0f} calls, {(textbox.inserted - inserted) // 50:,} characters inserted')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
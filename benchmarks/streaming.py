@@ -0,0 +1,94 @@
+# Generate against a stub Ollama server which sends a token every few milliseconds: waiting for whole responses (old
+# behaviour) vs. streaming them into the placeholder children. Reports when text first shows up in a child, when all
+# children are complete and how many tree updates streaming made.
+# usage: python -m benchmarks.streaming [tokens] [seconds_per_token]
+import contextlib
+import io
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synthetic import synthetic_model, report
+
+PLACEHOLDER = "\n\n** Generating **"
+
+
+def stub_stream_server(tokens, token_delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            if body.get('stream'):
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                for i in range(tokens):
+                    time.sleep(token_delay)
+                    self.wfile.write(json.dumps({'response': f' token{i}', 'done': False}).encode() + b'\n')
+                    self.wfile.flush()
+                self.wfile.write(json.dumps({'response': '', 'done': True, 'done_reason': 'stop'}).encode() + b'\n')
+            else:
+                time.sleep(tokens * token_delay)
+                payload = json.dumps({'response': ''.join(f' token{i}' for i in range(tokens))}).encode()
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(api_base, stream, tokens):
+    model = synthetic_model(3)
+    model.tree_raw_data['frame'] = {
+        'model_config': {'models': {'stub': {'model': 'stub', 'type': 'ollama', 'api_base': api_base}}},
+        'generation_settings': {'model': 'stub', 'num_continuations': 4, 'stream': stream},
+    }
+    model.frames_changed()
+    updates = [0]
+    tree_updated = model.tree_updated
+
+    def counting_tree_updated(*args, **kwargs):
+        if kwargs.get('edit'):
+            updates[0] += 1
+        return tree_updated(*args, **kwargs)
+    model.tree_updated = counting_tree_updated
+
+    node = model.nodes[-1]
+    start = time.perf_counter()
+    model.generate_continuations(node, placeholder=PLACEHOLDER)
+    children = node['children']
+    first_text = None
+    while not all('generation' in child for child in children):
+        if first_text is None and any(child['text'] != PLACEHOLDER for child in children):
+            first_text = time.perf_counter() - start
+        time.sleep(0.001)
+    total = time.perf_counter() - start
+    assert all(child['text'].endswith(f' token{tokens - 1}') for child in children)
+    return first_text if first_text is not None else total, total, updates[0]
+
+
+def main(tokens=100, token_delay=0.01):
+    server = stub_stream_server(tokens, token_delay)
+    api_base = f'http://127.0.0.1:{server.server_address[1]}'
+    print(f'4 continuations of {tokens} tokens, {token_delay * 1000:.0f} ms per token')
+    for name, stream in [('whole responses (old)', False), ('streaming', True)]:
+        # post_generation prints every continuation
+        with contextlib.redirect_stdout(io.StringIO()):
+            first_text, total, updates = run(api_base, stream, tokens)
+        report(f'{name}: first text in a child', first_text)
+        report(f'{name}: all children complete', total)
+        if stream:
+            print(f'    {updates} tree updates for {4 * tokens} streamed tokens')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) if i == 0 else float(arg) for i, arg in enumerate(sys.argv[1:])))
@@ -0,0 +1,58 @@
+import random
+import threading
+import time
+import uuid
+
+from model import TreeModel
+
+
+# Stands in for the Tk root so that TreeModel can be used without a display.
+# Virtual events run their handler immediately on the calling thread, and after() runs its callback on a timer
+# thread. <<NewNodes>> is dropped because its handler only refreshes the view (and sleeps).
+class StubApp:
+    def __init__(self):
+        self.handlers = {}
+
+    def bind(self, sequence, func, *args, **kwargs):
+        self.handlers[sequence] = func
+
+    def event_generate(self, sequence, *args, **kwargs):
+        if sequence in self.handlers and sequence != "<<NewNodes>>":
+            self.handlers[sequence](None)
+
+    def after(self, ms, func, *args):
+        threading.Timer(ms / 1000, func, args).start()
+
+
+# Returns {"root": ...} with n nodes. Each new node is attached to a random existing node, so depth is O(log n)
+# unless chain=True, in which case every node is the only child of the previous one.
+def synthetic_tree(n, chain=False, text_length=40, seed=0):
+    rng = random.Random(seed)
+    root = {"id": str(uuid.UUID(int=rng.getrandbits(128))), "text": "", "children": []}
+    nodes = [root]
+    for i in range(n - 1):
+        parent = nodes[-1] if chain else rng.choice(nodes)
+        node = {"id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "text": f" node {i} " + "x" * rng.randint(0, text_length),
+                "children": []}
+        parent["children"].append(node)
+        nodes.append(node)
+    return {"root": root}
+
+
+def synthetic_model(n, **kwargs):
+    model = TreeModel(StubApp())
+    model.load_tree_data(synthetic_tree(n, **kwargs))
+    return model
+
+
+# Returns mean seconds per call of f over repeat calls
+def time_call(f, repeat=10):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, seconds):
+    print(f'{name:<48} {seconds * 1000:>10.3f} ms')
@@ -0,0 +1,74 @@
+# Cost of the nav tree filter (TreeModel.visible on every node) with subtree and ancestry scoped tags: checking each
+# node's ancestry or subtree for the tag (old behaviour) vs. the tag index closures
+# usage: python -m benchmarks.tag_filter [num_nodes] [chain_length]
+import random
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.node_conditions import condition_lambda
+from util.util_tree import subtree_list
+
+
+def old_has_tag(model, node, tag):
+    if tag not in model.tags:
+        return False
+    if model.tags[tag]['scope'] == 'node':
+        return model.has_tag_attribute(node, tag)
+    elif model.tags[tag]['scope'] == 'subtree':
+        for ancestor in model.ancestry(node):
+            if model.has_tag_attribute(ancestor, tag):
+                return True
+        return False
+    elif model.tags[tag]['scope'] == 'ancestry':
+        for descendant in subtree_list(node):
+            if model.has_tag_attribute(descendant, tag):
+                return True
+        return False
+
+
+def old_visible(model, node):
+    and_conditions = []
+    or_conditions = []
+    for tag, attributes in model.tags.items():
+        if attributes['hide']:
+            and_conditions.append(lambda node, _tag=tag: not old_has_tag(model, node, _tag))
+        if attributes['show_only']:
+            or_conditions.append(lambda node, _tag=tag: old_has_tag(model, node, _tag))
+    return condition_lambda(node, and_conditions, or_conditions) or model.is_root(node)
+
+
+def tagged_model(n, chain=False, seed=0):
+    rng = random.Random(seed)
+    model = synthetic_model(n, chain=chain)
+    model.add_tag('draft', scope='subtree', hide=True)
+    model.add_tag('story', scope='ancestry', show_only=True)
+    nodes = model.nodes
+    for node in rng.sample(nodes, max(1, n // 200)):
+        model.tag_node(node, 'draft')
+    for node in rng.sample(nodes, max(1, n // 50)):
+        model.tag_node(node, 'story')
+    return model
+
+
+def run(label, model, repeat):
+    print(f'{label}: {len(model.tree_node_dict):,} nodes')
+    old = model.nodes_dict(filter=lambda node: old_visible(model, node))
+    assert old == model.nodes_dict(filter=model.visible)
+    report('nav filter, old has_tag', time_call(lambda: model.nodes_dict(filter=lambda node: old_visible(model, node)),
+                                                 repeat))
+    report('nav filter, tag index', time_call(lambda: model.nodes_dict(filter=model.visible), repeat))
+    node = model.nodes[len(model.tree_node_dict) // 2]
+
+    def retag():
+        model.toggle_tag(node, 'story')
+        return model.nodes_dict(filter=model.visible)
+    report('toggle a tag, then nav filter', time_call(retag, repeat))
+
+
+def main(n, chain_length):
+    run('random tree', tagged_model(n), 3)
+    run('chain', tagged_model(chain_length, chain=True), 3)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else 3000)
@@ -0,0 +1,40 @@
+# Writing Read mode textbox edits back to the nodes of a long story: diffing the whole ancestry text against the
+# textbox text (old behaviour, still the fallback) vs. applying the edit ranges recorded by TextAware to the ancestors
+# they touch. The textbox is written back on every click, focus change and navigation, usually without any edits.
+# usage: python -m benchmarks.textbox_edits [depth]
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+from util.textbox_util import distribute_textbox_changes, apply_textbox_edits
+
+
+def main(depth):
+    model = synthetic_model(depth, chain=True, text_length=400)
+    leaf = model.nodes[-1]
+    ancestry = model.ancestry(leaf)
+    offsets = model.ancestor_text_indices(leaf)
+    old_text = model.ancestry_text(leaf)
+    print(f'{depth:,} ancestors, {len(old_text):,} characters')
+
+    # typing a sentence at the end and deleting a word in the middle of the story
+    edits = []
+    text = old_text
+    for char in 'and then the story went on. ':
+        edits.append((len(text), len(text), char))
+        text += char
+    middle = len(text) // 2
+    edits.append((middle, middle + 6, ''))
+    text = text[:middle] + text[middle + 6:]
+
+    report('no edits, diff whole text (old)',
+           time_call(lambda: distribute_textbox_changes(old_text, [dict(a) for a in ancestry]), 3))
+    report('no edits, recorded edits', time_call(lambda: apply_textbox_edits([], ancestry, offsets), 3))
+    report('typing and a deletion, diff whole text (old)',
+           time_call(lambda: distribute_textbox_changes(text, [dict(a) for a in ancestry]), 3))
+    report('typing and a deletion, recorded edits',
+           time_call(lambda: apply_textbox_edits(edits, [dict(a) for a in ancestry], offsets), 3))
+    report('  (copying the ancestry, included in both)', time_call(lambda: [dict(a) for a in ancestry], 3))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
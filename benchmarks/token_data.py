@@ -0,0 +1,52 @@
+# Memory held by the token logprob data of many responses: one dict per token (old format) vs. TokenData arrays,
+# and the cost of reading tokens back through the dict view
+# usage: python -m benchmarks.token_data [num_responses]
+import random
+import sys
+import tracemalloc
+
+from benchmarks.synthetic import time_call, report
+from util.token_data import TokenData, token_starts
+
+
+def synthetic_token_dicts(rng, num_tokens, top_k):
+    token_dicts = []
+    offset = 0
+    for i in range(num_tokens):
+        token = f' w{rng.randrange(5000)}'
+        counterfactuals = {token: -rng.random()}
+        while len(counterfactuals) < top_k:
+            counterfactuals[f' w{rng.randrange(5000)}'] = -rng.random() * 10
+        token_dicts.append({'generatedToken': {'token': token, 'logprob': counterfactuals[token]},
+                            'position': {'start': offset, 'end': offset + len(token)},
+                            'counterfactuals': counterfactuals})
+        offset += len(token)
+    return token_dicts
+
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main(num_responses, num_tokens=200, top_k=10):
+    rng = random.Random(0)
+    print(f'{num_responses:,} responses x {num_tokens} tokens, top {top_k} counterfactuals')
+    dicts, dicts_size = measure(lambda: [synthetic_token_dicts(rng, num_tokens, top_k) for _ in range(num_responses)])
+    print(f'{"token dicts (old)":<48} {dicts_size / 1e6:>10.1f} MB')
+    columns, columns_size = measure(lambda: [TokenData.from_dicts(token_dicts) for token_dicts in dicts])
+    print(f'{"TokenData":<48} {columns_size / 1e6:>10.1f} MB')
+    assert columns[0].to_dicts()[5]['position'] == dicts[0][5]['position']
+
+    report('select token offsets, token dicts (old)', time_call(lambda: token_starts(dicts[0]), 100))
+    report('select token offsets, TokenData', time_call(lambda: token_starts(columns[0]), 100))
+    report('read every token, token dicts (old)',
+           time_call(lambda: [t['counterfactuals'] for t in dicts[0]], 100))
+    report('read every token, TokenData view', time_call(lambda: [t['counterfactuals'] for t in columns[0]], 100))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
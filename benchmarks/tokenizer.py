@@ -0,0 +1,36 @@
+# Per-call cost of util.tokenizer: loading the tokenizer on every call (old behaviour) vs. the shared, cached one
+# usage: python -m benchmarks.tokenizer
+from benchmarks.synthetic import time_call, report
+from util.tokenizer import tokenize, tokenize_batch, token_to_word, clear_encode_cache, \
+    encode_cache_info
+
+
+def main():
+    from transformers import GPT2Tokenizer
+    text = "The quick brown fox jumps over the lazy dog. " * 4
+    words = [f" word{i}" for i in range(500)]
+
+    report('from_pretrained per call (old)', time_call(lambda: GPT2Tokenizer.from_pretrained("gpt2")(text), 3))
+    report('first call, loads shared tokenizer', time_call(lambda: tokenize(text), 1))
+
+    def uncached():
+        clear_encode_cache()
+        tokenize(text)
+    report('tokenize, cache miss', time_call(uncached, 200))
+    report('tokenize, cache hit', time_call(lambda: tokenize(text), 2000))
+    report('token_to_word, cached', time_call(lambda: token_to_word(464), 2000))
+
+    def one_by_one():
+        clear_encode_cache()
+        for word in words:
+            tokenize(word)
+    def batched():
+        clear_encode_cache()
+        tokenize_batch(words)
+    report(f'{len(words)} strings one by one, uncached', time_call(one_by_one, 5))
+    report(f'{len(words)} strings tokenize_batch, uncached', time_call(batched, 5))
+    print(encode_cache_info())
+
+
+if __name__ == "__main__":
+    main()
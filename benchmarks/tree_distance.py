@@ -0,0 +1,50 @@
+# The minimap's selection_dist prune (limited_distance_tree) and single distance queries: walking ancestries per
+# query (old behaviour) vs. the AncestorIndex
+# usage: python -m benchmarks.tree_distance [sizes...]
+import random
+import sys
+
+from benchmarks.synthetic import synthetic_tree, time_call, report
+from util.util_tree import flatten_tree, node_ancestry, ancestry_in_range, tree_subset, limited_distance_tree, \
+    AncestorIndex
+
+
+def old_path_distance(node_a, node_b, node_dict):
+    ancestry_a = node_ancestry(node_a, node_dict)
+    ancestry_b = node_ancestry(node_b, node_dict)
+    nca = ancestry_a[-1]
+    for i in range(1, len(ancestry_a)):
+        if i > (len(ancestry_b) - 1) or ancestry_a[i] is not ancestry_b[i]:
+            nca = ancestry_a[i - 1]
+            break
+    return len(ancestry_in_range(nca, node_a, node_dict)) - 1 + len(ancestry_in_range(nca, node_b, node_dict)) - 1
+
+
+def old_limited_distance_tree(root, reference_node, distance_limit, node_dict):
+    condition = lambda node: old_path_distance(reference_node, node, node_dict) <= distance_limit
+    if not condition(root):
+        root = node_ancestry(reference_node, node_dict)[-(distance_limit + 1)]
+    return tree_subset(root, condition)
+
+
+def main(sizes):
+    for n, chain in [(size, False) for size in sizes] + [(800, True)]:
+        root = synthetic_tree(n, chain=chain)['root']
+        nodes = flatten_tree(root)
+        node_dict = {d['id']: d for d in nodes}
+        rng = random.Random(0)
+        reference = nodes[-1] if chain else rng.choice(nodes)
+        print(f'\n{n:,} nodes' + (' (chain)' if chain else ''))
+        report('selection_dist prune, walk ancestries (old)',
+               time_call(lambda: old_limited_distance_tree(root, reference, 4, node_dict), 3))
+        report('build AncestorIndex', time_call(lambda: AncestorIndex(root), 3))
+        index = AncestorIndex(root)
+        report('selection_dist prune, AncestorIndex',
+               time_call(lambda: limited_distance_tree(root, reference, 4, node_dict, index=index), 3))
+        pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(1000)]
+        report('1000 path distances (old)', time_call(lambda: [old_path_distance(a, b, node_dict) for a, b in pairs], 1))
+        report('1000 path distances, AncestorIndex', time_call(lambda: [index.path_distance(a, b) for a, b in pairs], 1))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
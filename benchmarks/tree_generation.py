@@ -0,0 +1,38 @@
+# Wall time of TreeModel.generate_tree against a stub Ollama server, one node at a time vs. concurrent levels
+# usage: python -m benchmarks.tree_generation [delay_seconds] [max_depth] [branching_factor]
+import sys
+
+from benchmarks.local_generation import stub_server
+from benchmarks.synthetic import synthetic_model
+from util.tree_expansion import expansion_report
+
+
+def run(api_base, max_workers, max_depth, branching_factor):
+    model = synthetic_model(2)
+    model.tree_raw_data['frame'] = {
+        'model_config': {'models': {'stub': {'model': 'stub', 'type': 'ollama', 'api_base': api_base,
+                                             'max_concurrency': 64}}},
+        'generation_settings': {'model': 'stub'},
+    }
+    node = model.nodes[-1]
+    num_nodes = len(model.nodes)
+    expansion = model.generate_tree(node, max_depth=max_depth, branching_factor=branching_factor,
+                                    max_workers=max_workers, on_level=lambda *args: None)
+    expansion.done.wait()
+    assert len(model.nodes) == num_nodes + sum(branching_factor ** d for d in range(1, max_depth + 1))
+    assert not model.check_index()
+    return expansion.stats
+
+
+def main(delay=0.2, max_depth=3, branching_factor=3):
+    server = stub_server(delay)
+    api_base = f'http://127.0.0.1:{server.server_address[1]}'
+    for max_workers in (1, 4, 16):
+        stats = run(api_base, max_workers, max_depth, branching_factor)
+        print(f'max_workers={max_workers}: {expansion_report(stats)}')
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(float(args[0]) if args else 0.2, int(args[1]) if len(args) > 1 else 3, int(args[2]) if len(args) > 2 else 3)
@@ -0,0 +1,31 @@
+# Compares patching the node index for single-node edits against a full rebuild_tree
+# usage: python -m benchmarks.tree_index [sizes...]
+import random
+import sys
+
+from benchmarks.synthetic import synthetic_model, time_call, report
+
+
+def edit_cycle(model, parent):
+    child = model.create_child(parent)
+    model.update_text(child, "some text", refresh_nav=False)
+    model.shift(child, 1)
+    model.delete_node(child)
+
+
+def main(sizes):
+    for n in sizes:
+        print(f'\n{n:,} nodes')
+        model = synthetic_model(n)
+        rng = random.Random(0)
+        report('full rebuild_tree', time_call(model.rebuild_tree, repeat=5))
+        # choose parents up front, reading model.nodes recomputes the preorder after structural edits
+        parents = [rng.choice(model.nodes[1:]) for _ in range(200)]
+        report('incremental create/edit/shift/delete', time_call(lambda: edit_cycle(model, parents.pop()),
+                                                                  repeat=200))
+        errors = model.check_index()
+        print('index consistent' if not errors else f'index errors: {errors[:5]}')
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
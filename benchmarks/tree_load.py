@@ -0,0 +1,58 @@
+# Opening tree files of several sizes: stdlib json and two flatten passes (old behaviour) vs. the fast parser with a
+# single flatten pass. Includes data/loom_demo.json and a deep chain, which the old path can't open.
+# usage: python -m benchmarks.tree_load [sizes...]
+import json
+import os
+import sys
+import tempfile
+
+from benchmarks.synthetic import StubApp, synthetic_tree, time_call, report
+from model import TreeModel
+from util import tree_parse
+from util.tree_save import load_tree_file, write_tree, tree_snapshot
+from util.util_tree import flatten_tree, fix_miro_tree, add_immutable_root
+
+
+def old_load(filename):
+    with open(filename) as f:
+        tree = json.load(f)
+    node_dict = {d["id"]: d for d in flatten_tree(tree["root"])}
+    for node in node_dict.values():
+        node["open"] = node.get("open", False)
+    add_immutable_root(tree)
+    node_order = flatten_tree(tree["root"])
+    node_dict = {d["id"]: d for d in node_order}
+    fix_miro_tree(node_order)
+    return node_dict
+
+
+def new_load(filename):
+    model = TreeModel(StubApp())
+    model.tree_filename = filename
+    model.load_tree_data(load_tree_file(filename))
+    return model
+
+
+def compare(name, filename):
+    print(f'\n{name}, {os.path.getsize(filename) / 1e6:.1f} MB')
+    try:
+        report('json + two flatten passes (old)', time_call(lambda: old_load(filename), 3))
+    except RecursionError:
+        print(f'{"json + two flatten passes (old)":<48} RecursionError')
+    report('fast parser + one flatten pass', time_call(lambda: new_load(filename), 3))
+
+
+def main(sizes):
+    directory = tempfile.mkdtemp()
+    print(f'parser: {"orjson" if tree_parse.orjson else "json"}')
+    demo = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'loom_demo.json')
+    if os.path.isfile(demo):
+        compare('data/loom_demo.json', demo)
+    for n, chain in [(size, False) for size in sizes] + [(20000, True)]:
+        filename = os.path.join(directory, f'{n}{"_chain" if chain else ""}.json')
+        write_tree(filename, tree_snapshot(synthetic_tree(n, chain=chain, text_length=200)))
+        compare(f'{n:,} nodes' + (' (chain)' if chain else ''), filename)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,49 @@
+# Time spent on the UI thread per save: json.dump of the whole tree (old behaviour) vs. taking a snapshot and handing
+# it to a TreeSaver, and the background cost of full and journal saves after a small edit
+# usage: python -m benchmarks.tree_save [num_nodes]
+import json
+import os
+import random
+import sys
+import tempfile
+
+from benchmarks.synthetic import synthetic_tree, time_call, report
+from util.tree_save import TreeSaver, tree_snapshot, write_tree
+from util.util_tree import flatten_tree
+
+
+def main(n):
+    tree = synthetic_tree(n, text_length=400)
+    tree['model_responses'] = {str(i): {'prompt': 'x' * 2000, 'completions': [{'text': 'y' * 200}] * 4}
+                               for i in range(n // 10)}
+    nodes = flatten_tree(tree['root'])
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'tree.json')
+    print(f'{n:,} nodes, {len(tree["model_responses"]):,} model responses')
+
+    def old_save():
+        with open(filename, 'w') as f:
+            json.dump(tree, f, indent=4)
+    report('json.dump on the UI thread (old)', time_call(old_save, 3))
+    print(f'{"file size":<48} {os.path.getsize(filename) / 1e6:>10.1f} MB')
+
+    report('snapshot (UI thread)', time_call(lambda: tree_snapshot(tree), 3))
+    report('full save, streamed and atomic', time_call(lambda: write_tree(filename, tree_snapshot(tree)), 3))
+    print(f'{"file size":<48} {os.path.getsize(filename) / 1e6:>10.1f} MB')
+
+    for journal in (False, True):
+        saver = TreeSaver()
+        saver.save(filename, tree_snapshot(tree))
+        saver.flush()
+        def edit_and_save():
+            node = rng.choice(nodes)
+            node['text'] += ' edit'
+            saver.save(filename, tree_snapshot(tree), journal=journal)
+            saver.flush()
+        report(f'edit, then {"journal" if journal else "full"} save (background)', time_call(edit_and_save, 10))
+    print(saver.stats)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,237 @@
+# Frame time of the tree visualization on synthetic trees with every node open: deleting and redrawing the whole tree
+# on each update (old behaviour, still used for chapter trees) vs. the retained layout, which redraws only changed
+# nodes and culls nodes outside the view. Runs TreeVis against a stub canvas which counts calls; each call into a
+# real canvas costs a Tcl round trip on top. Needs the app's requirements (PIL, ttkthemes) but no display.
+# usage: python -m benchmarks.tree_vis [num_nodes ...]
+import math
+import random
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_model
+from view.tree_vis import TreeVis
+
+
+class StubCanvas:
+    def __init__(self, width=1600, height=900):
+        self.width = width
+        self.height = height
+        self.view = (0, 0)
+        self.items = {}
+        self.tagged = {}
+        self.next_id = 1
+        self.calls = 0
+
+    def create(self, coords, tags=(), **options):
+        self.calls += 1
+        item = self.next_id
+        self.next_id += 1
+        self.items[item] = {'coords': list(coords), 'tags': list(tags), 'options': options}
+        for tag in tags:
+            self.tagged.setdefault(tag, set()).add(item)
+        return item
+
+    def create_text(self, x, y, tags=(), **options):
+        return self.create((x, y), tags, **options)
+
+    def create_line(self, *coords, tags=(), **options):
+        return self.create(coords, tags, **options)
+
+    def create_polygon(self, coords, tags=(), **options):
+        return self.create(coords, tags, **options)
+
+    def create_rectangle(self, coords, tags=(), **options):
+        return self.create(coords, tags, **options)
+
+    def create_image(self, x, y, tags=(), **options):
+        return self.create((x, y), tags, **options)
+
+    def create_oval(self, *coords, tags=(), **options):
+        return self.create(coords, tags, **options)
+
+    def find(self, tag):
+        if tag == 'all':
+            return list(self.items)
+        if isinstance(tag, int):
+            return [tag] if tag in self.items else []
+        return list(self.tagged.get(tag, ()))
+
+    def find_withtag(self, tag):
+        self.calls += 1
+        return self.find(tag)
+
+    # text wraps at its width with 7px characters and 16px lines
+    def bbox(self, tag):
+        self.calls += 1
+        boxes = []
+        for item in self.find(tag):
+            coords, options = self.items[item]['coords'], self.items[item]['options']
+            if 'text' in options:
+                text_width = len(options['text']) * 7
+                width = min(text_width, options['width']) if options.get('width') else text_width
+                lines = max(1, math.ceil(text_width / width)) if width else 1
+                boxes.append((coords[0], coords[1], coords[0] + width, coords[1] + lines * 16))
+            else:
+                boxes.append((min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2])))
+        if not boxes:
+            return None
+        return min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+    def delete(self, *tags):
+        self.calls += 1
+        for tag in tags:
+            for item in self.find(tag):
+                for item_tag in self.items.pop(item)['tags']:
+                    self.tagged[item_tag].discard(item)
+
+    def move(self, tag, dx, dy):
+        self.calls += 1
+        for item in self.find(tag):
+            coords = self.items[item]['coords']
+            coords[0::2] = [x + dx for x in coords[0::2]]
+            coords[1::2] = [y + dy for y in coords[1::2]]
+
+    def scale(self, tag, x, y, sx, sy):
+        self.calls += 1
+        for item in self.find(tag):
+            coords = self.items[item]['coords']
+            coords[0::2] = [x + (c - x) * sx for c in coords[0::2]]
+            coords[1::2] = [y + (c - y) * sy for c in coords[1::2]]
+
+    def coords(self, tag, *coords):
+        self.calls += 1
+        for item in self.find(tag):
+            self.items[item]['coords'] = list(coords)
+
+    def itemconfig(self, tag, **options):
+        self.calls += 1
+        for item in self.find(tag):
+            self.items[item]['options'].update(options)
+
+    itemconfigure = itemconfig
+
+    def tag_bind(self, *args):
+        self.calls += 1
+
+    def tag_lower(self, *args):
+        self.calls += 1
+
+    def tag_raise(self, *args):
+        self.calls += 1
+
+    def configure(self, **options):
+        self.calls += 1
+
+    def canvasx(self, x):
+        return self.view[0] + x
+
+    def canvasy(self, y):
+        return self.view[1] + y
+
+    def winfo_width(self):
+        return self.width
+
+    def winfo_height(self):
+        return self.height
+
+    winfo_reqwidth = winfo_width
+    winfo_reqheight = winfo_height
+
+    def after_idle(self, func):
+        pass
+
+    def after(self, ms, func, *args):
+        self.calls += 1
+        self.pending = (func, args)
+        return 'after'
+
+    def after_cancel(self, after_id):
+        self.calls += 1
+
+
+class StubIcons:
+    icons = {}
+
+    def get_icon(self, icon_name, zsize=None):
+        return icon_name
+
+
+class BenchVis(TreeVis):
+    def init_icons(self):
+        self.icons = StubIcons()
+
+    def build_canvas(self):
+        self.canvas = StubCanvas()
+
+    def bind_mouse_controls(self):
+        pass
+
+
+def make_vis(n):
+    model = synthetic_model(n, text_length=200)
+    for node in model.nodes:
+        node['open'] = True
+    vis = BenchVis(None, model, None)
+    vis.overflow_display = 'FULL'
+    return model, vis
+
+
+def frame(name, vis, func, repeat=3):
+    calls = vis.canvas.calls
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    seconds = (time.perf_counter() - start) / repeat
+    print(f'{name:<40} {seconds * 1000:>10.3f} ms {(vis.canvas.calls - calls) // repeat:>10} canvas calls '
+          f'{len(vis.canvas.items):>8} items')
+
+
+def old_draw(vis, model):
+    vis.root = model.tree_raw_data['root']
+    vis.selected_node = model.selected_node
+    vis.active = vis.get_active()
+    vis.draw_all()
+    vis.canvas.configure(scrollregion=vis.scroll_region())
+
+
+def main(sizes):
+    for n in sizes:
+        print(f'{n} nodes')
+        rng = random.Random(n)
+        model, vis = make_vis(n)
+        root = model.tree_raw_data['root']
+        frame('full redraw', vis, lambda: old_draw(vis, model), repeat=1)
+        vis.clear()
+
+        draw = lambda: vis.draw(root, model.selected_node)
+        frame('retained: first draw', vis, lambda: (vis.clear(), draw()), repeat=1)
+        frame('retained: no change', vis, draw)
+
+        visible_ids = list(vis.drawn)
+
+        def edit():
+            node = model.node(rng.choice(visible_ids))
+            node['text'] += ' edited'
+            draw()
+        frame('retained: edit a visible node', vis, edit)
+
+        def add():
+            parent = model.node(rng.choice(visible_ids))
+            model.create_child(parent, expand=False)
+            draw()
+        frame('retained: add a child', vis, add)
+
+        def select():
+            model.selected_node_id = rng.choice(visible_ids)
+            draw()
+        frame('retained: select another node', vis, select)
+
+        def scroll():
+            vis.canvas.view = (vis.canvas.view[0], vis.canvas.view[1] + 400)
+            vis.cull()
+        frame('retained: scroll 400px', vis, scroll, repeat=10)
+        print()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
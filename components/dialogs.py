@@ -1,4 +1,5 @@
 import os
+import re
 import tkinter as tk
 from tkinter import TclError, filedialog, ttk
 from tkinter.font import Font
@@ -7,7 +8,7 @@ from tkinter.scrolledtext import ScrolledText
 # from gpt import POSSIBLE_MODELS
 from util.custom_tks import Dialog, TextAware
 from util.util_tk import create_side_label, create_label, Entry, create_button, create_slider, create_combo_box, create_checkbutton
-from util.util_tree import search, node_ancestry
+from util.util_tree import node_ancestry
 from util.keybindings import tkinter_keybindings, special_keybindings
 from view.colors import default_color, text_color, bg_color, PROB_1, PROB_2, PROB_3, PROB_4, PROB_5, PROB_6
 from view.styles import textbox_config
@@ -130,6 +131,10 @@ class SearchDialog(Dialog):
         self.labels = []
         self.goto_buttons = []
         self.num_results_label = None
+        # generator of the remaining matches of the current search and the matches taken from it so far
+        self.matches = None
+        self.fetched_matches = []
+        self.pending_search = None
         self.depth_limit = None
         self.search_entry = None
         self.goto = goto
@@ -169,15 +174,24 @@ class SearchDialog(Dialog):
 
         self.depth_limit = Entry(master, master.grid_size()[1], "Max depth", "", None, width=5)
 
-        self.search_entry = Entry(master, master.grid_size()[1], "Search", "", None, width=20)
+        # ready by the time typing pauses, except for very large trees, which are searched without it until then
+        self.state.search_index.build_in_background()
+
+        self.search_entry = Entry(master, master.grid_size()[1], "Search", "", self.search_typed, width=20)
         self.search_entry.focus_entry()
         create_button(master, "Search", self.search)
 
         # return causes freeze whether or not bound
         #self.master.bind('<Return>', lambda event=None: self.search)
 
-    # TODO super deprecated
+    # search as you type, once typing pauses
+    def search_typed(self, *args):
+        if self.pending_search is not None:
+            self.master.after_cancel(self.pending_search)
+        self.pending_search = self.master.after(250, self.search)
+
     def search(self):
+        self.pending_search = None
         search_term = self.search_entry.tk_variables.get()
         if not search_term:
             print('not')
@@ -186,26 +200,44 @@ class SearchDialog(Dialog):
         if not depth_limit:
             depth_limit = None
         else:
-            depth_limit = int(depth_limit)
+            try:
+                depth_limit = int(depth_limit)
+            except ValueError:
+                print('invalid max depth:', depth_limit)
+                return
         root = self.state.selected_node if self.subtree.get() else self.state.tree_raw_data["root"]
-        print('case sensitive: ', self.case_sensitive.get())
-        matches = search(root=root,
-                         pattern=search_term,
-                         text=self.text.get(),
-                         tags=self.tags.get(),
-                         case_sensitive=self.case_sensitive.get(),
-                         regex=self.regex.get(),
-                         filter_set=self.state.tagged_nodes("canonical") if self.canonical.get() else None,
-                         max_depth=depth_limit)
-
-        self.search_results(matches)
-
+        if self.canonical.get():
+            filter_set = self.state.tag_closure("canonical") if "canonical" in self.state.tags else set()
+        else:
+            filter_set = None
+        # TODO search chapter titles and tags
+        matches = self.state.search_text(root=root,
+                                         pattern=search_term,
+                                         case_sensitive=self.case_sensitive.get(),
+                                         regex=self.regex.get(),
+                                         filter_set=filter_set,
+                                         max_depth=depth_limit) if self.text.get() else iter(())
+        self.matches = matches
+        self.fetched_matches = []
+        try:
+            self.search_results()
+        except re.error as e:
+            print('invalid pattern:', e)
+            self.matches = None
+            self.clear_results()
+            self.num_results_label = create_side_label(self.master, 'invalid pattern')
+
+    # takes matches from the current search until count have been taken or there are no more
+    def fetch_matches(self, count):
+        while self.matches is not None and len(self.fetched_matches) < count:
+            match = next(self.matches, None)
+            if match is None:
+                self.matches = None
+                break
+            self.fetched_matches.append(match)
 
-    def search_results(self, matches, start=0):
+    def clear_results(self):
         # remove previous search results
-        context_padding = 50
-        limit = 4
-        counter = 0
         if self.num_results_label:
             self.num_results_label.destroy()
         if self.next_page_button:
@@ -218,10 +250,22 @@ class SearchDialog(Dialog):
             label.destroy()
         for button in self.goto_buttons:
             button.destroy()
+        self.num_results_label = None
+        self.next_page_button = None
+        self.prev_page_button = None
         self.results = []
         self.labels = []
         self.goto_buttons = []
-        self.num_results_label = create_side_label(self.master, f'{len(matches)} results')
+
+    def search_results(self, start=0):
+        context_padding = 50
+        limit = 4
+        counter = 0
+        # one more than shown, to know whether there is a next page
+        self.fetch_matches(start + limit + 1)
+        matches = self.fetched_matches
+        self.clear_results()
+        self.num_results_label = create_side_label(self.master, f'{len(matches)}{"+" if self.matches is not None else ""} results')
         for i, match in enumerate(matches[start:]):
             if counter >= limit:
                 break
@@ -260,16 +304,22 @@ class SearchDialog(Dialog):
             counter += 1
         if start > 0:
             self.prev_page_button = create_button(self.master, "previous page",
-                                                  lambda _start=start, _limit=limit: self.search_results(matches, start=_start-_limit))
+                                                  lambda _start=start, _limit=limit: self.search_results(start=_start-_limit))
             self.prev_page_button.config(width=12)
         if len(matches) > start + limit:
             self.next_page_button = create_button(self.master, "next page",
-                                                  lambda _start=start, _limit=limit: self.search_results(matches, start=_start+_limit))
+                                                  lambda _start=start, _limit=limit: self.search_results(start=_start+_limit))
 
     def goto_result(self, id):
         self.ok()
         self.goto(node_id=id)
 
+    def destroy(self):
+        if self.pending_search is not None:
+            self.master.after_cancel(self.pending_search)
+            self.pending_search = None
+        Dialog.destroy(self)
+
 
 class GotoNode(Dialog):
     def __init__(self, parent, goto):
@@ -3,27 +3,33 @@ import tkinter as tk
 from tkinter import Canvas, ttk, simpledialog, messagebox
 from view.colors import text_color, bg_color, edit_color, vis_bg_color
 from util.custom_tks import TextAware
-from util.util_tree import tree_subset, limited_branching_tree, limited_distance_tree, flatten_tree, collapsed_wavefunction
+from util.util_tree import tree_subset, limited_branching_tree, limited_distance_tree, flatten_tree, collapsed_wavefunction, \
+    preorder
 from util.react import react_changes, unchanged
-from util.canvas_util import move_object
 from util.gpt_util import logprobs_to_probs
 from view.icons import Icons
 from view.styles import textbox_config, code_textbox_config
 from components.templates import *
 from view.tree_vis import round_rectangle
 from pprint import pformat, pprint
-from gpt import completions_text, gen
+from gpt import completions_text, gen, submit_gen
+from util.generation_executor import generation_executor, generation_report
 import uuid
 import threading
 from tkinter.colorchooser import askcolor
 from PIL import Image, ImageTk
 import os
 import json
+from collections import Counter
 
 from components.block_multiverse import BlockMultiverse
 
 icons = Icons()
 
+# moves of minimap nodes are animated in this many steps, this many ms apart
+minimap_animation_steps = 8
+minimap_animation_interval = 15
+
 
 
 class Paint(Module):
@@ -734,7 +740,8 @@ class JanusPlayground(Module):
 
 
     def inline_generate(self, *args):
-        self.textbox.inline_generate(self.state.inline_generation_settings, self.state.model_config)
+        self.textbox.inline_generate(self.state.inline_generation_settings, self.state.model_config,
+                                     self.state.post_to_main_thread)
 
     def generate(self, mode='completions', *args):
         prompt = self.textbox.get("1.0", "end-1c")
@@ -743,15 +750,23 @@ class JanusPlayground(Module):
         if mode == 'completions':
             # disable generate button
             self.generate_button.configure(state='disabled')
-            threading.Thread(target=self.call_model, args=(prompt, settings, config)).start()
+            submit_gen(prompt, settings, config, key=('playground', id(self)),
+                       callback=lambda response, error: self.state.post_to_main_thread(
+                           lambda: self.show_completions(response, error)))
         elif mode == 'eval':
             # disable eval button
             self.eval_prompt_button.configure(state='disabled')
-            threading.Thread(target=self.call_model_prompt, args=(prompt, settings, config)).start()
+            self.call_model_prompt(prompt, settings, config)
 
     def call_model(self, prompt, settings, model_config):
         response, error = gen(prompt, settings, model_config)
+        self.show_completions(response, error)
+
+    def show_completions(self, response, error):
         self.generate_button.configure(state='normal')
+        if error:
+            print(f'playground generation failed: {error}')
+            return
         self.textbox.model_response = response
         self.textbox.process_logprobs()
         response_text_list = completions_text(response)
@@ -759,8 +774,8 @@ class JanusPlayground(Module):
             self.completion_windows.open_window(completion)
 
     def call_model_prompt(self, prompt, settings, model_config):
-        self.textbox.call_model_prompt(prompt, settings, model_config)
-        self.eval_prompt_button.configure(state='normal')
+        self.textbox.call_model_prompt(prompt, settings, model_config, self.state.post_to_main_thread,
+                                       callback=lambda: self.eval_prompt_button.configure(state='normal'))
 
     def call_model_inline(self, prompt, settings, selected_range):
         self.textbox.call_model_inline(prompt, settings, selected_range)
@@ -934,6 +949,18 @@ class MiniMap(Module):
         self.old_node_coords = {}
         self.preview_textbox = None
         self.selected_node = None
+        self.old_selected_node = None
+        self.ancestry = []
+        # unaligned layout of the last pruned tree: (key, node_coords, levels, parents)
+        self.layout_cache = None
+        # {child_id: parent_id} of the drawn lines
+        self.line_parents = {}
+        # ids of the nodes colored as the selected ancestry
+        self.colored = set()
+        # settings the items were drawn with
+        self.drawn_settings = None
+        # (after id, moves) of the running animation
+        self.animation = None
 
     def build(self, parent):
         Module.build(self, parent)
@@ -979,9 +1006,14 @@ class MiniMap(Module):
         self.old_selected_node = self.selected_node
 
     def clear(self):
+        self.finish_animation()
         self.canvas.delete('all')
         self.nodes = {}
         self.lines = {}
+        self.line_parents = {}
+        self.colored = set()
+        self.old_node_coords = {}
+        self.drawn_settings = None
         self.reset()
     
     def reset(self):
@@ -989,55 +1021,67 @@ class MiniMap(Module):
         self.levels = {}
 
 
+    # Items are kept between refreshes: the minimap is laid out again (from the cached layout if the pruned tree
+    # has the same shape), and only the nodes which appeared, disappeared or moved are changed on the canvas.
+    # A selection change which doesn't change the pruned tree only moves and recolors nodes.
     def refresh(self):
         #print(self.settings())
+        self.finish_animation()
         self.selected_node = self.state.selected_node
-        # self.cache()
-        # if self.old_selected_node != self.selected_node:
-        #     self.clear()
-        # self.reset()
-        self.clear()
+        settings = self.settings()
+        if settings != self.drawn_settings:
+            self.clear()
+            self.drawn_settings = settings
         root = self.state.root()
         filtered_tree = tree_subset(root, filter=lambda node:self.callbacks["In nav"]["callback"](node=node))
         # FIXME using generate_conditional_tree for filtered_dict causes ancestry out of range error - why?
         filtered_dict = {d['id']: d for d in flatten_tree(filtered_tree)}
         self.ancestry = self.state.ancestry(self.selected_node)
         center_subtree = False
-        if self.settings()['prune_mode'] == 'ancestry_dist':
-            pruned_tree = limited_branching_tree(self.ancestry, filtered_tree, depth_limit=self.settings()['path_length_limit'])
-        elif self.settings()['prune_mode'] == 'selection_dist':
-            pruned_tree = limited_distance_tree(filtered_tree, self.selected_node, distance_limit=self.settings()['path_length_limit'], 
-                                                node_dict=filtered_dict)
-            self.ancestry = self.ancestry[-(self.settings()['path_length_limit'] + 1):]
-        elif self.settings()['prune_mode'] == 'wavefunction_collapse':
-            pruned_tree = collapsed_wavefunction(self.ancestry, filtered_tree, self.selected_node, depth_limit=self.settings()['path_length_limit'])
+        if settings['prune_mode'] == 'ancestry_dist':
+            pruned_tree = limited_branching_tree(self.ancestry, filtered_tree, depth_limit=settings['path_length_limit'])
+        elif settings['prune_mode'] == 'selection_dist':
+            pruned_tree = limited_distance_tree(filtered_tree, self.selected_node, distance_limit=settings['path_length_limit'], 
+                                                node_dict=filtered_dict, index=self.state.ancestor_index)
+            self.ancestry = self.ancestry[-(settings['path_length_limit'] + 1):]
+        elif settings['prune_mode'] == 'wavefunction_collapse':
+            pruned_tree = collapsed_wavefunction(self.ancestry, filtered_tree, self.selected_node, depth_limit=settings['path_length_limit'])
             center_subtree = True
-        elif self.settings()['prune_mode'] == 'in_nav':
+        elif settings['prune_mode'] == 'in_nav':
             pruned_tree = filtered_tree
-        elif self.settings()['prune_mode'] == 'open_in_nav':
+        elif settings['prune_mode'] == 'open_in_nav':
             pruned_tree = tree_subset(filtered_tree, filter=lambda node:self.state.is_root(node) or self.callbacks["Node open"]["callback"](node=self.state.parent(node)))
         else:
             pruned_tree = filtered_tree
-        self.compute_tree_coordinates(pruned_tree, 200, 400, level=0)
+        self.layout(pruned_tree)
         self.center_about_ancestry(self.ancestry, x_align=200, center_subtree=center_subtree)
         self.center_y(self.selected_node, 400)
         self.fix_orientation()
-        # if self.old_node_coords and self.old_selected_node == self.selected_node:
-        #     print('moving nodes')
-        #     self.move_nodes()
-        # else:
-        #     print('draw precomputed')
-        self.draw_precomputed_tree(pruned_tree)
+        self.update_canvas()
         # print('selected node:', self.selected_node)
         self.color_selection(self.selected_node)
+        self.cache()
+
+    # Sets node_coords and levels to the layout of pruned_tree before alignment, computing it only if the shape of
+    # pruned_tree changed
+    def layout(self, pruned_tree):
+        key = (tuple((node['id'], len(node['children'])) for node in preorder(pruned_tree)),
+               self.drawn_settings['level_offset'], self.drawn_settings['leaf_offset'])
+        if self.layout_cache is None or self.layout_cache[0] != key:
+            self.reset()
+            self.compute_tree_coordinates(pruned_tree, 200, 400, level=0)
+            parents = {child['id']: node['id'] for node in preorder(pruned_tree) for child in node['children']}
+            self.layout_cache = (key, dict(self.node_coords), self.levels, parents)
+        self.node_coords = dict(self.layout_cache[1])
+        self.levels = self.layout_cache[2]
 
     def compute_tree_coordinates(self, root, x, y, level=0):
         self.node_coords[root["id"]] = (x, y)
         if level not in self.levels:
             self.levels[level] = []
         self.levels[level].append(root["id"])
-        level_offset = self.settings()['level_offset']
-        leaf_offset = self.settings()['leaf_offset']
+        level_offset = self.drawn_settings['level_offset']
+        leaf_offset = self.drawn_settings['leaf_offset']
         leaf_position = x
         next_child_position = x
         for child in root['children']:
@@ -1055,28 +1099,86 @@ class MiniMap(Module):
                 coords[id] = (value[1], value[0])
             self.node_coords = coords
 
-    def draw_precomputed_tree(self, root):
-        root_x, root_y = self.node_coords[root["id"]]
-        self.draw_node(root['id'], radius=self.settings()['node_radius'], x=root_x, y=root_y)
+    # Changes the drawn minimap (old_node_coords) into the new one (node_coords)
+    def update_canvas(self):
+        parents = self.layout_cache[3]
+        added_ids, deleted_ids = react_changes(old_components=self.old_node_coords.keys(), new_components=self.node_coords.keys())
+        for node_id in deleted_ids:
+            self.canvas.delete(self.nodes.pop(node_id))
+            self.colored.discard(node_id)
+        for child_id in [child_id for child_id in self.line_parents if parents.get(child_id) is None]:
+            self.canvas.delete(self.lines.pop(child_id))
+            del self.line_parents[child_id]
 
-        for child in root['children']:
-            child_x, child_y = self.node_coords[child["id"]]
-            self.draw_connector(child['id'], root_x, root_y, child_x, child_y, fill='#000000', width=self.settings()['line_thickness'], 
-                                offset=self.settings()['leaf_offset']*5/8,
-                                connections='horizontal' if self.settings()['horizontal'] else 'vertical')
-            self.draw_precomputed_tree(child)
+        reparented_ids = [child_id for child_id, parent_id in self.line_parents.items() if parents[child_id] != parent_id]
+        self.line_parents.update((child_id, parents[child_id]) for child_id in reparented_ids)
 
-    def move_nodes(self):
-        added_ids, deleted_ids = react_changes(old_components=self.old_node_coords.keys(), new_components=self.node_coords.keys())
         persisting_ids = unchanged(old_components=self.old_node_coords.keys(), new_components=self.node_coords.keys())
+        deltas = {}
         for node_id in persisting_ids:
             old_x, old_y = self.old_node_coords[node_id]
             new_x, new_y = self.node_coords[node_id]
-            #dy = new_y - old_y
-            #dx = new_x - old_x
-            #self.canvas.move(self.nodes[node_id], dx, dy)
-            move_object(self.canvas, self.nodes[node_id], (new_x, new_y))
+            if (old_x, old_y) != (new_x, new_y):
+                deltas[node_id] = (new_x - old_x, new_y - old_y)
+
+        if self.drawn_settings.get('animate_moves', False):
+            for child_id in reparented_ids:
+                self.canvas.coords(self.lines[child_id], *self.connector_points(child_id, parents[child_id]))
+            if deltas:
+                self.animate_moves({node_id: (self.old_node_coords[node_id], self.node_coords[node_id])
+                                    for node_id in deltas})
+            self.draw_added(added_ids, parents)
+            return
 
+        # centering on the selection moves most nodes by the same amount, which is done with one move of everything
+        common, count = Counter(deltas.values()).most_common(1)[0] if deltas else ((0, 0), 0)
+        if len(persisting_ids) - count + 1 < len(deltas):
+            self.canvas.move('minimap', *common)
+        else:
+            common = (0, 0)
+        for node_id in persisting_ids:
+            dx, dy = deltas.get(node_id, (0, 0))
+            if (dx, dy) != common:
+                self.canvas.move(self.nodes[node_id], dx - common[0], dy - common[1])
+        reparented_ids = set(reparented_ids)
+        for child_id, parent_id in self.line_parents.items():
+            if child_id in reparented_ids or deltas.get(child_id, (0, 0)) != common \
+                    or deltas.get(parent_id, (0, 0)) != common:
+                self.canvas.coords(self.lines[child_id], *self.connector_points(child_id, parent_id))
+        self.draw_added(added_ids, parents)
+
+    def draw_added(self, added_ids, parents):
+        for node_id in added_ids:
+            x, y = self.node_coords[node_id]
+            self.draw_node(node_id, radius=self.drawn_settings['node_radius'], x=x, y=y)
+        for child_id, parent_id in parents.items():
+            if child_id not in self.line_parents:
+                self.draw_connector(child_id, parent_id)
+                # a node which is still colored as selected gets a line to match, color_selection changes both
+                if child_id in self.colored:
+                    self.canvas.itemconfig(self.lines[child_id], fill="blue", width=self.drawn_settings['line_thickness'] + 1)
+
+    def animate_moves(self, moves, step=1):
+        fraction = step / minimap_animation_steps
+        positions = {node_id: (old[0] + (new[0] - old[0]) * fraction, old[1] + (new[1] - old[1]) * fraction)
+                     for node_id, (old, new) in moves.items()}
+        radius = self.drawn_settings['node_radius']
+        for node_id, (x, y) in positions.items():
+            self.canvas.coords(self.nodes[node_id], x - radius, y - radius, x + radius, y + radius)
+        for child_id, parent_id in self.line_parents.items():
+            if child_id in moves or parent_id in moves:
+                self.canvas.coords(self.lines[child_id], *self.connector_points(child_id, parent_id, positions))
+        if step < minimap_animation_steps:
+            self.animation = (self.canvas.after(minimap_animation_interval, self.animate_moves, moves, step + 1), moves)
+        else:
+            self.animation = None
+
+    # Jumps to the end of the running animation
+    def finish_animation(self):
+        if self.animation is not None:
+            after_id, moves = self.animation
+            self.canvas.after_cancel(after_id)
+            self.animate_moves(moves, step=minimap_animation_steps)
 
     # TODO center remaining subtree based on extreme x values
     def center_about_ancestry(self, ancestry, x_align, level=0, center_subtree=False):
@@ -1112,19 +1214,24 @@ class MiniMap(Module):
             self.node_coords[node_id] = (self.node_coords[node_id][0], self.node_coords[node_id][1] - offset)
 
     def draw_circle(self, radius, x, y):
-        return self.canvas.create_oval(x - radius, y - radius, x + radius, y + radius, fill="black", activefill="white", activeoutline="white", outline="black")
-
-    def draw_connector(self, child_id, x1, y1, x2, y2, fill, width=1, activefill=None, offset=0, smooth=True, connections='horizontal'):
-        if connections=='horizontal':
-            self.lines[child_id] = self.canvas.create_line(x1, y1, x1 + offset, y1, x2 - offset, y2, x2, y2, smooth=smooth,
-                                                fill=fill,
-                                                activefill=activefill,
-                                                width=width)
+        return self.canvas.create_oval(x - radius, y - radius, x + radius, y + radius, fill="black", activefill="white",
+                                       activeoutline="white", outline="black", tags=['minimap'])
+
+    # Points of the line from parent_id to child_id, at positions or else at node_coords
+    def connector_points(self, child_id, parent_id, positions=None):
+        x1, y1 = positions[parent_id] if positions and parent_id in positions else self.node_coords[parent_id]
+        x2, y2 = positions[child_id] if positions and child_id in positions else self.node_coords[child_id]
+        offset = self.drawn_settings['leaf_offset']*5/8
+        if self.drawn_settings['horizontal']:
+            return x1, y1, x1 + offset, y1, x2 - offset, y2, x2, y2
         else:
-            self.lines[child_id] = self.canvas.create_line(x1, y1, x1, y1 + offset, x2, y2 - offset, x2, y2, smooth=smooth,
-                                                fill=fill,
-                                                activefill=activefill,
-                                                width=width)
+            return x1, y1, x1, y1 + offset, x2, y2 - offset, x2, y2
+
+    def draw_connector(self, child_id, parent_id):
+        self.lines[child_id] = self.canvas.create_line(*self.connector_points(child_id, parent_id), smooth=True,
+                                                       fill='#000000', width=self.drawn_settings['line_thickness'],
+                                                       tags=['minimap'])
+        self.line_parents[child_id] = parent_id
         self.canvas.tag_lower(self.lines[child_id])
 
 
@@ -1148,11 +1255,17 @@ class MiniMap(Module):
         self.preview_textbox.configure(state="disabled")
 
     def color_selection(self, selected_node):
-        # color all ancestry nodes blue
-        for node in self.ancestry:
-            self.canvas.itemconfig(self.nodes[node['id']], fill="blue", outline="blue",)
-            if node['id'] in self.lines:
-                self.canvas.itemconfig(self.lines[node['id']], fill="blue", width=self.settings()['line_thickness'] + 1)
+        # color all ancestry nodes blue, and nodes which are no longer in the ancestry black
+        ancestry_ids = {node['id'] for node in self.ancestry if node['id'] in self.nodes}
+        for node_id in self.colored - ancestry_ids:
+            self.canvas.itemconfig(self.nodes[node_id], fill="black", outline="black")
+            if node_id in self.lines:
+                self.canvas.itemconfig(self.lines[node_id], fill="#000000", width=self.settings()['line_thickness'])
+        for node_id in ancestry_ids - self.colored:
+            self.canvas.itemconfig(self.nodes[node_id], fill="blue", outline="blue",)
+            if node_id in self.lines:
+                self.canvas.itemconfig(self.lines[node_id], fill="blue", width=self.settings()['line_thickness'] + 1)
+        self.colored = ancestry_ids
 
     def select_node(self, node_id):
         self.callbacks["Nav Select"]["callback"](node_id=node_id, open=True)
@@ -1160,10 +1273,15 @@ class MiniMap(Module):
 
 class DebugConsole(Module):
     def __init__(self, callbacks, state):
+        self.generation_label = None
+        self.refresh_id = None
         Module.__init__(self, "debug", callbacks, state)
 
     def build(self, parent):
         Module.build(self, parent)
+        self.generation_label = ttk.Label(self.frame, justify='left')
+        self.generation_label.pack(side='top', fill='x')
+        self.refresh_generation_stats()
         self.debug_box = TextAware(self.frame, bd=3, height=3)
         self.debug_box.pack(expand=True, fill='both')
         self.debug_box.configure(
@@ -1180,6 +1298,17 @@ class DebugConsole(Module):
         self.debug_box.insert("end-1c", pformat(message))
         self.debug_box.configure(state="disabled")
 
+    # generation queue metrics, refreshed every second while the console is open
+    def refresh_generation_stats(self):
+        self.generation_label.configure(text=generation_report(generation_executor().stats()))
+        self.refresh_id = self.frame.after(1000, self.refresh_generation_stats)
+
+    def destroy(self):
+        if self.refresh_id is not None:
+            self.frame.after_cancel(self.refresh_id)
+            self.refresh_id = None
+        Module.destroy(self)
+
 
 class Input(Module):
     def __init__(self, callbacks, state):
@@ -1674,10 +1803,18 @@ class Transformers(Module):
         self.write_all()
         prompt = self.prompt
         n = self.generation_settings["num_continuations"]
-        threading.Thread(target=self.call_model, args=(prompt, n)).start()
+        submit_gen(prompt, self.generation_settings, self.state.model_config, key=('transformers', id(self)),
+                   callback=lambda response, error: self.state.post_to_main_thread(
+                       lambda: self.show_completions(response, error)))
 
     def call_model(self, prompt, n):
         response, error = gen(prompt, self.generation_settings, self.state.model_config)
+        self.show_completions(response, error)
+
+    def show_completions(self, response, error):
+        if error:
+            print(f'transformers generation failed: {error}')
+            return
         response_text_list = completions_text(response)
         self.completions_frame.show()
         for completion in response_text_list:
@@ -16,7 +16,8 @@ import time
 import os
 import codecs
 from PIL import Image, ImageTk
-from gpt import gen, completions_text
+from gpt import gen, submit_gen, completions_text
+from util.generation_executor import INTERACTIVE
 import json
 import bisect
 import threading
@@ -644,6 +645,8 @@ class LoomTerminal(TextAware):
         self.alternatives = []
         self.completion_index = None
         self.inline_completions = None
+        # the last inline generation request
+        self.inline_job = None
 
     def key_pressed(self, event):
         pass
@@ -813,7 +816,8 @@ class LoomTerminal(TextAware):
             return True
         return False
 
-    def inline_generate(self, generation_settings, config):
+    # post(func) runs func on the Tk thread; request callbacks come from generation worker threads
+    def inline_generate(self, generation_settings, config, post):
         prompt_length = generation_settings['prompt_length']
         if self.tag_ranges("sel"):
             self.fix_selection()
@@ -824,10 +828,23 @@ class LoomTerminal(TextAware):
             text = self.get("1.0", "insert")
             prompt = text[-prompt_length:]
             selected_range = [len(text), len(text)]
-        threading.Thread(target=self.call_model_inline, args=(prompt, generation_settings, selected_range, config)).start()
+        job = submit_gen(prompt, generation_settings, config, priority=INTERACTIVE,
+                         callback=lambda response, error: post(
+                             lambda: self.show_inline_completions(response, error, selected_range)),
+                         key=('inline', id(self), tuple(selected_range)))
+        # a request for another position or prompt replaces the last one
+        if self.inline_job is not None and self.inline_job is not job:
+            self.inline_job.cancel()
+        self.inline_job = job
 
     def call_model_inline(self, prompt, settings, selected_range, model_config):
         response, error = gen(prompt, settings, model_config)
+        self.show_inline_completions(response, error, selected_range)
+
+    def show_inline_completions(self, response, error, selected_range):
+        if error:
+            print(f'inline generation failed: {error}')
+            return
         response_text_list = completions_text(response)
         print(response_text_list)
         self.alternatives = []
@@ -843,14 +860,23 @@ class LoomTerminal(TextAware):
         self.tag_remove("alternate", "1.0", tk.END)
         self.insert_inline_completion()
 
-    def call_model_prompt(self, prompt, settings, model_config):
+    # Queues a request for the prompt's logprobs, then shows them. callback() is called when the request finishes,
+    # like showing the logprobs, on the Tk thread through post(func).
+    def call_model_prompt(self, prompt, settings, model_config, post, callback=None):
         eval_settings = settings.copy()
         eval_settings.update({'max_tokens': 1, 'num_continuations': 1, 'logprobs': 15})
-        response, error = gen(prompt, eval_settings, model_config)
-        # enable eval button
-        #self.eval_prompt_button.configure(state='normal')
-        self.model_response = response
-        self.process_logprobs()
+
+        def evaluated(response, error):
+            if callback:
+                callback()
+            if error:
+                print(f'prompt evaluation failed: {error}')
+                return
+            self.model_response = response
+            self.process_logprobs()
+        return submit_gen(prompt, eval_settings, model_config, priority=INTERACTIVE,
+                          callback=lambda response, error: post(lambda: evaluated(response, error)),
+                          key=('eval', id(self)))
 
     def insert_inline_completion(self, step=1):
         if self.inline_completions:
@@ -1089,6 +1115,7 @@ class Preferences(FrameSettings):
             "paragraph_spacing": tk.IntVar,
 
             "autosave": tk.BooleanVar,
+            "autosave_mode": tk.StringVar,
             "revision_history": tk.BooleanVar,
             "model_response": tk.StringVar,
             
@@ -1137,6 +1164,9 @@ class Preferences(FrameSettings):
         create_checkbutton(self.frame, "Autosave", "autosave", self.vars)
         self.build_pin_button("autosave")
 
+        self.create_dropdown("autosave_mode", "Autosave mode", ['full', 'journal'])
+        self.build_pin_button("autosave_mode")
+
         create_checkbutton(self.frame, "Revision history", "revision_history", self.vars)
         self.build_pin_button("revision_history")
 
@@ -1180,6 +1210,7 @@ def full_generation_settings_init(self):
             'template': tk.StringVar,
             #'post_template': tk.StringVar,
             'preset': tk.StringVar,
+            'stream': tk.BooleanVar,
         }
     for key in additional_vars.keys():
         self.vars[key] = additional_vars[key](value=self.orig_params[key])
@@ -1422,6 +1453,8 @@ class FullGenerationSettings(FrameSettings, SpecialFullGenerationSettings):
     def body(self, master):
         FrameSettings.body(self, master)
         generation_settings_body(self, build_pins=True)
+        create_checkbutton(self.frame, "Stream", "stream", self.vars)
+        self.build_pin_button("stream")
         generation_settings_templates_body(self, build_pins=True)
         self.build_write_to_frame_button()
 
@@ -1440,6 +1473,7 @@ class MinimapSettings(FrameSettings):
             'horizontal': tk.BooleanVar,
             'prune_mode': tk.StringVar,
             'path_length_limit': tk.IntVar,
+            'animate_moves': tk.BooleanVar,
         }
         self.init_vars()
 
@@ -1459,6 +1493,9 @@ class MinimapSettings(FrameSettings):
         create_checkbutton(self.frame, "Horizontal", "horizontal", self.vars)
         self.build_pin_button("horizontal")
 
+        create_checkbutton(self.frame, "Animate moves", "animate_moves", self.vars)
+        self.build_pin_button("animate_moves")
+
         self.create_dropdown("prune_mode", "Prune mode", ['in_nav', 'open_in_nav', 'ancestry_dist', 'selection_dist', 'wavefunction_collapse', 'all'])
         self.build_pin_button("prune_mode")
 
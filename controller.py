@@ -21,13 +21,16 @@ import traceback
 from view.colors import history_color, not_visited_color, visited_color, ooc_color, text_color, uncanonical_color, \
     immutable_color
 from view.display import Display
+from view.nav_tree import NavTree
+from view.story_text import StoryText
 from components.dialogs import *
 from model import TreeModel
 from util.util import clip_num, metadata, diff, split_indices, diff_linesToWords
 from util.util_tree import ancestry_in_range, depth, height, flatten_tree, stochastic_transition, node_ancestry, subtree_list, \
     node_index, nearest_common_ancestor, filtered_children
 from util.gpt_util import logprobs_to_probs, parse_logit_bias
-from util.textbox_util import distribute_textbox_changes
+from util.token_data import token_starts
+from util.textbox_util import distribute_textbox_changes, apply_textbox_edits
 from util.keybindings import tkinter_keybindings
 from view.icons import Icons
 from difflib import SequenceMatcher
@@ -58,6 +61,8 @@ class Controller:
         self.state = TreeModel(self.root)
         self.display = Display(self.root, self.callbacks, self.state, self)
         self.icons = Icons()
+        self.nav = NavTree(self.display.nav_tree, self.state.node, self.nav_item_options)
+        self.story_text = StoryText(self.display.textbox)
 
         self.register_model_callbacks()
         self.setup_key_bindings()
@@ -380,14 +385,12 @@ class Controller:
 
     def next_tag(self, tag, node=None):
         node = node if node else self.state.selected_node
-        next_tag_id = self.state.find_next(node=node, filter=lambda node: self.state.has_tag_attribute(node, tag),
-                                           visible_filter=self.in_nav)
+        next_tag_id = self.state.find_next_tag(node=node, tag=tag, visible_filter=self.in_nav)
         self.select_node(self.state.node(next_tag_id))
 
     def prev_tag(self, tag, node=None):
         node = node if node else self.state.selected_node
-        prev_tag_id = self.state.find_prev(node=node, filter=lambda node: self.state.has_tag_attribute(node, tag),
-                                           visible_filter=self.in_nav)
+        prev_tag_id = self.state.find_prev_tag(node=node, tag=tag, visible_filter=self.in_nav)
         self.select_node(self.state.node(prev_tag_id))
 
     @metadata(name="Go to next bookmark", keys=["<Key-d>", "<Control-d>"])
@@ -423,7 +426,7 @@ class Controller:
 
     @metadata(name="In nav")
     def in_nav(self, node):
-        return self.display.nav_tree.exists(node['id'])
+        return self.nav.exists(node['id'])
 
     @metadata(name="Select node")
     def select_node(self, node, noscroll=False, ask_reveal=True, open=True):
@@ -443,8 +446,6 @@ class Controller:
         if open:
             node['open'] = True
             self.refresh_nav_node(node)
-        else:
-            node['open'] = self.display.nav_tree.item(node["id"], "open")
         self.nav_history.append(self.state.selected_node_id)
         self.undo_history = []
         self.state.select_node(node['id'])
@@ -669,12 +670,15 @@ class Controller:
         if node is None:
             node = self.state.selected_node
         try:
-            node["open"] = True
-            self.display.nav_tree.item(node['id'], open=True)
+            self.nav.set_open(node, True)
         except Exception as e:
             print(str(e))
         self.state.generate_continuations(node=node, **kwargs)
 
+    @metadata(name="Cancel generation", keys=["<Control-Alt-KeyPress-g>"], display_key="")
+    def cancel_generation(self):
+        self.state.cancel_generation()
+
 
     @metadata(name="Retry")
     def retry(self, node=None):
@@ -936,7 +940,6 @@ class Controller:
             #self.display.textbox.tag_config("sel", background="black", foreground=text_color())
 
             self.display.textbox.configure(state="normal")
-            self.display.textbox.delete("1.0", "end")
 
             # if self.state.preferences.get('show_prompt', False):
             #     self.display.textbox.insert("end-1c", self.state.prompt(self.state.selected_node))
@@ -950,27 +953,20 @@ class Controller:
 
             ancestry = self.state.ancestor_text_list(self.state.selected_node)
             #self.ancestor_end_indices = indices
-            history = ''
-            for node_text in ancestry[:-1]:
-                # "end" includes the automatically inserted new line
-                history += node_text
+            history_length = sum(len(node_text) for node_text in ancestry[:-1])
             selected_text = self.state.text(self.state.selected_node)#self.state.selected_node["text"]
             prompt_length = self.state.generation_settings['prompt_length'] - len(selected_text)
-
-            in_context = history[-prompt_length:]
-            if prompt_length < len(history):
-                out_context = history[:len(history)-prompt_length]
-                self.display.textbox.insert("end-1c", out_context, "ooc_history")
-            self.display.textbox.insert("end-1c", in_context, "history")
-
-            history_end = self.display.textbox.index(tk.END)
-            self.display.textbox.insert("end-1c", selected_text)
+            # the history before the last prompt_length characters is out of context
+            in_context_start = min(max(history_length - prompt_length, 0), history_length)
 
             active_append_text = self.state.get_text_attribute(self.state.selected_node, 'active_append')
-            if active_append_text:
-                self.display.textbox.insert("end-1c", active_append_text)
-
-            self.tag_prompts()
+            # only the text after the part shared with the previously shown ancestry is replaced, see StoryText
+            self.story_text.render(ancestry[:-1] + [selected_text, active_append_text or ''],
+                                   {'ooc_history': [(0, in_context_start)],
+                                    'history': [(in_context_start, history_length)],
+                                    'prompt': self.prompt_ranges()})
+            self.display.textbox.track_edits()
+            history_end = self.display.textbox.index(f"1.0 + {history_length} chars")
             if not kwargs.get('noscroll', False):
                 self.display.textbox.update_idletasks()
                 if self.state.preferences['coloring'] == 'edit':
@@ -987,6 +983,8 @@ class Controller:
         # Textbox to edit mode, fill with single node
         elif self.display.mode == "Edit":
             self.display.textbox.configure(state="normal")
+            self.story_text.invalidate()
+            self.display.textbox.track_edits(False)
             self.display.textbox.delete("1.0", "end")
             # TODO depending on show template mode
             self.display.textbox.insert("1.0", self.state.selected_node["text"])#self.state.text(self.state.selected_node))#self.state.selected_node["text"])
@@ -1013,11 +1011,23 @@ class Controller:
     def write_textbox_changes(self):
         #print('writing')
         if self.state.preferences['editable'] and self.display.mode == 'Read' and self.state.selected_node:
-            new_text = self.display.textbox.get("1.0", "end-1c")
+            textbox = self.display.textbox
             ancestry = self.state.ancestry(self.state.selected_node)
-            changed_ancestry = distribute_textbox_changes(new_text, ancestry)
+            offsets = self.state.ancestor_text_indices(self.state.selected_node)
+            changed_ancestry = None
+            # the edits recorded since the textbox was filled are applied to the ancestors they touch. The whole text
+            # is diffed only if they weren't recorded (e.g. too many, or the textbox didn't show the ancestry's text)
+            if textbox.edits is not None and offsets and textbox.edits_length == offsets[-1][1]:
+                if not textbox.edits:
+                    return
+                changed_ancestry = apply_textbox_edits(textbox.edits, ancestry, offsets)
+            if changed_ancestry is None:
+                new_text = textbox.get("1.0", "end-1c")
+                changed_ancestry = distribute_textbox_changes(new_text, ancestry)
+            textbox.track_edits()
             for ancestor in changed_ancestry:
                 self.state.tree_node_dict[ancestor['id']]['text'] = ancestor['text']
+                self.state.text_changed(self.state.tree_node_dict[ancestor['id']])
             self.update_nav_tree(edit=[ancestor['id'] for ancestor in changed_ancestry])
 
     def select_endpoints_range(self, start_endpoint, end_endpoint):
@@ -1128,23 +1138,23 @@ class Controller:
     def index_to_ancestor(self, index):
         ancestor_end_indices = [ind[1] for ind in self.state.ancestor_text_indices(self.state.selected_node)]
         ancestor_index = bisect.bisect_left(ancestor_end_indices, index)
-        return ancestor_index, node_ancestry(self.state.selected_node, self.state.tree_node_dict)[ancestor_index]
+        return ancestor_index, self.state.ancestry(self.state.selected_node)[ancestor_index]
 
     # TODO nodes with mixed prompt/continuation
-    def tag_prompts(self):
+    # (start, end) ranges of the selected node's ancestry text which were written by the user
+    def prompt_ranges(self):
         if self.state.preferences['bold_prompt']:
             self.display.textbox.tag_config('prompt', font=('Georgia', self.state.preferences['font_size'], 'bold'))
         else:
             self.display.textbox.tag_config('prompt', font=('Georgia', self.state.preferences['font_size']))
-        self.display.textbox.tag_remove("prompt", "1.0", 'end')
+        ranges = []
         #ancestry_text = self.state.ancestry_text(self.state.selected_node)
         indices = self.state.ancestor_text_indices(self.state.selected_node)
         #start_index = 0
         for i, ancestor in enumerate(self.state.ancestry(self.state.selected_node)):
             if 'meta' in ancestor and 'source' in ancestor['meta']:
                 if not (ancestor['meta']['source'] == 'AI' or ancestor['meta']['source'] == 'mixed'):
-                    self.display.textbox.tag_add("prompt", f"1.0 + {indices[i][0]} chars",
-                                                 f"1.0 + {indices[i][1]} chars")
+                    ranges.append((indices[i][0], indices[i][1]))
                 elif ancestor['meta']['source'] == 'mixed':
                     if 'diffs' in ancestor['meta']:
                         # TODO multiple diffs in sequence
@@ -1153,9 +1163,9 @@ class Controller:
                         current_tokens = ancestor['meta']['diffs'][-1]['diff']['new']
                         total_diff = diff(original_tokens, current_tokens)
                         for addition in total_diff['added']:
-                            self.display.textbox.tag_add("prompt", f"1.0 + {indices[i][0] + addition['indices'][0]} chars",
-                                                         f"1.0 + {indices[i][0] + addition['indices'][1]} chars")
+                            ranges.append((indices[i][0] + addition['indices'][0], indices[i][0] + addition['indices'][1]))
             #start_index = indices[i][1]
+        return ranges
 
     #################################
     #   Search
@@ -1262,7 +1272,7 @@ class Controller:
                 self.change_token.meta["counterfactual_index"] = 0
                 self.change_token.meta["prev_token"] = None
                 model_response, prompt, completion = self.state.get_request_info(selected_node)
-                token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
+                token_offsets = token_starts(completion['tokens'])
                 token_index = bisect.bisect_left(token_offsets, offset) - 1
                 token_data = completion['tokens'][token_index]
                 counterfactuals = token_data['counterfactuals']
@@ -1292,7 +1302,7 @@ class Controller:
         token_data = completion['tokens'][token_index]
 
         if not self.change_token.meta['temp_token_offsets']:
-            token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
+            token_offsets = token_starts(completion['tokens'])
             self.change_token.meta['temp_token_offsets'] = token_offsets
         else:
             token_offsets = self.change_token.meta['temp_token_offsets']
@@ -1419,7 +1429,14 @@ class Controller:
 
             else:
                 if self.display.vis.textbox is None:
-                    self.display.vis.textbox_events[self.state.selected_node['id']]()
+                    node = self.state.selected_node
+                    edit = self.display.vis.textbox_events.get(node['id'])
+                    if edit:
+                        edit()
+                    elif self.display.vis.layout.position(node['id']) is not None:
+                        # culled off-screen, so it has no canvas items, but its box is still laid out
+                        self.display.vis.edit_node(node_id=node['id'], box=self.display.vis.node_box(node['id']),
+                                                   text=node['text'])
                 else:
                     self.display.vis.delete_textbox()
 
@@ -1559,20 +1576,12 @@ class Controller:
     @metadata(name="Expand children", keys=["<Control-slash>"], display_key="Ctrl-/")
     def expand_node(self, node=None):
         node = node if node else self.state.selected_node
-        node['open'] = True
-        self.display.nav_tree.item(
-            node["id"],
-            open=True
-        )
+        self.nav.set_open(node, True)
 
     @metadata(name="Collapse node", keys=["<Control-question>"], display_key="Ctrl-?")
     def collapse_node(self, node=None):
         node = node if node else self.state.selected_node
-        node['open'] = False
-        self.display.nav_tree.item(
-            node["id"],
-            open=False
-        )
+        self.nav.set_open(node, False)
 
     @metadata(name="Collapse all except subtree", keys=["<Control-colon>"], display_key="Ctrl-:")
     def collapse_all_except_subtree(self):
@@ -1713,9 +1722,10 @@ class Controller:
         if self.state.preferences['model_response'] == 'backup' and not autosave:
             self.state.backup_and_delete_model_response_data()
         elif self.state.preferences['model_response'] == 'discard':
-            self.state.tree_raw_data['model_responses'] = {}
+            self.state.discard_model_responses()
 
-        self.state.save_tree(backup=popup, save_filename=filename, subtree=subtree)
+        self.state.save_tree(backup=popup, save_filename=filename, subtree=subtree, background=autosave,
+                             journal=autosave and self.state.preferences.get('autosave_mode') == 'journal')
         if popup:
             messagebox.showinfo(title=None, message="Saved!")
         #except Exception as e:
@@ -2392,51 +2402,21 @@ class Controller:
         self.display.nav_tree.tag_configure("visited", background=visited_color())
         self.display.nav_tree.tag_configure("immutable", foreground=immutable_color())
 
-    def insert_nav(self, node, image, tags):
-        # get index of node in sibling list 
-        # if node is root, then index = 0
-        insert_idx = self.state.siblings_index(node, filter=self.state.visible)
-        parent_id = node.get("parent_id", "")
-        # TODO instead of visible, check if parent is in nav tree
-        if parent_id:
-            if not self.in_nav(self.state.node(parent_id)):
-                if not self.state.visible(self.state.node(parent_id)):
-                    #parent_id = self.state.root()['id']
-                    return
-                else:
-                    #print('parent not in nav but visible')
-                    return
-        self.display.nav_tree.insert(
-            parent=parent_id,
-            index=insert_idx,#0 if self.state.preferences.get('reverse', False) else "end",
-            iid=node["id"],
-            text=self.nav_name(node),
-            #open=True,
-            open=node.get("open", False),
-            tags=tags,
-            **dict(image=image) if image else {}
-        )
+    def nav_item_options(self, node):
+        image = self.nav_icon(node)
+        return dict(text=self.nav_name(node), tags=self.state.get_node_tags(node), **dict(image=image) if image else {})
 
+    # Only items whose ancestors are open are inserted into the treeview, see NavTree
     def build_nav_tree(self, flat_tree=None):
         if not flat_tree:
             flat_tree = self.state.nodes_dict(filter=self.state.visible)#self.state.generate_filtered_tree()
-        self.display.nav_tree.delete(*self.display.nav_tree.get_children())
-        for id in flat_tree:
-            node = self.state.node(id)
-            image = self.nav_icon(node)
-            tags = self.state.get_node_tags(node)
-            self.insert_nav(node, image, tags)
+        self.nav.build(self.state.node(id) for id in flat_tree)
         self.configure_nav_tags()
 
     # TODO Probably move this to display
     # (Re)build the nav tree
     def update_nav_tree(self, **kwargs):
-        # Save the state of opened nodes
-        # open_nodes = [
-        #     node_id for node_id in treeview_all_nodes(self.display.nav_tree)
-        #     if self.display.nav_tree.item(node_id, "open")
-        # ]
-        if not self.display.nav_tree.get_children() or kwargs.get('rebuild', False):
+        if not self.nav.members or kwargs.get('rebuild', False):
             self.build_nav_tree()
 
         #override_visible = kwargs.get('override_visible', True)
@@ -2444,30 +2424,18 @@ class Controller:
         if 'edit' not in kwargs and 'add' not in kwargs and 'delete' not in kwargs:
             return
         else:
-            #visible = lambda _node: all(condition(_node) for condition in self.state.generate_visible_conditions())
-            #visible = self.state.id_visible
             delete_items = [i for i in kwargs['delete']] if 'delete' in kwargs else []
             edit_items = [i for i in kwargs['edit'] if (i in self.state.tree_node_dict
                           and self.in_nav(node=self.state.node(i)))] if 'edit' in kwargs else []
             add_items = [i for i in kwargs['add'] if i in self.state.tree_node_dict] if 'add' in kwargs else []
 
-        self.display.nav_tree.delete(*delete_items)
-
-        for id in add_items + edit_items:
-            node = self.state.node(id)
-            image = self.nav_icon(node)
-            tags = self.state.get_node_tags(node)
-            if id in add_items:
-                #print('adding id', id)
-                if self.display.nav_tree.exists(id):
-                    self.display.nav_tree.delete(id)
-                self.insert_nav(node, image, tags)
-            elif id in edit_items:
-                self.display.nav_tree.item(id,
-                                           text=self.nav_name(node),
-                                           open=node.get("open", False),
-                                           tags=tags,
-                                           **dict(image=image) if image else {})
+        for id in delete_items:
+            self.nav.remove(id)
+
+        for id in add_items:
+            self.nav.add(self.state.node(id))
+        for id in edit_items:
+            self.nav.refresh(self.state.node(id))
 
 
     def update_chapter_nav_tree(self, **kwargs):
@@ -2497,7 +2465,7 @@ class Controller:
         if self.state.selected_node is None:
             return
 
-        if not self.display.nav_tree.exists(self.state.selected_node_id):
+        if not self.nav.reveal(self.state.selected_node_id):
             print('error: node is not in treeview')
             return
 
@@ -2511,12 +2479,7 @@ class Controller:
             except tk.TclError:
                 print('selection set error')
 
-        # Update the open state of all nodes based on the navbar
-        # TODO
-        for node in self.state.nodes:
-            if self.display.nav_tree.exists(node["id"]):
-                node["open"] = self.display.nav_tree.item(node["id"], "open")
-
+        # Open state is kept in the nodes by NavTree's open and close events
         # Update tag of node based on visited status
         self.refresh_nav_node(self.state.selected_node)
 
@@ -2525,21 +2488,13 @@ class Controller:
 
     @metadata(name="Refresh nav node")
     def refresh_nav_node(self, node):
-        if self.in_nav(node):
-            tags = self.state.get_node_tags(node)
-            image = self.nav_icon(node)
-            self.display.nav_tree.item(
-                node["id"],
-                text=self.nav_name(node),
-                open=node.get("open", False),
-                tags=tags,
-                **dict(image=image) if image else {})
+        self.nav.refresh(node)
 
 
     # add node and ancestry to open tree
     # TODO masked nodes
     def reveal_node(self, node):
-        if self.display.nav_tree.exists(node['id']):
+        if self.in_nav(node):
             return
         self.state.reveal_ancestry(node)
 
@@ -2555,6 +2510,8 @@ class Controller:
 
     @metadata(name="Center", keys=[], display_key="")
     def scroll_to_selected(self):
+        if not self.nav.reveal(self.state.selected_node_id):
+            return
         self.display.nav_tree.see(self.state.selected_node_id)
         self.set_nav_scrollbars()
 
@@ -2577,19 +2534,13 @@ class Controller:
 
     @metadata(name="Node open")
     def node_open(self, node):
-        try:
-            open = self.display.nav_tree.item(node['id'], "open")
-            return open
-        except tk.TclError:
-            return False
+        return self.in_nav(node) and node.get("open", False)
 
     def set_nav_scrollbars(self):
 
-        open_nav_nodes = self.state.nodes_list(filter=lambda node: self.in_nav(node) and self.node_open(node))
-
-        open_nav_ids = {d["id"] for d in open_nav_nodes}
-        # Ordered by tree order
-        open_nav_ids = [iid for iid in self.state.tree_node_dict.keys() if iid in open_nav_ids]
+        # only nodes with an item in the treeview can be showing their children
+        open_nav_ids = [node_id for node_id in self.nav.item_ids()
+                        if self.state.node(node_id) and self.node_open(self.state.node(node_id))]
 
         # Magic numbers
         WIDTH_PER_INDENT = 20  # Derived...
@@ -2676,7 +2627,7 @@ class Controller:
     def fix_selection(self, **kwargs):
         if not self.state.selected_node:
             self.state.selected_node_id = self.state.root()["id"]
-        elif not self.display.nav_tree.exists(self.state.selected_node_id):
+        elif not self.in_nav(self.state.selected_node):
             self.state.selected_node_id = self.state.find_next(node=self.state.selected_node,
                                                                filter=self.in_nav)
 
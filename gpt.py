@@ -5,12 +5,15 @@ from pprint import pprint
 import httpx
 import json
 import asyncio
+import threading
 import uuid
 
 from celery import Celery
 import openai
 from util.util import retry, timestamp
 from util.gpt_util import parse_logit_bias, parse_stop, get_correct_key
+from util.token_data import TokenData, token_data_json
+from util.generation_executor import generation_executor, endpoint_key, endpoint_concurrency, NORMAL
 import requests
 import codecs
 import json
@@ -19,11 +22,11 @@ import json
 '''
 {
     "completions": [{'text': string
-                     'tokens': [token_data]
+                     'tokens': TokenData
                      'finishReason': string}]
     "prompt": {
                 'text': string,
-                ? 'tokens': [token_data]
+                ? 'tokens': TokenData
               }
     "id": string
     "model": string
@@ -31,7 +34,7 @@ import json
 }
 '''
 
-# token data dictionary type
+# token data dictionary type (TokenData items, see util/token_data.py)
 '''
 {
     'generatedToken': {'logprob': float,
@@ -76,7 +79,8 @@ def gen(prompt, generation_settings, model_config, **kwargs):
             stop=parse_stop(generation_settings["stop"]) if generation_settings["stop"] else None,
             logit_bias=parse_logit_bias(generation_settings["logit_bias"]) if generation_settings["logit_bias"] else None,
             config=model_config,
-            ai21_api_key=kwargs.get('AI21_API_KEY', os.environ.get("AI21_API_KEY", None))
+            ai21_api_key=kwargs.get('AI21_API_KEY', os.environ.get("AI21_API_KEY", None)),
+            on_text=kwargs.get('on_text')
         )
         return response, error
 
@@ -86,107 +90,26 @@ def gen(prompt, generation_settings, model_config, **kwargs):
         return None, str(e)
 
 
-def generate(config, **kwargs):
+# Queues gen on the shared generation executor (util/generation_executor.py) and returns the GenerationJob;
+# callback(response, error) is called when it finishes. The settings are copied, so that later changes don't apply
+# to a queued request. Requests with the same key, prompt and settings are deduplicated while one is pending.
+def submit_gen(prompt, generation_settings, model_config, callback=None, priority=NORMAL, key=None, **kwargs):
+    settings = dict(generation_settings)
+    model_info = model_config["models"].get(settings["model"], {'type': settings["model"]})
+    if key is not None:
+        key = (key, prompt, json.dumps(settings, sort_keys=True, default=str))
+    return generation_executor().submit(endpoint_key(model_info), gen, (prompt, settings, model_config), kwargs,
+                                        callback=callback, priority=priority, key=key,
+                                        max_concurrency=endpoint_concurrency(model_info))
+
+
+# on_text(index, text), if given, is called with the text of continuation index so far as it streams in. Only local
+# servers stream; other backends return the whole response at once.
+def generate(config, on_text=None, **kwargs):
     model_type = config['models'][kwargs['model']]['type']
     
-    # Add special handling for LMStudio
-    if model_type == 'lmstudio':
-        try:
-            completions = []
-            # Make separate calls for each continuation to get different responses
-            for _ in range(kwargs['num_continuations']):
-                response = httpx.post(
-                    f"{config['models'][kwargs['model']]['api_base']}/chat/completions",
-                    json={
-                        "model": config['models'][kwargs['model']]['model'],
-                        "messages": [
-                            {"role": "system", "content": "You are a helpful AI assistant."},
-                            {"role": "user", "content": kwargs['prompt']}
-                        ],
-                        "stream": False,
-                        "temperature": kwargs['temperature'],
-                        "max_tokens": -1
-                    },
-                    headers={
-                        "Content-Type": "application/json"
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code != 200:
-                    return None, f"LMStudio API error: {response.text}"
-                
-                result = response.json()
-                completions.append({
-                    "text": result["choices"][0]["message"]["content"],
-                    "tokens": None,
-                    "finishReason": result["choices"][0]["finish_reason"]
-                })
-            
-            # Format response to match expected structure
-            formatted_response = {
-                "completions": completions,
-                "prompt": {
-                    "text": kwargs['prompt'],
-                    "tokens": None
-                },
-                "id": str(uuid.uuid4()),
-                "model": kwargs['model'],
-                "timestamp": timestamp()
-            }
-            return formatted_response, None
-            
-        except Exception as e:
-            print(f"LMStudio generation error: {str(e)}")
-            traceback.print_exc()
-            return None, str(e)
-            
-    # Add special handling for Ollama
-    elif model_type == 'ollama':
-        try:
-            completions = []
-            # Make separate calls for each continuation to get different responses
-            for _ in range(kwargs['num_continuations']):
-                response = httpx.post(
-                    f"{config['models'][kwargs['model']]['api_base']}/api/generate",
-                    json={
-                        "model": config['models'][kwargs['model']]['model'],
-                        "prompt": kwargs['prompt'],
-                        "stream": False,
-                        "temperature": kwargs['temperature'],
-                        "top_p": kwargs['top_p'],
-                    },
-                    headers={"Content-Type": "application/json"},
-                    timeout=30.0
-                )
-                
-                if response.status_code != 200:
-                    return None, f"Ollama API error: {response.text}"
-                
-                result = response.json()
-                completions.append({
-                    "text": result["response"],
-                    "tokens": None,
-                    "finishReason": "stop"
-                })
-            
-            # Format response to match expected structure
-            formatted_response = {
-                "completions": completions,
-                "prompt": {
-                    "text": kwargs['prompt'],
-                    "tokens": None
-                },
-                "id": str(uuid.uuid4()),
-                "model": kwargs['model'],
-                "timestamp": timestamp()
-            }
-            return formatted_response, None
-            
-        except Exception as e:
-            print(f"Ollama generation error: {str(e)}")
-            return None, str(e)
-            
+    if model_type in ('lmstudio', 'ollama'):
+        return local_generate(model_type, config['models'][kwargs['model']], on_text=on_text, **kwargs)
     elif model_type == 'ai21':
         response, error = ai21_generate(api_key=kwargs['ai21_api_key'], **kwargs)#config['AI21_API_KEY'], **kwargs)
         #save_response_json(response.json(), 'examples/AI21_response.json')
@@ -229,7 +152,198 @@ def completions_text(response):
 
 def save_response_json(response, filename):
     with open(filename, 'w') as f:
-        json.dump(response, f)
+        json.dump(response, f, default=token_data_json)
+
+#################################
+#   Local servers (LMStudio, Ollama)
+#################################
+
+# Continuations for local servers are requested concurrently on one pooled async client. The client lives on a
+# background event loop so that it can be shared by generation threads. Requests to the same api_base are capped
+# by the model config's 'max_concurrency' (1 sends them one at a time). When streaming, each response is read as it
+# is generated (Ollama sends a JSON object per line, LMStudio server-sent events) and passed on chunk by chunk.
+
+DEFAULT_LOCAL_CONCURRENCY = 4
+LOCAL_TIMEOUT = 30.0
+
+_local_loop = None
+_local_loop_lock = threading.Lock()
+_local_client = None
+# {api_base: (max_concurrency, asyncio.Semaphore)}, only touched from the local loop
+_endpoint_limits = {}
+
+
+class LocalServerError(Exception):
+    pass
+
+
+def local_event_loop():
+    global _local_loop
+    with _local_loop_lock:
+        if _local_loop is None:
+            _local_loop = asyncio.new_event_loop()
+            threading.Thread(target=_local_loop.run_forever, name='local-generation-loop', daemon=True).start()
+    return _local_loop
+
+
+def endpoint_semaphore(api_base, max_concurrency):
+    limit = _endpoint_limits.get(api_base)
+    if limit is None or limit[0] != max_concurrency:
+        limit = (max_concurrency, asyncio.Semaphore(max_concurrency))
+        _endpoint_limits[api_base] = limit
+    return limit[1]
+
+
+def local_client():
+    global _local_client
+    if _local_client is None:
+        _local_client = httpx.AsyncClient(timeout=LOCAL_TIMEOUT,
+                                          limits=httpx.Limits(max_keepalive_connections=DEFAULT_LOCAL_CONCURRENCY * 4))
+    return _local_client
+
+
+def lmstudio_request(model_info, prompt, temperature, **kwargs):
+    url = f"{model_info['api_base']}/chat/completions"
+    body = {
+        "model": model_info['model'],
+        "messages": [
+            {"role": "system", "content": "You are a helpful AI assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        "stream": False,
+        "temperature": temperature,
+        "max_tokens": -1
+    }
+    return url, body
+
+
+def lmstudio_completion(result):
+    return {"text": result["choices"][0]["message"]["content"],
+            "tokens": None,
+            "finishReason": result["choices"][0]["finish_reason"]}
+
+
+def ollama_request(model_info, prompt, temperature, top_p=1, **kwargs):
+    url = f"{model_info['api_base']}/api/generate"
+    body = {
+        "model": model_info['model'],
+        "prompt": prompt,
+        "stream": False,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    return url, body
+
+
+def ollama_completion(result):
+    return {"text": result["response"],
+            "tokens": None,
+            "finishReason": "stop"}
+
+
+# (text, finish reason) of a line of a streamed response, either may be None
+def lmstudio_stream_chunk(line):
+    if not line.startswith("data:"):
+        return None, None
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None, None
+    choice = json.loads(data)["choices"][0]
+    return choice.get("delta", {}).get("content"), choice.get("finish_reason")
+
+
+def ollama_stream_chunk(line):
+    if not line.strip():
+        return None, None
+    result = json.loads(line)
+    return result.get("response"), (result.get("done_reason") or "stop") if result.get("done") else None
+
+
+local_backends = {
+    'lmstudio': {'name': 'LMStudio', 'request': lmstudio_request, 'completion': lmstudio_completion,
+                 'stream_chunk': lmstudio_stream_chunk},
+    'ollama': {'name': 'Ollama', 'request': ollama_request, 'completion': ollama_completion,
+               'stream_chunk': ollama_stream_chunk},
+}
+
+
+async def local_post(url, body, semaphore, backend_name):
+    async with semaphore:
+        response = await local_client().post(url, json=body, headers={"Content-Type": "application/json"})
+    if response.status_code != 200:
+        raise LocalServerError(f"{backend_name} API error: {response.text}")
+    return response.json()
+
+
+# Streams a response, calling on_text(index, text so far) for each chunk of text. Returns the completion.
+async def local_stream_post(url, body, semaphore, backend, index, on_text):
+    text = ''
+    finish_reason = None
+    async with semaphore:
+        async with local_client().stream('POST', url, json=dict(body, stream=True),
+                                         headers={"Content-Type": "application/json"}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise LocalServerError(f"{backend['name']} API error: {response.text}")
+            async for line in response.aiter_lines():
+                chunk, finish = backend['stream_chunk'](line)
+                finish_reason = finish or finish_reason
+                if chunk:
+                    text += chunk
+                    on_text(index, text)
+    return {"text": text,
+            "tokens": None,
+            "finishReason": finish_reason or "stop"}
+
+
+# Returns completions in request order. If one request fails the others are cancelled.
+async def local_post_all(url, bodies, api_base, max_concurrency, backend, on_text=None):
+    semaphore = endpoint_semaphore(api_base, max_concurrency)
+    if on_text:
+        tasks = [asyncio.ensure_future(local_stream_post(url, body, semaphore, backend, i, on_text))
+                 for i, body in enumerate(bodies)]
+    else:
+        tasks = [asyncio.ensure_future(local_post(url, body, semaphore, backend['name'])) for body in bodies]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return results if on_text else [backend['completion'](result) for result in results]
+
+
+def local_generate(model_type, model_info, prompt, num_continuations=1, on_text=None, **kwargs):
+    backend = local_backends[model_type]
+    try:
+        # Make separate calls for each continuation to get different responses
+        url, body = backend['request'](model_info, prompt, **kwargs)
+        max_concurrency = max(1, int(model_info.get('max_concurrency', DEFAULT_LOCAL_CONCURRENCY)))
+        future = asyncio.run_coroutine_threadsafe(
+            local_post_all(url, [body] * num_continuations, model_info['api_base'], max_concurrency, backend,
+                           on_text),
+            local_event_loop())
+        completions = future.result()
+        # Format response to match expected structure
+        formatted_response = {
+            "completions": completions,
+            "prompt": {
+                "text": prompt,
+                "tokens": None
+            },
+            "id": str(uuid.uuid4()),
+            "model": kwargs['model'],
+            "timestamp": timestamp()
+        }
+        return formatted_response, None
+
+    except LocalServerError as e:
+        return None, str(e)
+    except Exception as e:
+        print(f"{backend['name']} generation error: {str(e)}")
+        traceback.print_exc()
+        return None, str(e)
+
 
 #################################
 #   Janus
@@ -270,60 +384,60 @@ def fix_openAI_token(token):
     # return byte_token.decode('utf-8')
 
 
-def format_openAI_token_dict(completion, token, i, offset):
-    calculated_offset = len(token) + offset
-    token_dict = {'generatedToken': {'token': token,
-                                     'logprob': completion['logprobs']['token_logprobs'][i]},
-                  'position': calculated_offset}
-    if completion['logprobs'].get('top_logprobs', None) is not None and \
-        completion['logprobs']['top_logprobs']:
-        openai_counterfactuals = completion['logprobs']['top_logprobs'][i]
-        if openai_counterfactuals:
-            sorted_counterfactuals = {k: v for k, v in
-                                    sorted(openai_counterfactuals.items(), key=lambda item: item[1], reverse=True)}
-            token_dict['counterfactuals'] = sorted_counterfactuals
-    else:
-        token_dict['counterfactuals'] = None
-    return token_dict, calculated_offset
-
-def format_openAI_chat_token_dict(content_token, i):
-    token_dict = {
-        'generatedToken': {'token': content_token['token'],
-                           'logprob': content_token['logprob']},
-                           'position': i,
-                           'counterfactuals' : {c['token']: c['logprob'] for c in content_token['top_logprobs']}
-        }
-    return token_dict
+def openAI_counterfactuals(completion, i):
+    top_logprobs = completion['logprobs'].get('top_logprobs', None)
+    if not top_logprobs or not top_logprobs[i]:
+        return None
+    return {k: v for k, v in sorted(top_logprobs[i].items(), key=lambda item: item[1], reverse=True)}
+
+
+# Returns TokenData for tokens [start_index, end_index) of a completion, whose text starts at offset
+def format_openAI_token_data(completion, start_index, end_index, offset):
+    tokens = completion['logprobs']['tokens'][start_index:end_index]
+    starts, ends = [], []
+    for token in tokens:
+        starts.append(offset)
+        offset += len(token)
+        ends.append(offset)
+    has_counterfactuals = bool(completion['logprobs'].get('top_logprobs', None))
+    return TokenData(tokens,
+                     completion['logprobs']['token_logprobs'][start_index:end_index],
+                     starts, ends,
+                     [openAI_counterfactuals(completion, i) for i in range(start_index, start_index + len(tokens))]
+                     if has_counterfactuals else None)
+
+
+def format_openAI_chat_token_data(content_tokens):
+    tokens = [content_token['token'] for content_token in content_tokens]
+    starts, ends = [], []
+    offset = 0
+    for token in tokens:
+        starts.append(offset)
+        offset += len(token)
+        ends.append(offset)
+    return TokenData(tokens,
+                     [content_token['logprob'] for content_token in content_tokens],
+                     starts, ends,
+                     [{c['token']: c['logprob'] for c in content_token['top_logprobs']} for content_token in content_tokens])
+
 
 def format_openAI_completion(completion, prompt_offset, prompt_end_index, is_chat):
     if 'text' in completion:
         completion_text = completion['text']
     else:
         completion_text = completion['message']['content']
-    completion_dict = {'text': completion_text[prompt_offset:],
-                       'finishReason': completion['finish_reason'],
-                       'tokens': []}
-    offset = prompt_offset
     if is_chat:
-        for i, token in enumerate(completion['logprobs']['content']):
-            token_dict = format_openAI_chat_token_dict(token, i)
-            completion_dict['tokens'].append(token_dict)
+        tokens = format_openAI_chat_token_data(completion['logprobs']['content'])
     else:
-        for i, token in enumerate(completion['logprobs']['tokens'][prompt_end_index:]):
-            j = i + prompt_end_index
-            token_dict, offset = format_openAI_token_dict(completion, token, j, offset)
-            completion_dict['tokens'].append(token_dict)
+        tokens = format_openAI_token_data(completion, prompt_end_index, None, prompt_offset)
+    completion_dict = {'text': completion_text[prompt_offset:],
+                       'finishReason': completion['finish_reason'],
+                       'tokens': tokens}
     return completion_dict
 
 
 def format_openAI_prompt(completion, prompt, prompt_end_index):
-    prompt_dict = {'text': prompt, 'tokens': []}
-    # loop over tokens until offset >= prompt length
-    offset = 0
-    for i, token in enumerate(completion['logprobs']['tokens'][:prompt_end_index]):
-        token_dict, offset = format_openAI_token_dict(completion, token, i, offset)
-        prompt_dict['tokens'].append(token_dict)
-
+    prompt_dict = {'text': prompt, 'tokens': format_openAI_token_data(completion, 0, prompt_end_index, 0)}
     return prompt_dict
 
 
@@ -404,20 +518,19 @@ def ai21_token_position(textRange, text_offset):
     return {'start': textRange['start'] + text_offset,
             'end': textRange['end'] + text_offset}
 
-def format_ai21_token_data(token, prompt_offset=0):
-    token_dict = {'generatedToken': {'token': fix_ai21_tokens(token['generatedToken']['token']),
-                                     'logprob': token['generatedToken']['logprob']},
-                  'position': ai21_token_position(token['textRange'], prompt_offset)}
-    if token['topTokens']:
-        token_dict['counterfactuals'] = {fix_ai21_tokens(c['token']): c['logprob'] for c in token['topTokens']}
-    else:
-        token_dict['counterfactuals'] = None
-    return token_dict
+def format_ai21_token_data(tokens, prompt_offset=0):
+    positions = [ai21_token_position(token['textRange'], prompt_offset) for token in tokens]
+    return TokenData([fix_ai21_tokens(token['generatedToken']['token']) for token in tokens],
+                     [token['generatedToken']['logprob'] for token in tokens],
+                     [position['start'] for position in positions],
+                     [position['end'] for position in positions],
+                     [{fix_ai21_tokens(c['token']): c['logprob'] for c in token['topTokens']} if token['topTokens']
+                      else None for token in tokens])
 
 
 def format_ai21_completion(completion, prompt_offset=0):
     completion_dict = {'text': completion['data']['text'],
-                       'tokens': [format_ai21_token_data(token, prompt_offset) for token in completion['data']['tokens']],
+                       'tokens': format_ai21_token_data(completion['data']['tokens'], prompt_offset),
                        'finishReason': completion['finishReason']['reason']}
     return completion_dict
 
@@ -426,7 +539,7 @@ def format_ai21_response(response, model):
     prompt = response['prompt']['text']
     response_dict = {'completions': [format_ai21_completion(completion, prompt_offset=len(prompt)) for completion in response['completions']],
                      'prompt': {'text': prompt,
-                                'tokens': [format_ai21_token_data(token, prompt_offset=0) for token in response['prompt']['tokens']]},
+                                'tokens': format_ai21_token_data(response['prompt']['tokens'], prompt_offset=0)},
                      'id': response['id'],
                      'model': model,
                      'timestamp': timestamp()}
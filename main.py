@@ -61,6 +61,7 @@ class Application:
         # Bind Button-1 to tab click so tabs can be closed
         self.notebook.bind('<Button-1>', self.tab_click)
         self.notebook.bind()
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_app)
 
         # Do final root prep
         self.root.update_idletasks()
@@ -132,6 +133,8 @@ class Application:
 
     def close_tab(self, event=None, index=None):
         index = self.notebook.index("current") if index is None else index
+        self.tabs[index].state.saver.flush()
+        self.tabs[index].state.close()
         self.notebook.forget(index)
         self.tabs.pop(index)
         if len(self.tabs) == 0:
@@ -191,6 +194,9 @@ class Application:
 
 
     def quit_app(self, event=None):
+        # let background saves finish
+        for tab in self.tabs:
+            tab.state.saver.flush()
         self.root.destroy()
 
 
@@ -1,29 +1,41 @@
 import functools
+import itertools
 import os
 import threading
 import time
 import math
 import uuid
+import queue
 from asyncio import Queue
 from pprint import pprint
 import bisect
+import re
 import numpy as np
 from collections import defaultdict, ChainMap
 from multiprocessing.pool import ThreadPool
 import codecs
 import json
-from util.frames_util import frame_merger, frame_merger_append, frame_merger_override
+from util.frames_util import frame_merger, frame_merger_append, frame_merger_override, copy_frame
 from copy import deepcopy
 import jsonlines
 
-from gpt import openAI_generate, search, gen
+from gpt import openAI_generate, search, gen, submit_gen
 from util.util import json_create, timestamp, json_open, clip_num, index_clip, diff
 from util.util_tree import fix_miro_tree, flatten_tree, node_ancestry, in_ancestry, get_inherited_attribute, \
-    subtree_list, generate_conditional_tree, filtered_children, \
+    normalize_tree, normalize_nodes, NORMALIZED_VERSION, subtree_list, generate_conditional_tree, filtered_children, \
     new_node, add_immutable_root, make_simple_tree, fix_tree, ancestry_in_range, ancestry_plaintext, ancestor_text_indices, \
-    node_index, ancestor_text_list, tree_subset
+    node_index, ancestor_text_list, tree_subset, AncestorIndex, postorder, preorder
 from util.gpt_util import conditional_logprob, tokenize_ada, prompt_probs, logprobs_to_probs, parse_logit_bias, parse_stop
 from util.multiverse_util import greedy_word_multiverse
+from util.tree_expansion import TreeExpansion, ExpansionCancelled, backend_rate_limiter, expansion_report
+from util.generation_executor import generation_executor, BATCH
+from util.generation_stream import GenerationStream
+from util.main_thread import main_thread_dispatcher
+from util.ancestry_index import AncestryIndex
+from util.tag_index import TagIndex
+from util.search_index import SearchIndex
+from util.tree_save import TreeSaver, tree_snapshot, load_tree_file
+from util.response_store import ResponseStore, response_store_filename
 from util.node_conditions import conditions, condition_lambda
 
 # Calls any callbacks associated with the wrapped function
@@ -61,6 +73,7 @@ DEFAULT_PREFERENCES = {
     # Saving
     'revision_history': False,
     'autosave': False,
+    'autosave_mode': 'full', # 'journal'
     #'save_counterfactuals': False,
     'model_response': 'backup', #'discard', #'save'
 
@@ -89,6 +102,7 @@ DEFAULT_MODULE_SETTINGS = {
                 'horizontal': False,
                 'prune_mode': 'open_in_nav', #'in_nav', 'ancestry_dist', 'wavefunction_collapse', 'selected_dist', 'all'
                 'path_length_limit': 10,
+                'animate_moves': False,
                 },
     'read children': {'filter': 'in_nav', #'all', 'uncleared', or name of tag TODO hide condition
                       'show_continue': 'no alternatives', #no choice, always, never, or name of tag
@@ -112,6 +126,8 @@ DEFAULT_GENERATION_SETTINGS = {
     'global_context': '',
     'logit_bias': '',
     'template': 'Default',
+    # stream continuations into their nodes as they are generated (local servers)
+    'stream': False,
 }
 
 
@@ -185,12 +201,14 @@ DEFAULT_MODEL_CONFIG = {
         'ollama': {
             'model': 'llama3.2:latest',  # Using llama3.2:latest
             'type': 'ollama',
-            'api_base': 'http://10.0.0.29:11434'
+            'api_base': 'http://10.0.0.29:11434',
+            'max_concurrency': 4,
         },
         'lmstudio': {
             'model': 'mistral-small-22b-arliai-rpmax-v1.1',
             'type': 'lmstudio',
-            'api_base': 'http://127.0.0.1:80/v1'
+            'api_base': 'http://127.0.0.1:80/v1',
+            'max_concurrency': 4,
         },
     },
     # 'api_base': None,
@@ -300,13 +318,36 @@ class TreeModel:
         self.app = root
         self.app.bind("<<TreeUpdated>>", lambda _: self.tree_updated())
         self.app.bind("<<NewNodes>>", lambda _: self.edit_new_nodes())
+        self.main_thread = main_thread_dispatcher(self.app)
 
         # All variables initialized below
         self.tree_filename = None
         # tree with all data
         self.tree_raw_data = None
-        # CALCULATED {node_id: node}
+        # CALCULATED {node_id: node}, patched in place by structural edits
         self.tree_node_dict = None
+        # CALCULATED preorder list of nodes, None when stale
+        self._node_order = None
+        # CALCULATED (_node_order, {node_id: position in _node_order})
+        self._node_positions = None
+        # CALCULATED AncestorIndex for depth, ancestor and distance queries, None when stale
+        self._ancestor_index = None
+        # CALCULATED memoized ancestry, ancestry text and text offsets, invalidated per subtree
+        self.ancestry_index = AncestryIndex(self.text, volatile=self.is_template)
+        # CALCULATED {tag: node ids} and the nodes each tag applies to given its scope
+        self.tag_index = TagIndex()
+        # CALCULATED {word: node ids} of node text, for search
+        self.search_index = SearchIndex()
+        # CALCULATED {tag: (tag index version, _node_order, sorted preorder positions of the nodes tagged with tag)}
+        self._tag_positions = {}
+        # CALCULATED (key, visible_conditions())
+        self._visible_condition = None
+        # incremented whenever a frame, the user frame or the ancestry of a frame changes
+        self.frame_version = 0
+        # CALCULATED {node_id: accumulated frames of its ancestry} for nodes with a frame, invalidated per subtree
+        self._accumulated_frames = {}
+        # CALCULATED ((selected_node_id, frame_version), state)
+        self._cached_state = None
         # {chapter_id: chapter}
         self.chapters = None
         #self.memories = None
@@ -314,13 +355,16 @@ class TreeModel:
         self.checkpoint = None
         self.canonical = None
         #self.tags = None
-        self.model_responses = None
+        # full model responses, read back by get_request_info, kept in a sidecar file next to the tree
+        self.model_responses = ResponseStore()
 
         self.selected_node_id = None
 
         self.callbacks = defaultdict(list)
         self.conditions = defaultdict(list)
         self.new_nodes = []
+        self.saver = TreeSaver()
+        self.active_expansions = []
         self.OPENAI_API_KEY = None
         self.AI21_API_KEY = None
         self.GOOSEAI_API_KEY = None
@@ -341,35 +385,35 @@ class TreeModel:
 
     @property
     def model_config(self):
-        return self.state["model_config"]
+        return copy_frame(self.cached_state()['model_config'])
 
     @property
     def generation_settings(self):
-        return self.state['generation_settings']
+        return copy_frame(self.cached_state()['generation_settings'])
 
     @property
     def inline_generation_settings(self):
-        return self.state['inline_generation_settings']
+        return copy_frame(self.cached_state()['inline_generation_settings'])
 
     @property
     def preferences(self):
-        return self.state['preferences']
+        return copy_frame(self.cached_state()['preferences'])
 
     @property
     def module_settings(self):
-        return self.state['module_settings']
+        return copy_frame(self.cached_state()['module_settings'])
 
     @property
     def workspace(self):
-        return self.state['workspace']
+        return copy_frame(self.cached_state()['workspace'])
 
     @property
     def memories(self):
-        return self.state['memories']
+        return copy_frame(self.cached_state()['memories'])
 
     @property
     def vars(self):
-        return self.state['vars']
+        return copy_frame(self.cached_state()['vars'])
     
     # user frame
 
@@ -409,21 +453,30 @@ class TreeModel:
             if self.tree_raw_data and "frame" in self.tree_raw_data \
             else {}
 
+    # A fresh copy on every access, which callers may modify. Sections are cheaper through the properties above.
     @property
     def state(self):
-        state = {}
-        state["memories"] = {}
-        state["vars"] = deepcopy(DEFAULT_VARS)
-        state["preferences"] = deepcopy(DEFAULT_PREFERENCES)
-        state["generation_settings"] = deepcopy(DEFAULT_GENERATION_SETTINGS)
-        state["inline_generation_settings"] = deepcopy(DEFAULT_INLINE_GENERATION_SETTINGS)
-        state["workspace"] = deepcopy(DEFAULT_WORKSPACE)
-        state["module_settings"] = deepcopy(DEFAULT_MODULE_SETTINGS) 
-        state["model_config"] = deepcopy(DEFAULT_MODEL_CONFIG)
-        frames = self.accumulate_frames(self.selected_node) if self.selected_node else {}
-        frame_merger.merge(state, frames)
-        frame_merger.merge(state, self.user_frame)
-        return state
+        return copy_frame(self.cached_state())
+
+    # The default state with the frames of the selected node's ancestry and the user frame merged in, recomputed
+    # when the selection or frame_version changes. Don't modify it.
+    def cached_state(self):
+        key = (self.selected_node_id if self.selected_node else None, self.frame_version)
+        if self._cached_state is None or self._cached_state[0] != key:
+            state = {}
+            state["memories"] = {}
+            state["vars"] = copy_frame(DEFAULT_VARS)
+            state["preferences"] = copy_frame(DEFAULT_PREFERENCES)
+            state["generation_settings"] = copy_frame(DEFAULT_GENERATION_SETTINGS)
+            state["inline_generation_settings"] = copy_frame(DEFAULT_INLINE_GENERATION_SETTINGS)
+            state["workspace"] = copy_frame(DEFAULT_WORKSPACE)
+            state["module_settings"] = copy_frame(DEFAULT_MODULE_SETTINGS)
+            state["model_config"] = copy_frame(DEFAULT_MODEL_CONFIG)
+            if self.selected_node:
+                frame_merger.merge(state, copy_frame(self.accumulated_frames(self.selected_node)))
+            frame_merger.merge(state, copy_frame(self.user_frame))
+            self._cached_state = (key, state)
+        return self._cached_state[1]
 
 
     def name(self):
@@ -437,20 +490,44 @@ class TreeModel:
     At any node in the multiverse, the state of the tree is the accumulation of all frames from its ancestry, 
     applied in chronological order (the future can override the past).
     A frame is a dictionary which is merged into the state of the tree using deepmerge.
+    The accumulated frames of each node with a frame are cached as (entry of the nearest framed ancestor,
+    accumulation), and an entry is only reused while the entry it was built on is still the current one, so
+    changing a frame (frames_changed) or moving a subtree invalidates the accumulations below it without walking it.
+    Changes bump frame_version, which invalidates the cached state.
     """
 
     def accumulate_frames(self, node):
-        frames = []
+        return copy_frame(self.accumulated_frames(node))
+
+    # Cached, don't modify
+    def accumulated_frames(self, node):
+        entry = None
         for ancestor in self.ancestry(node):
-            if 'frame' in ancestor:
-                frames.append(ancestor['frame'])
-        frame_accumulator = {}
-        for frame in frames:
-            frame_merger.merge(frame_accumulator, deepcopy(frame))
-        return frame_accumulator
+            if 'frame' not in ancestor:
+                continue
+            cached = self._accumulated_frames.get(ancestor['id'])
+            if cached is None or cached[0] is not entry:
+                accumulated = copy_frame(entry[1]) if entry else {}
+                frame_merger.merge(accumulated, copy_frame(ancestor['frame']))
+                cached = (entry, accumulated)
+                self._accumulated_frames[ancestor['id']] = cached
+            entry = cached
+        return entry[1] if entry else {}
+
+    # call when the frame of node changes. With no node, forgets every accumulation.
+    def frames_changed(self, node=None):
+        self.frame_version += 1
+        if node is None:
+            self._accumulated_frames.clear()
+        else:
+            self._accumulated_frames.pop(node['id'], None)
+
+    def user_frame_changed(self):
+        self.frame_version += 1
 
     def set_frame(self, frame_parent, frame):
         frame_parent['frame'] = deepcopy(frame)
+        self.frames_changed(frame_parent)
 
     # def overwrite_frame(self, frame, new_frame):
     #     frame = deepcopy(new_frame)
@@ -482,6 +559,7 @@ class TreeModel:
             self.update(node['frame'], update, append)
         else:
             node['frame'] = deepcopy(update)
+        self.frames_changed(node)
         self.tree_updated(write=False)
 
     def get_frame(self, node):
@@ -489,12 +567,14 @@ class TreeModel:
 
     def set_user_frame(self, state):
         self.tree_raw_data['frame'] = deepcopy(state)
+        self.user_frame_changed()
 
     def update_user_frame(self, update, append=False):
         if 'frame' in self.tree_raw_data:
             self.update(self.tree_raw_data['frame'], update, append)
         else:
             self.tree_raw_data['frame'] = deepcopy(update)
+        self.user_frame_changed()
         self.tree_updated(write=False)
 
     # TODO merge with frame
@@ -502,11 +582,13 @@ class TreeModel:
         if 'frame' not in self.tree_raw_data:
             self.tree_raw_data['frame'] = {}
         self.set_path(self.tree_raw_data['frame'], value, path)
+        self.user_frame_changed()
         
     def set_frame_partial(self, node, value, path):
         if 'frame' not in node:
             node['frame'] = {}
         self.set_path(node['frame'], value, path)
+        self.frames_changed(node)
 
     def clear_user_frame(self):
         self.set_user_frame({})
@@ -525,10 +607,28 @@ class TreeModel:
         self.callbacks[func.__name__].append(callback)
 
     # Decorator calls callbacks
+    # Structural edits in the model patch tree_node_dict themselves, so the full rebuild is only
+    # needed when the whole tree has been replaced
+    # Text edits reported with edit=[ids] invalidate memoized ancestry text below those nodes only (text_changed).
+    # Added nodes are invalidated too, since their text is often written after they were created (and possibly
+    # memoized). Updates which don't say what changed may have edited text anywhere.
     @event
-    def tree_updated(self, rebuild_dict=True, **kwargs):
+    def tree_updated(self, rebuild_dict=False, **kwargs):
         if self.tree_raw_data and rebuild_dict:
             self.rebuild_tree()
+            return
+        for node_id in kwargs.get('add') or ():
+            if node_id in self.tree_node_dict:
+                self.ancestry_index.invalidate(self.tree_node_dict[node_id])
+                self.search_index.node_changed(self.tree_node_dict[node_id])
+        if kwargs.get('edit'):
+            for node_id in kwargs['edit']:
+                if node_id in self.tree_node_dict:
+                    self.text_changed(self.tree_node_dict[node_id])
+        elif not any(kwargs.get(key) for key in ('add', 'delete', 'rebuild')):
+            self.ancestry_index.clear()
+            self.search_index.texts_changed()
+            self.frame_version += 1
 
     # def tree_updated_silent(self):
     #     self.rebuild_tree()
@@ -536,8 +636,17 @@ class TreeModel:
     @event
     def rebuild_tree(self):
         add_immutable_root(self.tree_raw_data)
-        self.tree_node_dict = {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
-        fix_miro_tree(self.nodes)
+        self._node_order = flatten_tree(self.tree_raw_data["root"])
+        self._ancestor_index = None
+        self.tree_node_dict = {}
+        for node in self._node_order:
+            self.tree_node_dict[node["id"]] = node
+            # If things don't have an open state, give one to them
+            node.setdefault("open", False)
+        self.ancestry_index.reset(self.tree_node_dict)
+        self.tag_index.reset(self.tree_node_dict)
+        self.search_index.reset(self.tree_node_dict)
+        self.frames_changed()
 
 
     @event
@@ -550,6 +659,39 @@ class TreeModel:
         self.tree_updated(edit=self.new_nodes[0])
         del self.new_nodes[0]
 
+    # Runs func on the Tk thread and waits for its result. Used by background threads which need to edit the tree.
+    def run_on_main_thread(self, func):
+        if threading.current_thread() is threading.main_thread():
+            return func()
+        done = threading.Event()
+        result = {}
+
+        def call():
+            try:
+                result['value'] = func()
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
+
+        self.post_to_main_thread(call)
+        while not done.wait(0.1):
+            # the call is dropped once the tab is closed, and never runs once the app has quit
+            if self.main_thread.closed(self) or not threading.main_thread().is_alive():
+                raise RuntimeError('tab closed before the main thread call ran')
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    # Queues func to run on the Tk thread without waiting for it. Dropped if the tab is closed first.
+    def post_to_main_thread(self, func):
+        self.main_thread.post(func, owner=self)
+
+    # Called when the tab is closed: stops its tree generation and drops its pending main thread calls
+    def close(self):
+        self.main_thread.close(self)
+        self.cancel_tree_generation()
+
     @event
     def pre_selection_updated(self, **kwargs):
         pass
@@ -562,6 +704,85 @@ class TreeModel:
     def io_update(self):
         pass
 
+    #################################
+    #   Index
+    #################################
+    """
+    tree_node_dict is an index {node_id: node} of every node reachable from the root through "children".
+    Each node's "parent_id" is its parent pointer. Structural edits patch only the entries they touch
+    instead of calling rebuild_tree, which flattens the whole tree. Preorder (nodes) is recomputed lazily.
+    """
+
+    # add node and its descendants to the index, optionally attaching it to parent
+    def index_subtree(self, node, parent=None):
+        if parent is not None:
+            node["parent_id"] = parent["id"]
+        self.ancestry_changed(node)
+        subtree = flatten_tree(node)
+        for d in subtree:
+            self.tree_node_dict[d["id"]] = d
+        self.tag_index.nodes_added(subtree)
+        self.search_index.nodes_added(subtree)
+        self._node_order = None
+        self._ancestor_index = None
+
+    # remove node and its descendants from the index
+    def unindex_subtree(self, node):
+        self.ancestry_changed(node)
+        subtree = subtree_list(node)
+        for d in subtree:
+            self.tree_node_dict.pop(d["id"], None)
+        self.tag_index.nodes_removed(subtree)
+        self.search_index.nodes_removed(subtree)
+        self._node_order = None
+        self._ancestor_index = None
+
+    # call when children are reordered or moved without entering or leaving the tree
+    def index_order_changed(self):
+        self._node_order = None
+        self._ancestor_index = None
+
+    # call when the text of node changes. Forgets the memoized ancestry text of its subtree; frames and tag closures
+    # don't depend on text, so the cached state and tag closures are kept.
+    def text_changed(self, node):
+        self.ancestry_index.invalidate(node)
+        self.search_index.node_changed(node)
+
+    # call when the parent of node changes, or to forget everything derived from the ancestry of its subtree
+    def ancestry_changed(self, node):
+        self.text_changed(node)
+        # frames above node may have changed
+        self.frame_version += 1
+        self.tag_index.structure_changed()
+
+    # Returns a list of inconsistencies between tree_node_dict and the tree. Empty if consistent.
+    def check_index(self):
+        errors = []
+        root = self.tree_raw_data["root"]
+        if root.get("parent_id"):
+            errors.append(f'root {root["id"]} has parent_id {root["parent_id"]}')
+        seen = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node["id"] in seen:
+                errors.append(f'duplicate id {node["id"]}')
+                continue
+            seen.add(node["id"])
+            if self.tree_node_dict.get(node["id"]) is not node:
+                errors.append(f'node {node["id"]} is missing from the index')
+            for child in node["children"]:
+                if child.get("parent_id") != node["id"]:
+                    errors.append(f'node {child.get("id")} has parent_id {child.get("parent_id")}, '
+                                  f'expected {node["id"]}')
+                stack.append(child)
+        for node_id in self.tree_node_dict.keys() - seen:
+            errors.append(f'stale index entry {node_id}')
+        if self._node_order is not None and [d["id"] for d in self._node_order] != \
+                [d["id"] for d in flatten_tree(root)]:
+            errors.append('cached node order is stale')
+        return errors
+
     #################################
     #   Access
     #################################
@@ -594,32 +815,74 @@ class TreeModel:
 
     @property
     def nodes(self):
-        return list(self.tree_node_dict.values()) if self.tree_node_dict else None
+        if not self.tree_node_dict:
+            return None
+        return list(self.node_order())
+
+    # Cached preorder list of nodes, don't modify
+    def node_order(self):
+        if self._node_order is None:
+            self._node_order = flatten_tree(self.tree_raw_data["root"])
+        return self._node_order
+
+    # {node_id: preorder position}, rebuilt when the cached preorder is
+    @property
+    def node_positions(self):
+        order = self.node_order()
+        if self._node_positions is None or self._node_positions[0] is not order:
+            self._node_positions = (order, {d["id"]: i for i, d in enumerate(order)})
+        return self._node_positions[1]
+
+    # Preorder position of node. Raises ValueError if it isn't in the tree.
+    def node_position(self, node):
+        position = self.node_positions.get(node["id"])
+        if position is None or self._node_order[position] is not node:
+            raise ValueError(f'node {node["id"]} is not in the tree')
+        return position
+
+    @property
+    def ancestor_index(self):
+        if not self.tree_node_dict:
+            return None
+        if self._ancestor_index is None:
+            self._ancestor_index = AncestorIndex(self.tree_raw_data["root"])
+        return self._ancestor_index
 
 
     @property
     def tree_traversal_idx(self):
-        return self.nodes.index(self.selected_node)
+        return self.node_position(self.selected_node)
 
 
     def nodes_list(self, filter=None):
         #tree = tree if tree else self.tree_node_dict
         if not filter:
-            return list(self.tree_node_dict.values())
+            return self.nodes
         else:
-            return [n for n in list(self.tree_node_dict.values()) if filter(n)]
+            return [n for n in self.nodes if filter(n)]
 
     def nodes_dict(self, filter=None):
         nodes = self.nodes_list(filter)
         return {d['id']: d for d in nodes}
 
     def traversal_idx(self, node, filter=None):
-        #tree = tree if tree else self.tree_node_dict
-        nodes = self.nodes_list(filter) if filter else self.nodes
-        return nodes.index(node)
-        # for i, node in enumerate(nodes):
-        #     if node['id'] == node_id:
-        #         return i
+        position = self.node_position(node)
+        if not filter:
+            return position
+        if not filter(node):
+            raise ValueError(f'node {node["id"]} does not satisfy filter')
+        order = self.node_order()
+        return sum(1 for i in range(position) if filter(order[i]))
+
+    # Nodes after (or with step=-1 before) node in preorder, then wrapping around to node itself
+    def traversal_from(self, node, step=1):
+        order = self.node_order()
+        position = self.node_position(node)
+        if step > 0:
+            positions = itertools.chain(range(position + 1, len(order)), range(0, position + 1))
+        else:
+            positions = itertools.chain(range(position - 1, -1, -1), range(len(order) - 1, position - 1, -1))
+        return (order[i] for i in positions)
 
     def filter_indices(self, nodes, filter=None):
         if filter:
@@ -630,18 +893,24 @@ class TreeModel:
 
     # Returns [{chapter: {}, id, children: []}, ...]
     def _build_chapter_trees(self, node):
-        # Returns a 1 element list if the node is a chapter, else a list of children chapters
-        children_chapter_lists = [self._build_chapter_trees(child) for child in node["children"]]
-        children_chapters = [item for sublist in children_chapter_lists for item in sublist]
-        if "chapter_id" in node:
-            chapter = self.chapters[node["chapter_id"]]
-            return [{
-                "chapter": chapter,
-                "id": chapter["id"],
-                "children": children_chapters
-            }]
-        else:
-            return children_chapters
+        # {id(node): 1 element list if the node is a chapter, else a list of children chapters}
+        chapters_below = {}
+        for d in postorder(node):
+            children = d["children"]
+            if len(children) == 1:
+                children_chapters = chapters_below.pop(id(children[0]))
+            else:
+                children_chapters = [item for child in children for item in chapters_below.pop(id(child))]
+            if "chapter_id" in d:
+                chapter = self.chapters[d["chapter_id"]]
+                chapters_below[id(d)] = [{
+                    "chapter": chapter,
+                    "id": chapter["id"],
+                    "children": children_chapters
+                }]
+            else:
+                chapters_below[id(d)] = children_chapters
+        return chapters_below[id(node)]
 
     # Returns tuple of
     #  [ {chapter{}, id, parent_id, children[]}, ... ]
@@ -659,24 +928,60 @@ class TreeModel:
     #   Ancestry
     #################################
 
+    # These use the memoized ancestry index and fall back to walking the ancestry when it has no entry for node
+    # (ancestries containing templates) or root is not an ancestor of node
+
+    # Returns the index entries from root (default progenitor) to node, or None
+    def ancestry_chain(self, node, root=None):
+        chain = self.ancestry_index.chain(node)
+        if chain is None or not root:
+            return chain
+        root_entry = self.ancestry_index.entries.get(root['id'])
+        if root_entry is None or root_entry.depth >= len(chain) or chain[root_entry.depth] is not root_entry:
+            return None
+        return chain[root_entry.depth:]
+
     def ancestry(self, node, root=None):
+        chain = self.ancestry_chain(node, root)
+        if chain is not None:
+            return [entry.node for entry in chain]
         if not root:
             return node_ancestry(node, self.tree_node_dict)
         else: 
             return ancestry_in_range(root=root, node=node, node_dict=self.tree_node_dict)
 
     def ancestry_text(self, node, root=None):
+        text = self.ancestry_index.text(node)
+        if text is not None:
+            if not root:
+                return text
+            chain = self.ancestry_chain(node, root)
+            if chain is not None:
+                return text[chain[0].start:]
         ancestry = self.ancestry(node, root)
         return ancestry_plaintext(ancestry, text_callback=self.text)
 
     def ancestor_text_list(self, node, root=None):
+        chain = self.ancestry_chain(node, root)
+        if chain is not None:
+            return [entry.text for entry in chain]
         ancestry = self.ancestry(node, root)
         return ancestor_text_list(ancestry, text_callback=self.text)
 
     def ancestor_text_indices(self, node, root=None):
+        chain = self.ancestry_chain(node, root)
+        if chain is not None:
+            offset = chain[0].start
+            return [(entry.start - offset, entry.end - offset) for entry in chain]
         ancestry = self.ancestry(node, root)
         return ancestor_text_indices(ancestry, text_callback=self.text)
 
+    def nearest_common_ancestor(self, node_a, node_b):
+        return self.ancestor_index.nearest_common_ancestor(node_a, node_b)
+
+    def path_distance(self, node_a, node_b):
+        return self.ancestor_index.path_distance(node_a, node_b)
+
     def chain_uninterrupted(self, start, end):
         # returns true if chain of nodes has no other siblings
         chain = ancestry_in_range(start, end, self.tree_node_dict)
@@ -697,6 +1002,59 @@ class TreeModel:
         return delimiter.join(self.children_text_list(node, filter))
 
 
+    #################################
+    #   Search
+    #################################
+
+    # Yields {'node_id', 'span', 'match'} for the matches of pattern in the text of root and its descendants, in
+    # preorder, like util_tree.search. Once the search index is built, only nodes whose text can match according to it
+    # are searched. filter_set (node ids) and max_depth limit the descent from root as in preorder. Raises re.error for
+    # invalid regular expressions.
+    def search_text(self, root, pattern, case_sensitive=False, regex=True, filter_set=None, max_depth=None):
+        if (filter_set is not None and root['id'] not in filter_set) or max_depth == 0:
+            return
+        compiled = re.compile(pattern if regex else re.escape(pattern), 0 if case_sensitive else re.IGNORECASE)
+        if self.search_index.ready():
+            candidate_ids = self.search_index.candidates(pattern, regex=regex)
+        else:
+            # building the index would block the Tk thread, so every node is searched until it is built
+            self.search_index.build_in_background()
+            candidate_ids = None
+        if candidate_ids is None or len(candidate_ids) > len(self.tree_node_dict) // 4:
+            # walking the tree is cheaper than sorting most of its nodes
+            nodes = preorder(root, (lambda child: child['id'] in filter_set) if filter_set is not None else None,
+                             max_depth)
+            if candidate_ids is not None:
+                nodes = (node for node in nodes if node['id'] in candidate_ids)
+        else:
+            positions = self.node_positions
+            # {node_id: depth below root, None if not reachable from root}
+            depths = {root['id']: 0}
+
+            def depth_below_root(node):
+                path = []
+                while node is not None and node['id'] not in depths:
+                    path.append(node)
+                    node = self.tree_node_dict.get(node.get('parent_id')) \
+                        if filter_set is None or node['id'] in filter_set else None
+                depth = depths[node['id']] if node is not None else None
+                for ancestor in reversed(path):
+                    depth = depth + 1 if depth is not None else None
+                    depths[ancestor['id']] = depth
+                return depth
+
+            def within_depth(node):
+                depth = depth_below_root(node)
+                return depth is not None and (max_depth is None or depth < max_depth)
+
+            nodes = (self.tree_node_dict[node_id] for node_id in
+                     sorted((node_id for node_id in candidate_ids if node_id in positions), key=positions.get))
+            nodes = filter(within_depth, nodes)
+        for node in nodes:
+            for match in compiled.finditer(node['text']):
+                yield {'node_id': node['id'], 'span': match.span(), 'match': match.group()}
+
+
     #################################
     #   Traversal
     #################################
@@ -713,7 +1071,7 @@ class TreeModel:
                 self.reveal_nodes([self.selected_node])
 
             # Open all parents but not the node itself
-            ancestors = node_ancestry(self.selected_node, self.tree_node_dict)
+            ancestors = self.ancestry(self.selected_node)
             for ancestor in ancestors[:-1]:
                 ancestor["open"] = True
             # Always open the root
@@ -729,34 +1087,72 @@ class TreeModel:
     #         return self.select_node(new_node_id)
 
     # this only works if node is in filter
+    # Steps over the nodes between node and the result only, instead of filtering the whole tree
     def next_id(self, node, offset=1, filter=None):
-        nodes = self.nodes_list(filter)
-        traversal_idx = self.traversal_idx(node, filter)
-        new_idx = clip_num(traversal_idx + offset, 0, len(nodes) - 1)
-        return nodes[new_idx]["id"]
+        if filter and not filter(node):
+            raise ValueError(f'node {node["id"]} does not satisfy filter')
+        if not filter:
+            order = self.node_order()
+            return order[clip_num(self.node_position(node) + offset, 0, len(order) - 1)]["id"]
+        order = self.node_order()
+        position = self.node_position(node)
+        step = 1 if offset > 0 else -1
+        positions = range(position + step, len(order), step) if step > 0 else range(position + step, -1, step)
+        new_node = node
+        remaining = abs(offset)
+        for i in positions:
+            if not remaining:
+                break
+            if filter(order[i]):
+                new_node = order[i]
+                remaining -= 1
+        return new_node["id"]
 
     # return id of next node which satisfies filter condition
+    # Nodes are tested in preorder from node, so this costs the distance to the result, not the size of the tree
     def find_next(self, node, filter=None, visible_filter=None):
-        nodes = self.nodes_list(visible_filter) if visible_filter else self.nodes
-        current_idx = self.traversal_idx(node, visible_filter)
-        true_indices = self.filter_indices(nodes, filter)
-        if len(true_indices) < 1:
-            return
-        try:
-            go_to_true = next(i for i, idx in enumerate(true_indices.keys()) if idx > current_idx)
-        except StopIteration:
-            go_to_true = 0
-        return list(true_indices.values())[go_to_true]["id"]
+        for d in self.traversal_from(node, 1):
+            if (not visible_filter or visible_filter(d)) and (not filter or filter(d)):
+                return d["id"]
 
     def find_prev(self, node, filter=None, visible_filter=None):
-        nodes = self.nodes_list(visible_filter) if visible_filter else self.nodes
-        current_idx = self.traversal_idx(node, visible_filter)
-        true_indices = self.filter_indices(nodes, filter)
-        if len(true_indices) < 1:
-            return
-        earlier_true = list(i for i, idx in enumerate(true_indices.keys()) if idx < current_idx)
-        go_to_true = earlier_true[-1] if len(earlier_true) > 0 else -1
-        return list(true_indices.values())[go_to_true]["id"]
+        for d in self.traversal_from(node, -1):
+            if (not visible_filter or visible_filter(d)) and (not filter or filter(d)):
+                return d["id"]
+
+    # Sorted preorder positions of the nodes tagged with tag (ignoring its scope), kept until the tag index or the
+    # preorder changes
+    def tag_positions(self, tag):
+        order = self.node_order()
+        cached = self._tag_positions.get(tag)
+        if cached is None or cached[0] != self.tag_index.version or cached[1] is not order:
+            node_positions = self.node_positions
+            positions = sorted(node_positions[node_id] for node_id in self.tag_index.tagged_ids(tag)
+                               if node_id in node_positions)
+            cached = (self.tag_index.version, order, positions)
+            self._tag_positions[tag] = cached
+        return cached[2]
+
+    # find_next/find_prev with filter=lambda node: self.has_tag_attribute(node, tag), by bisecting tag_positions
+    def find_next_tag(self, node, tag, visible_filter=None):
+        return self.find_tagged(node, tag, 1, visible_filter)
+
+    def find_prev_tag(self, node, tag, visible_filter=None):
+        return self.find_tagged(node, tag, -1, visible_filter)
+
+    def find_tagged(self, node, tag, step, visible_filter=None):
+        positions = self.tag_positions(tag)
+        position = self.node_position(node)
+        if step > 0:
+            split = bisect.bisect_right(positions, position)
+            candidates = itertools.chain(positions[split:], positions[:split])
+        else:
+            split = bisect.bisect_left(positions, position)
+            candidates = itertools.chain(reversed(positions[:split]), reversed(positions[split:]))
+        order = self.node_order()
+        for i in candidates:
+            if not visible_filter or visible_filter(order[i]):
+                return order[i]["id"]
 
     def parent(self, node):
         return self.node(node['parent_id']) if 'parent_id' in node else None
@@ -845,15 +1241,28 @@ class TreeModel:
         else:
             return generate_conditional_tree(root, condition)
 
+    # Reused until tags, their settings or the nodes they apply to change
     def visible_conditions(self):
-        and_conditions = []
-        or_conditions = []
-        for tag, attributes in self.tags.items():
-            if attributes['hide']:
-                and_conditions.append(lambda node, _tag=tag: not self.has_tag(node, _tag))
-            if attributes['show_only']:
-                or_conditions.append(lambda node, _tag=tag: self.has_tag(node, _tag))
-        return lambda node: condition_lambda(node, and_conditions, or_conditions)
+        tags = self.tags
+        key = (self.tag_index.version, id(self.tree_node_dict),
+               tuple((tag, attributes['scope'], attributes['hide'], attributes['show_only'])
+                     for tag, attributes in tags.items()))
+        if self._visible_condition is not None and self._visible_condition[0] == key:
+            return self._visible_condition[1]
+        hidden = [tag for tag, attributes in tags.items() if attributes['hide']]
+        show_only = [tag for tag, attributes in tags.items() if attributes['show_only']]
+        hidden_closures = [self.tag_closure(tag) for tag in hidden]
+        show_only_closures = [self.tag_closure(tag) for tag in show_only]
+        node_dict = self.tree_node_dict or {}
+
+        def condition(node):
+            if node_dict.get(node['id']) is not node:
+                return not any(self.has_tag(node, tag) for tag in hidden) \
+                       and (not show_only or any(self.has_tag(node, tag) for tag in show_only))
+            return not any(node['id'] in closure for closure in hidden_closures) \
+                   and (not show_only or any(node['id'] in closure for closure in show_only_closures))
+        self._visible_condition = (key, condition)
+        return condition
 
 
 
@@ -877,7 +1286,7 @@ class TreeModel:
         if expand:
             new_child["open"] = True
 
-        self.rebuild_tree()
+        self.index_subtree(new_child, parent)
         return new_child
 
         # if refresh_nav:
@@ -911,8 +1320,14 @@ class TreeModel:
 
         node["parent_id"] = new_parent["id"]
         new_parent["open"] = True
+        self.ancestry_changed(node)
 
-        self.rebuild_tree()
+        if "parent_id" not in new_parent:
+            # new root may need an immutable root above it
+            self.rebuild_tree()
+        else:
+            self.tree_node_dict[new_parent["id"]] = new_parent
+            self.index_order_changed()
         return new_parent
 
     def merge_with_parent(self, node):
@@ -924,14 +1339,16 @@ class TreeModel:
         assert self.is_mutable(parent)
 
         parent["text"] += node["text"]
+        self.ancestry_changed(parent)
 
         index_in_parent = parent["children"].index(node)
         parent["children"][index_in_parent:index_in_parent + 1] = node["children"]
         for i, c in enumerate(node["children"]):
             # parent["children"].insert(index_in_parent+i, c)
             c["parent_id"] = parent["id"]
-        
-        self.rebuild_tree()
+
+        self.tree_node_dict.pop(node["id"], None)
+        self.index_order_changed()
 
         # if node == self.selected_node:
         #     self.select_node(parent["id"])
@@ -972,8 +1389,8 @@ class TreeModel:
         old_siblings.remove(node)
         node["parent_id"] = new_parent_id
         new_parent["children"].append(node)
-        # TODO does this cause bugs
-        self.rebuild_tree()
+        self.ancestry_changed(node)
+        self.index_order_changed()
 
     # adds node to ghostchildren of new ghostparent
     def add_parent(self, node=None, new_ghostparent=None):
@@ -989,7 +1406,7 @@ class TreeModel:
         old_index = siblings.index(node)
         new_index = (old_index + interval) % len(siblings)
         siblings[old_index], siblings[new_index] = siblings[new_index], siblings[old_index]
-        self.rebuild_tree()
+        self.index_order_changed()
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(self.parent(node))])
         # else:
@@ -1006,9 +1423,14 @@ class TreeModel:
         #next_sibling = self.next_sibling(node)
         siblings.remove(node)
         if reassign_children:
+            self.ancestry_changed(node)
             siblings.extend(node["children"])
-
-        self.rebuild_tree()
+            for child in node["children"]:
+                child["parent_id"] = parent["id"]
+            self.tree_node_dict.pop(node["id"], None)
+            self.index_order_changed()
+        else:
+            self.unindex_subtree(node)
 
 
 
@@ -1032,6 +1454,7 @@ class TreeModel:
             # for child in node["children"]:
             #     child["text"] = " " * num_spaces + child["text"]
             node["text"] = text
+            self.text_changed(node)
 
             if 'meta' not in node:
                 node['meta'] = {}
@@ -1050,11 +1473,9 @@ class TreeModel:
                     'text': old_text,
                 })
                 
+            fix_miro_tree([node], node_dict=self.tree_node_dict)
             if refresh_nav:
                 self.tree_updated(edit=[node['id']])
-            else:
-                self.rebuild_tree()
-                #pass
 
 
     def update_note(self, node, text, index=0):
@@ -1083,6 +1504,7 @@ class TreeModel:
 
         new_parent["text"] = parent_text
         node["text"] = child_text
+        self.ancestry_changed(new_parent)
 
         new_parent["meta"] = {}
         new_parent['meta']['origin'] = f'split (from child {node["id"]})'
@@ -1097,7 +1519,8 @@ class TreeModel:
 
         # both nodes inherit tags
         if 'tags' in node:
-            new_parent['tags'] = node['tags']
+            new_parent['tags'] = list(node['tags'])
+            self.tag_index.node_changed(new_parent)
 
         new_parent['visited'] = True
 
@@ -1105,7 +1528,6 @@ class TreeModel:
         if 'chapter_id' in node:
             new_parent['chapter_id'] = node['chapter_id']
             node.pop('chapter_id')
-        self.rebuild_tree()
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(new_parent)])
         # else:
@@ -1113,12 +1535,14 @@ class TreeModel:
         return new_parent, node
 
     def sever_from_parent(self, node):
+        self.ancestry_changed(node)
         parent = self.parent(node)
         parent['children'].remove(node)
         node['parent_id'] = None
         return parent
 
     def sever_children(self, node):
+        self.ancestry_changed(node)
         children = node['children'].copy()
         for child in children:
             child['parent_id'] = None
@@ -1127,6 +1551,7 @@ class TreeModel:
         return children
 
     def adopt_parent(self, node, parent):
+        self.ancestry_changed(node)
         node['parent_id'] = parent['id']
         parent['children'].append(node)
 
@@ -1137,13 +1562,20 @@ class TreeModel:
     def zip(self, head, tail, refresh_nav=True, update_selection=True):
         text = self.ancestry_text(node=tail, root=head) #ancestry_plaintext(ancestry_in_range(root=head, node=tail))
         mask = new_node(text=text, mutable=False)
-        if self.has_parent(head):
+        has_parent = self.has_parent(head)
+        if has_parent:
             parent = self.sever_from_parent(head)
             self.adopt_parent(mask, parent)
         children = self.sever_children(tail)
         self.adopt_children(mask, children)
         mask['masked_head'] = head
         mask['tail_id'] = tail['id']
+        if has_parent:
+            # masked nodes leave the index, the mask's children were already indexed
+            self.unindex_subtree(head)
+            self.tree_node_dict[mask['id']] = mask
+        else:
+            self.rebuild_tree()
         # TODO hacky
         nav_preview_text = head['text'].strip()[:15].replace('\n', '\\n') \
                                    + '...' + tail['text'].strip()[:12].replace('\n', '\\n')
@@ -1152,8 +1584,6 @@ class TreeModel:
 
         if refresh_nav:
             self.tree_updated(delete=[head['id']], add=[n['id'] for n in subtree_list(mask)], write=False)
-        else:
-            self.rebuild_tree()
         if update_selection:
             self.select_node(mask['id'], write=False)
             self.selection_updated(write=False)
@@ -1168,16 +1598,20 @@ class TreeModel:
         head = mask['masked_head']
         head_dict = {d["id"]: d for d in flatten_tree(head)}
         tail = head_dict[mask['tail_id']]
-        if self.has_parent(mask):
+        has_parent = self.has_parent(mask)
+        if has_parent:
             parent = self.sever_from_parent(mask)
             self.adopt_parent(head, parent)
         children = self.sever_children(mask)
         self.adopt_children(tail, children)
+        if has_parent:
+            self.tree_node_dict.pop(mask['id'], None)
+            self.index_subtree(head)
+        else:
+            self.rebuild_tree()
 
         if refresh_nav:
             self.tree_updated(delete=[mask['id']], add=[n['id'] for n in subtree_list(head, filter)], write=False)
-        else:
-            self.rebuild_tree()
         if update_selection:
             self.select_node(head['id'])
             self.selection_updated()
@@ -1195,6 +1629,7 @@ class TreeModel:
         if not (head == node and tail == node):
             zipped = self.zip(head=head, tail=tail, refresh_nav=refresh_nav, update_selection=update_selection)
             zipped['tags'] = self.get_constituents_attribute(zipped, "tags")
+            self.tag_index.node_changed(zipped)
             zipped['memories'] = self.get_constituents_attribute(zipped, "memories")
             return zipped
         else:
@@ -1275,6 +1710,7 @@ class TreeModel:
 
     def set_template(self, node, value):
         node['template'] = value
+        self.text_changed(node)
         self.tree_updated()
 
     def display_to_raw_index(self, node, index):
@@ -1439,6 +1875,12 @@ class TreeModel:
 
     # returns first node that is fully contained in the context window
     def context_window_index(self, node):
+        prompt_length = self.generation_settings['prompt_length']
+        entry = self.ancestry_index.entry(node)
+        if entry is not None:
+            if entry.end < prompt_length:
+                return 0
+            return self.ancestry_index.window_start(node, prompt_length) + 1
         indices = self.ancestor_text_indices(node)
         end_indices = [ind[1] for ind in indices]
         first_in_context_index = end_indices[-1] - self.generation_settings['prompt_length']
@@ -1468,9 +1910,11 @@ class TreeModel:
                            'show_only': show_only,
                            'toggle_key': toggle_key,
                            'icon': icon}
+        self.tag_index.tag_changed(name)
 
     def delete_tag(self, name):
         del self.tags[name]
+        self.tag_index.tag_changed(name)
         # TODO delete tag from all nodes
 
     def tag_node(self, node, tag):
@@ -1481,10 +1925,12 @@ class TreeModel:
             node['tags'] = []
         if tag not in node['tags']:
             node['tags'].append(tag)
+            self.tag_index.add(node, tag)
 
     def untag_node(self, node, tag):
         if 'tags' in node and tag in node['tags']:
             node['tags'].remove(tag)
+            self.tag_index.remove(node, tag)
 
     def toggle_tag(self, node, tag):
         if self.has_tag_attribute(node, tag):
@@ -1492,46 +1938,29 @@ class TreeModel:
         else:
             self.tag_node(node, tag)
 
+    # ids of the nodes which have tag, including the nodes it applies to by its scope. Don't modify.
+    def tag_closure(self, tag):
+        return self.tag_index.closure(tag, self.tags[tag]['scope'])
+
+    # for tags with "node" scope, all nodes with that tag, for "subtree" scope also their descendants and for
+    # "ancestry" scope also their ancestors, in tree order
     def tagged_nodes(self, tag, filter=None):
         if tag not in self.tags:
             print('no such tag')
             return
-        # for tags with "node" scope, return all nodes with that tag
-        nodes = self.nodes_list(filter)
-        tagged_nodes = [d for d in nodes if self.has_tag_attribute(d, tag)]
-        if self.tags[tag]['scope'] == 'node':
-            return tagged_nodes
-
-        # for tags with "subtree" scope, return all nodes with that tag and their subtrees
-        elif self.tags[tag]['scope'] == 'subtree':
-            tag_subtrees = []
-            for node in tagged_nodes:
-                # add all nodes in subtree of node to tag_subtrees
-                tag_subtrees.extend(subtree_list(node))
-            # remove duplicates
-            tag_subtrees = list(set(tag_subtrees))
-            return tag_subtrees
-
-        # for tags with "ancestry" scope, return all nodes with that tag and their ancestors
-        elif self.tags[tag]['scope'] == 'ancestry':
-            tag_ancestors = []
-            for node in tagged_nodes:
-                # add all ancestors of node to tag_ancestors
-                ancestors = self.ancestry(node)
-                tag_ancestors.extend(ancestors)
-            # remove duplicates
-            tag_ancestors = list(set(tag_ancestors))
-            return tag_ancestors
-        else:
+        if self.tags[tag]['scope'] not in ('node', 'subtree', 'ancestry'):
             print('invalid scope')
             return
+        closure = self.tag_closure(tag)
+        return [d for d in self.nodes_list(filter) if d['id'] in closure]
 
     def tagged_indices(self, tag, filter=None):
         if tag not in self.tags:
             print('no such tag')
             return
         nodes = self.nodes_list(filter)
-        return {idx: d for idx, d in enumerate(nodes) if self.has_tag(d, tag)}
+        closure = self.tag_closure(tag)
+        return {idx: d for idx, d in enumerate(nodes) if d['id'] in closure}
 
     def has_tag_attribute(self, node, tag):
         return 'tags' in node and node['tags'] is not None and tag in node['tags']
@@ -1540,23 +1969,26 @@ class TreeModel:
         #print(node)
         if tag not in self.tags:
             return False
-        if self.tags[tag]['scope'] == 'node':
+        scope = self.tags[tag]['scope']
+        if scope == 'node':
             return self.has_tag_attribute(node, tag)
-        elif self.tags[tag]['scope'] == 'subtree':
-            # check if one of ancestors has tag
+        elif scope not in ('subtree', 'ancestry'):
+            print('invalid scope')
+            return
+        elif self.tree_node_dict and self.tree_node_dict.get(node['id']) is node:
+            return node['id'] in self.tag_closure(tag)
+        elif scope == 'subtree':
+            # node isn't in the tree: check if one of ancestors has tag
             for ancestor in self.ancestry(node):
                 if self.has_tag_attribute(ancestor, tag):
                     return True
             return False
-        elif self.tags[tag]['scope'] == 'ancestry':
+        else:
             # check if one of descendents has tag
             for descendant in subtree_list(node):
                 if self.has_tag_attribute(descendant, tag):
                     return True
             return False
-        else:
-            print('invalid scope')
-            return
 
 
     # temporary function to turn root-level attributes into a tag in all nodes
@@ -1653,7 +2085,9 @@ class TreeModel:
 
         if 'model_responses' not in self.tree_raw_data:
             self.tree_raw_data['model_responses'] = {}
-        self.model_responses = self.tree_raw_data['model_responses']
+        # responses still stored in the tree (saved before the sidecar) are readable and move out on the next save
+        self.model_responses.reset(response_store_filename(self.tree_filename) if self.tree_filename else None,
+                                   self.tree_raw_data['model_responses'])
 
         # if 'tags' not in self.tree_raw_data:
         #     self.tree_raw_data['tags'] = DEFAULT_TAGS
@@ -1671,6 +2105,7 @@ class TreeModel:
         }
 
         self.tree_raw_data["frame"] = self.tree_raw_data.get("frame", {})
+        self.user_frame_changed()
 
         # View settings # TODO If there are more of these, reduce duplication
         self.tree_raw_data["visualization_settings"] = {
@@ -1752,14 +2187,14 @@ class TreeModel:
             fix_tree(self.tree_raw_data)
         else:
             self.tree_raw_data = data
-        self.tree_node_dict = {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
-
-        # If things don't have an open state, give one to them
-        for node in self.tree_node_dict.values():
-            node["open"] = node.get("open", False)
 
         if init_global:
             self._init_global_objects()
+        # indexes the tree in one pass
+        self.rebuild_tree()
+        # Miro HTML etc., once per tree
+        if normalize_tree(self.tree_raw_data, self._node_order, self.tree_node_dict):
+            self.ancestry_index.clear()
         self.tree_updated(rebuild=True, write=False)
 
         self.select_node(self.tree_raw_data.get("selected_node_id", self.root()['children'][0]['id']))
@@ -1768,7 +2203,7 @@ class TreeModel:
     # Open a new tree json
     def open_tree(self, filename):
         self.tree_filename = os.path.abspath(filename)
-        self.load_tree_data(json_open(self.tree_filename))
+        self.load_tree_data(load_tree_file(self.tree_filename))
         self.io_update()
 
     def open_empty_tree(self):
@@ -1781,12 +2216,14 @@ class TreeModel:
     # because of duplicate IDs
     # TODO does metadata of subtree overwrite parent tree?
     def import_tree(self, filename):
-        tree_json = json_open(filename)
+        tree_json = load_tree_file(filename)
         if 'root' in tree_json:
             new_subtree_root = tree_json['root']
             if not new_subtree_root['mutable']:
                 new_subtree_root['mutable'] = True
             self.add_subtree(self.selected_node, new_subtree_root)
+            if tree_json.get('normalized') != NORMALIZED_VERSION:
+                self.normalize_subtree(new_subtree_root)
             # self.selected_node['children'].append(new_subtree_root)
             # new_subtree_root['parent_id'] = self.selected_node_id
             if 'chapters' in tree_json:
@@ -1800,6 +2237,7 @@ class TreeModel:
         else:
             if 'id' in tree_json:
                 self.add_subtree(self.selected_node, tree_json)
+                self.normalize_subtree(tree_json)
                 self.load_tree_data(self.tree_raw_data)
                 self.tree_updated()
                 self.io_update()
@@ -1810,6 +2248,11 @@ class TreeModel:
         node['children'].append(subtree_root)
         subtree_root['parent_id'] = node['id']
 
+    # Normalizes nodes imported under an existing node
+    def normalize_subtree(self, root):
+        subtree = flatten_tree(root)
+        normalize_nodes(subtree, ChainMap({d["id"]: d for d in subtree}, self.tree_node_dict))
+
     # open new tree with node as root
     def open_node_as_root(self, node=None, new_filename=None, save=True, rebuild_global=False):
         if save:
@@ -1834,6 +2277,7 @@ class TreeModel:
         self.tree_raw_data['root'] = new_root
         new_root['open'] = True
         new_root['hoisted'] = True
+        self.rebuild_tree()
         self.tree_updated(rebuild=True, write=False)
         self.select_node(new_root['id'])
 
@@ -1847,10 +2291,9 @@ class TreeModel:
         self.tree_raw_data['root'] = new_root
         if self.selected_node_id == old_root['id']:
             self.selected_node_id = new_root['id']
+        self.rebuild_tree()
         if rebuild:
             self.tree_updated(rebuild=True, write=False)
-        else:
-            self.rebuild_tree()
         if update_selection:
             self.selection_updated()
         return new_root
@@ -1869,7 +2312,9 @@ class TreeModel:
 
     # Tree flat data is just a different view to tree raw data!
     # We edit tree flat data with tkinter and save raw data which is still in json form
-    def save_tree(self, backup=True, save_filename=None, subtree=None):
+    # The tree is copied here and written by self.saver on its own thread. With background=False this waits for the
+    # write. journal=True appends only what changed to the tree's journal (see util/tree_save.py).
+    def save_tree(self, backup=True, save_filename=None, subtree=None, background=False, journal=False):
         save_filename = save_filename if save_filename else self.tree_filename
         subtree = subtree if subtree else self.tree_raw_data
         if not save_filename:
@@ -1881,15 +2326,27 @@ class TreeModel:
         save_dir = os.path.dirname(self.tree_filename)
         backup_dir = os.path.join(save_dir, "backups")
 
-        # Make backup before overwriting tree
+        # Keep the file being overwritten as a backup
+        backup_filename = None
         if backup and os.path.isfile(save_filename):
             if not os.path.exists(backup_dir):
                 os.mkdir(backup_dir)
-            os.rename(save_filename, os.path.join(backup_dir, f"{filename}-{timestamp()}.json"))
-
-        # print('chapters:', subtree['chapters'])
-        # Save tree
-        json_create(save_filename, subtree)
+            backup_filename = os.path.join(backup_dir, f"{filename}-{timestamp()}.json")
+
+        if subtree is self.tree_raw_data and save_filename == self.tree_filename:
+            # the tree file and its responses sidecar are saved together
+            self.model_responses.attach(response_store_filename(save_filename))
+            self.model_responses.migrate_inline()
+        journal = journal and subtree is self.tree_raw_data and save_filename == self.tree_filename
+        snapshot = tree_snapshot(subtree)
+        if background:
+            self.saver.save(save_filename, snapshot, backup_filename=backup_filename, journal=journal,
+                            on_done=lambda: self.post_to_main_thread(self.io_update))
+            return True
+        self.saver.save(save_filename, snapshot, backup_filename=backup_filename, journal=journal)
+        self.saver.flush()
+        if save_filename in self.saver.errors:
+            return False
         self.io_update()
         return True
 
@@ -1986,6 +2443,7 @@ class TreeModel:
     def set_generated_nodes(self, nodes, results):
         for i, node in enumerate(nodes):
             node['text'] = self.default_post_template(results['completions'][i])
+            self.text_changed(node)
             # node['text'] = self.default_post_template(results['completions'][i]) \
             #     if self.generation_settings['post_template'] == "Default" \
             #     else self.custom_post_template(results['completions'][i], self.generation_settings['post_template'])
@@ -1996,9 +2454,13 @@ class TreeModel:
 
     def delete_failed_nodes(self, nodes, error):
         print(f"ERROR {error}. Deleting failures")
+        failed_ids = [node['id'] for node in nodes]
+        if failed_ids in self.new_nodes:
+            self.new_nodes.remove(failed_ids)
         for node in nodes:
             parent = self.parent(node)
             parent["children"].remove(node)
+            self.unindex_subtree(node)
         self.tree_updated(delete=[node['id'] for node in nodes])
 
     def default_generate(self, prompt, nodes):
@@ -2160,79 +2622,154 @@ class TreeModel:
         if not node:
             return
 
-        children = []
-        #grandchildren = []
-        new_nodes = []
-        # pprint(self.generation_settings)
-        for i in range(self.generation_settings['num_continuations']):
-            child = self.create_child(node, expand=True)
-            children.append(child)
-            new_nodes.append(child['id'])
-            # if self.generation_settings['adaptive']:
-            #     grandchild = self.create_child(child, update_selection=False, expand=True, refresh_nav=False)
-            #     grandchildren.append(grandchild)
-            #     new_nodes.append(grandchild['id'])
-
-        self.new_nodes.append(new_nodes)
-        self.tree_updated(add=new_nodes)
-        #self.reveal_nodes(children + grandchildren)
         prompt = self.prompt(node=node)
+        children = self.create_placeholder_children(node, self.generation_settings['num_continuations'],
+                                                    placeholder=kwargs.get('placeholder', "\n\n** Generating **"))
+        #self.reveal_nodes(children + grandchildren)
 
-        threading.Thread(target=self.default_generate, args=(prompt, children)).start()
+        # submit_gen calls back from a generation worker thread
+        callback = lambda results, error: self.post_to_main_thread(
+            lambda: self.post_generation(error, children, results))
+        stream = None
+        job = None
+        if self.generation_settings.get('stream'):
+            stream = self.stream_into_nodes(children, on_first_text=lambda: job and job.output_started())
+            callback = lambda results, error: self.post_to_main_thread(
+                lambda: self.finish_stream(stream, children, results, error))
+        job = submit_gen(prompt, self.generation_settings, self.model_config,
+                         callback=callback,
+                         on_text=stream.on_text if stream else None,
+                         OPENAI_API_KEY=self.OPENAI_API_KEY,
+                         AI21_API_KEY=self.AI21_API_KEY,
+                         GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,
+                         TOGETHERAI_API_KEY=self.TOGETHERAI_API_KEY)
 
-        # After asking for the generation, set loading text
-        for child in children:
-            child["text"] = "\n\n** Generating **" if 'placeholder' not in kwargs else kwargs['placeholder']
-            child['mutable'] = False
-        # for grandchild in grandchildren:
-        #     grandchild["text"] = "\n\n** Generating **"
-        self.tree_updated(edit=new_nodes)
         if update_selection:
             self.select_node(children[0]["id"])
 
+    # Returns a GenerationStream which writes the streamed text of continuation i into nodes[i], in batches on the
+    # Tk thread, until finish_stream is called with the whole response
+    def stream_into_nodes(self, nodes, on_first_text=None):
+        start_text = codecs.decode(self.generation_settings['start'], "unicode-escape")
+
+        def apply(updates):
+            edited = []
+            for index, text in updates.items():
+                node = nodes[index]
+                if node['id'] in self.tree_node_dict:
+                    node['text'] = start_text + text
+                    edited.append(node['id'])
+            if edited:
+                self.tree_updated(edit=edited)
+
+        return GenerationStream(apply, self.post_to_main_thread,
+                                lambda seconds, func: self.app.after(int(seconds * 1000) + 1, func), on_first_text)
+
+    def finish_stream(self, stream, nodes, results, error):
+        stream.close()
+        if stream.time_to_first_text is not None:
+            print(f'time to first token: {stream.time_to_first_text:.2f}s ({stream.flushes} updates)')
+        self.post_generation(error, nodes, results)
+
+    # Creates immutable children showing placeholder text until post_generation fills them in
+    def create_placeholder_children(self, node, num_children, placeholder="\n\n** Generating **"):
+        children = []
+        for i in range(num_children):
+            child = self.create_child(node, expand=True)
+            child["text"] = placeholder
+            child['mutable'] = False
+            children.append(child)
+        new_nodes = [child['id'] for child in children]
+        self.new_nodes.append(new_nodes)
+        self.tree_updated(add=new_nodes)
+        return children
+
     def generate_tree_init(self, node=None, max_depth=2, branching_factor=2, interval=50, stop_condition=None,
-                           temperature=1, engine='ada'):
+                           temperature=1, engine=None):
         node = node if node else self.selected_node
-        self.generate_tree(node, max_depth, branching_factor, interval, stop_condition, temperature, engine)
-        new_nodes = []
-        # while len(self.new_nodes) > 0:
-        #     print(self.new_nodes)
-        #     self.tree_updated(add=self.new_nodes[0])
-        #     #new_nodes += self.new_nodes[0]
-        #     del self.new_nodes[0]
-        # #self.tree_updated(add=new_nodes)
+        return self.generate_tree(node, max_depth, branching_factor, interval, stop_condition, temperature, engine)
 
+    # Expands the tree below node breadth first in a background thread. Each level's nodes are generated
+    # concurrently on up to max_workers threads, subject to the model's 'requests_per_second' in the model config.
+    # Children go through the same placeholder -> post_generation -> <<NewNodes>> path as generate_continuations.
+    # on_level(level, new_nodes, stats) is called after each level. Returns the TreeExpansion, which can be cancelled
+    # or waited on with expansion.done.wait() (not from the Tk thread, which has to apply the results).
     def generate_tree(self, node=None, max_depth=3, branching_factor=2, interval=50, stop_condition=None,
-                      temperature=1, engine='ada'):
+                      temperature=1, engine=None, max_workers=4, on_level=None):
         node = node if node else self.selected_node
-        print('generating children for node', node['id'])
-        if max_depth == 0 or (stop_condition and stop_condition(node)):
-            return
-        prompt = self.default_prompt(quiet=False, node=node)
-        results, error = openAI_generate(prompt=prompt,
-                                         length=interval,
-                                         num_continuations=branching_factor,
-                                         temperature=temperature,
-                                         logprobs=0,
-                                         top_p=self.generation_settings['top_p'],
-                                         engine=engine
-                                         )
-        # create child nodes
-        children = []
-        for i in range(branching_factor):
-            child = self.create_child(node, update_selection=False, expand=True, refresh_nav=False)
-            children.append(child)
-        # set child nodes
-        self.generated_nodes_metadata(children, results, prompt)
-        self.tree_updated(add=[child['id'] for child in children])
-        # for each child node, branch again
-        for child in children:
-            # self.new_nodes.append(child['id'])
-            self.generate_tree(node=child, max_depth=max_depth - 1, branching_factor=branching_factor,
-                               interval=interval,
-                               stop_condition=stop_condition, temperature=temperature, engine=engine)
+        settings = deepcopy(self.generation_settings)
+        settings['num_continuations'] = branching_factor
+        settings['response_length'] = interval
+        settings['temperature'] = temperature
+        if engine:
+            settings['model'] = engine
+        model_config = self.model_config
+        model_info = model_config['models'][settings['model']]
+
+        # {node id: prompt} of the frontier, built on the Tk thread with the placeholders since it reads the tree
+        prompts = {}
+
+        def prepare(frontier):
+            def create_children():
+                for n in frontier:
+                    prompts[n['id']] = self.default_prompt(node=n)
+                return [self.create_placeholder_children(n, branching_factor) for n in frontier]
+            return self.run_on_main_thread(create_children)
+
+        # queued behind interactive requests to the same endpoint
+        def request(n):
+            job = submit_gen(prompts.pop(n['id']), settings, model_config, priority=BATCH,
+                             OPENAI_API_KEY=self.OPENAI_API_KEY,
+                             AI21_API_KEY=self.AI21_API_KEY,
+                             GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,
+                             TOGETHERAI_API_KEY=self.TOGETHERAI_API_KEY)
+            while not job.wait(0.1):
+                if expansion.cancelled:
+                    job.cancel()
+            if job.cancelled:
+                raise ExpansionCancelled()
+            if job.error:
+                raise RuntimeError(job.error)
+            return job.result
+
+        def apply(n, children, result):
+            if isinstance(result, Exception):
+                error = 'cancelled' if isinstance(result, ExpansionCancelled) else str(result)
+                self.run_on_main_thread(lambda: self.post_generation(error, children, None))
+                return []
+            self.run_on_main_thread(lambda: self.post_generation(None, children, result))
+            return children
+
+        def level_done(level, new_nodes, stats):
+            print(f'tree generation: level {level + 1}/{max_depth} done, {len(new_nodes)} new nodes')
+            if on_level:
+                on_level(level, new_nodes, stats)
+
+        expansion = TreeExpansion(request=request, apply=apply, prepare=prepare, max_depth=max_depth,
+                                  stop_condition=stop_condition, max_workers=max_workers,
+                                  rate_limiter=backend_rate_limiter(model_info.get('api_base') or model_info['type'],
+                                                                    model_info.get('requests_per_second')),
+                                  on_level=level_done)
+
+        def run():
+            self.active_expansions.append(expansion)
+            try:
+                stats = expansion.run(node)
+                print('tree generation:', expansion_report(stats))
+            finally:
+                self.active_expansions.remove(expansion)
+
+        threading.Thread(target=run, daemon=True).start()
+        return expansion
 
-        # TODO multi threading
+    def cancel_tree_generation(self):
+        for expansion in self.active_expansions:
+            expansion.cancel()
+
+    # Cancels tree generation and all queued and running generation requests
+    def cancel_generation(self):
+        self.cancel_tree_generation()
+        generation_executor().cancel_all()
 
     def generate_adaptive_tree(self, node=None, max_depth=3, branching_factor=2, max_interval=100, algorithm='min',
                                min_interval=None, stop_condition=None):
@@ -2448,7 +2985,7 @@ class TreeModel:
         return selection_optimization_power, selection_bits, tokens
 
     def generate_greedy_multiverse(self, prompt=None, node=None, ground_truth=None, max_depth=3,
-                                   unnormalized_amplitude=1, threshold=0.1, engine='ada'):
+                                   unnormalized_amplitude=1, threshold=0.1, engine='ada', max_in_flight=8):
         print('propagating wavefunction')
         print('max depth:', max_depth)
         print('threshold:', threshold)
@@ -2463,7 +3000,8 @@ class TreeModel:
                                                           unnormalized_threshold=threshold,
                                                           engine=engine,
                                                           model_type=model_info['type'],
-                                                          api_base=model_info['api_base']
+                                                          api_base=model_info['api_base'],
+                                                          max_in_flight=max_in_flight
         )
         return multiverse, ground_truth, prompt
 
@@ -2525,8 +3063,11 @@ class TreeModel:
         backup_dir = os.path.join(save_dir, "backups")
         if not os.path.exists(backup_dir):
             os.mkdir(backup_dir)
-        json_create(os.path.join(backup_dir, f"model_responses-{timestamp()}.json"), self.tree_raw_data['model_responses'])
-        self.tree_raw_data['model_responses'] = {}
+        self.model_responses.backup(os.path.join(backup_dir, f"model_responses-{timestamp()}.sqlite"))
+        self.model_responses.clear()
+
+    def discard_model_responses(self):
+        self.model_responses.clear()
 
     
         
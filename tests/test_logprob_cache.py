@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+from util import gpt_util, logprob_cache
+
+
+def fake_completion(calls):
+    def create(engine, prompt, **kwargs):
+        calls.append(gpt_util.openai.base_url)
+        logprobs = {'tokens': [prompt], 'token_logprobs': [-float(len(calls))], 'text_offset': [0],
+                    'top_logprobs': None}
+        return SimpleNamespace(choices=[{'logprobs': logprobs}])
+    return SimpleNamespace(create=create)
+
+
+# The same engine name at another OpenAI-compatible endpoint is another model
+def test_echo_logprobs_are_cached_per_endpoint(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(gpt_util.openai, 'Completion', fake_completion(calls), raising=False)
+    monkeypatch.setattr(gpt_util.openai, 'base_url', None)
+    monkeypatch.setattr(logprob_cache, '_logprob_cache', logprob_cache.LogprobCache(str(tmp_path / 'logprobs.sqlite')))
+
+    first = gpt_util.echo_logprobs('Once upon a time', engine='local')
+    assert gpt_util.echo_logprobs('Once upon a time', engine='local') == first
+    monkeypatch.setattr(gpt_util.openai, 'base_url', 'http://localhost:8000/v1/')
+    second = gpt_util.echo_logprobs('Once upon a time', engine='local')
+    assert second != first
+    assert calls == [None, 'http://localhost:8000/v1/']
@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+
+from benchmarks.local_generation import stub_server
+from benchmarks.synthetic import synthetic_tree
+from model import TreeModel
+
+PLACEHOLDER = "\n\n** Generating **"
+
+
+# Stands in for the Tk root like Tk does for bindings: bind replaces the sequence's handlers unless add="+", and
+# generated events are queued until the main loop (run_events) handles them on the main thread.
+class FakeRoot:
+    def __init__(self):
+        self.handlers = {}
+        self.events = queue.Queue()
+
+    def bind(self, sequence, func, add=None):
+        self.handlers[sequence] = self.handlers.get(sequence, []) + [func] if add == "+" else [func]
+
+    def event_generate(self, sequence, **kwargs):
+        self.events.put(sequence)
+
+    def after(self, ms, func, *args):
+        threading.Timer(ms / 1000, func, args).start()
+
+    # runs queued events until done() or timeout seconds have passed
+    def run_events(self, done, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            try:
+                sequence = self.events.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            if sequence != "<<NewNodes>>":
+                for handler in self.handlers.get(sequence, []):
+                    handler(None)
+
+
+def tab(root):
+    model = TreeModel(root)
+    model.load_tree_data(synthetic_tree(10))
+    return model
+
+
+def test_calls_posted_from_worker_threads_run_in_every_tab():
+    root = FakeRoot()
+    tabs = [tab(root), tab(root)]
+    ran = []
+
+    def post(i, model):
+        model.post_to_main_thread(lambda: ran.append((i, threading.current_thread() is threading.main_thread())))
+    workers = [threading.Thread(target=post, args=(i, model)) for i, model in enumerate(tabs)]
+    for worker in workers:
+        worker.start()
+    root.run_events(lambda: len(ran) == 2)
+    assert sorted(ran) == [(0, True), (1, True)]
+
+
+def test_run_on_main_thread_in_older_tab():
+    root = FakeRoot()
+    first, second = tab(root), tab(root)
+    results = []
+    worker = threading.Thread(target=lambda: results.append(first.run_on_main_thread(
+        lambda: threading.current_thread() is threading.main_thread())))
+    worker.start()
+    root.run_events(lambda: results)
+    worker.join(1)
+    assert results == [True]
+
+
+def test_run_on_main_thread_returns_when_tab_closes():
+    root = FakeRoot()
+    model = tab(root)
+    errors = []
+
+    def call():
+        try:
+            model.run_on_main_thread(lambda: None)
+        except RuntimeError as e:
+            errors.append(e)
+    worker = threading.Thread(target=call)
+    worker.start()
+    # the tab is closed before the main loop gets to the call
+    model.close()
+    worker.join(5)
+    assert not worker.is_alive() and errors
+    ran = []
+    model.post_to_main_thread(lambda: ran.append(True))
+    root.run_events(lambda: root.events.empty())
+    assert not ran
+
+
+# Generation results are posted from executor worker threads, and must be applied in every tab
+def test_generation_results_reach_every_tab():
+    server = stub_server(0.01)
+    root = FakeRoot()
+    tabs = [tab(root), tab(root)]
+    parents = [model.nodes[-1] for model in tabs]
+    for model, parent in zip(tabs, parents):
+        model.tree_raw_data['frame'] = {
+            'model_config': {'models': {'stub': {'model': 'stub', 'type': 'ollama',
+                                                 'api_base': f'http://127.0.0.1:{server.server_address[1]}'}}},
+            'generation_settings': {'model': 'stub', 'num_continuations': 2}}
+        model.frames_changed()
+        model.generate_continuations(parent, placeholder=PLACEHOLDER)
+    children = [child for parent in parents for child in parent['children']]
+    root.run_events(lambda: all(child['text'] != PLACEHOLDER for child in children))
+    server.shutdown()
+    assert len(children) == 4 and all(child['text'] != PLACEHOLDER for child in children)
+
+
+def test_background_saves_report_in_every_tab(tmp_path):
+    root = FakeRoot()
+    tabs = [tab(root), tab(root)]
+    saved = []
+    for i, model in enumerate(tabs):
+        model.tree_filename = str(tmp_path / f'tree{i}.json')
+        model.register_callback(model.io_update,
+                                lambda i=i: saved.append((i, threading.current_thread() is threading.main_thread())))
+        model.save_tree(backup=False, background=True)
+    root.run_events(lambda: len(saved) == 2)
+    assert sorted(saved) == [(0, True), (1, True)]
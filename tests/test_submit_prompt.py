@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+import view.tree_vis
+from benchmarks.synthetic import synthetic_model
+from controller import Controller
+
+
+# Controller.submit writes the submitted text into a new child after creating and selecting it, when its
+# ancestry text has already been memoized. The prompt for the auto response must include the submitted text.
+def test_submit_text_is_in_prompt():
+    model = synthetic_model(20, chain=True)
+    leaf = model.nodes[-1]
+    model.select_node(leaf['id'])
+    prompts = []
+
+    def create_child(toggle_edit=True):
+        child = model.create_child(model.selected_node)
+        model.tree_updated(add=[child['id']])
+        model.select_node(child['id'])
+        # refresh_textbox memoizes the new child's ancestry text on selection
+        model.ancestry_text(child)
+        return child
+
+    controller = SimpleNamespace(state=model, create_child=create_child,
+                                 generate=lambda **kwargs: prompts.append(model.default_prompt(model.selected_node)))
+    Controller.submit(controller, ' the submitted text', auto_response=True)
+
+    assert model.ancestry_text(model.selected_node).endswith(' the submitted text')
+    assert prompts[0].endswith(' the submitted text')
@@ -0,0 +1,33 @@
+from benchmarks.synthetic import synthetic_model
+
+
+# Text edits (update_text, textbox edits and streamed text reported with edit=[ids]) must not rebuild the cached
+# state or drop tag closures, which only depend on frames and structure
+def test_text_edits_keep_state_and_tag_closures():
+    model = synthetic_model(50, chain=True)
+    leaf = model.nodes[-1]
+    model.select_node(leaf['id'])
+    model.tag_node(model.nodes[10], 'canonical')
+    state, closure = model.cached_state(), model.tag_closure('canonical')
+
+    model.update_text(model.nodes[20], model.nodes[20]['text'] + ' edited')
+    model.nodes[30]['text'] += ' streamed'
+    model.tree_updated(edit=[model.nodes[30]['id']])
+
+    assert model.cached_state() is state and model.tag_closure('canonical') is closure
+    assert model.ancestry_text(leaf).count(' edited') == 1 and model.ancestry_text(leaf).count(' streamed') == 1
+
+
+def test_moving_a_node_drops_state_and_tag_closures():
+    model = synthetic_model(50, chain=True)
+    model.select_node(model.nodes[-1]['id'])
+    model.tag_node(model.nodes[30], 'canonical')
+    node = model.nodes[20]
+    assert node['id'] in model.tag_closure('canonical')
+    state, closure = model.cached_state(), model.tag_closure('canonical')
+
+    # node 20 is no longer an ancestor of the tagged node
+    model.change_parent(model.nodes[30], model.nodes[5]['id'])
+
+    assert model.cached_state() is not state and model.tag_closure('canonical') is not closure
+    assert node['id'] not in model.tag_closure('canonical')
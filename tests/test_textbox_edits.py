@@ -0,0 +1,140 @@
+import random
+from types import SimpleNamespace
+
+from util.custom_tks import TextAware
+from util.textbox_util import apply_textbox_edits, distribute_textbox_changes
+
+
+def story(*texts):
+    ancestry = [{'id': str(i), 'text': text} for i, text in enumerate(texts)]
+    offsets = []
+    start = 0
+    for text in texts:
+        offsets.append((start, start + len(text)))
+        start += len(text)
+    return ancestry, offsets
+
+
+def copy(ancestry):
+    return [dict(ancestor) for ancestor in ancestry]
+
+
+# Applies edits to text the way the textbox does
+def edited(text, edits):
+    for start, end, insert in edits:
+        text = text[:start] + insert + text[end:]
+    return text
+
+
+def texts(ancestry):
+    return [ancestor['text'] for ancestor in ancestry]
+
+
+def test_no_edits():
+    ancestry, offsets = story('Once', ' upon', ' a time')
+    assert apply_textbox_edits([], ancestry, offsets) == []
+
+
+def test_insert_at_node_boundary_goes_into_later_node():
+    ancestry, offsets = story('Once', ' upon', ' a time')
+    edits = [(4, 4, ',')]
+    diffed = copy(ancestry)
+    distribute_textbox_changes(edited('Once upon a time', edits), diffed)
+
+    changed = apply_textbox_edits(edits, ancestry, offsets)
+
+    assert texts(ancestry) == ['Once', ', upon', ' a time'] == texts(diffed)
+    assert changed == [ancestry[1]]
+
+
+def test_insert_at_end_goes_into_last_node():
+    ancestry, offsets = story('Once', ' upon')
+    apply_textbox_edits([(9, 9, ' a time')], ancestry, offsets)
+    assert texts(ancestry) == ['Once', ' upon a time']
+
+
+def test_delete_across_several_nodes():
+    ancestry, offsets = story('Once', ' upon', ' a', ' time', ' there')
+    # from "ce" in the first node to the space before "time" in the fourth
+    changed = apply_textbox_edits([(2, 12, '')], ancestry, offsets)
+
+    assert texts(ancestry) == ['On', '', '', 'time', ' there']
+    assert changed == ancestry[:4]
+
+
+def test_replace_across_nodes_puts_text_in_first_node():
+    ancestry, offsets = story('Once', ' upon', ' a time')
+    apply_textbox_edits([(2, 7, 'XX')], ancestry, offsets)
+    assert texts(ancestry) == ['OnXX', 'on', ' a time']
+
+
+def test_edits_in_sequence():
+    ancestry, offsets = story('Once', ' upon', ' a time')
+    text = 'Once upon a time'
+    # typing at the end, then deleting in the middle, then inserting before the deletion: each edit's range is in
+    # the text left by the ones before it
+    edits = [(16, 16, ' there'), (16, 16, ' lived'), (5, 10, ''), (0, 0, 'And ')]
+    changed = apply_textbox_edits(edits, ancestry, offsets)
+
+    assert ''.join(texts(ancestry)) == edited(text, edits) == 'And Once a time lived there'
+    assert texts(ancestry) == ['And Once', ' ', 'a time lived there']
+    assert changed == ancestry
+
+
+def test_text_changed_since_the_textbox_was_filled():
+    ancestry, offsets = story('Once', ' upon', ' a time')
+    ancestry[1]['text'] = ' upon upon'
+    assert apply_textbox_edits([(6, 6, '!')], ancestry, offsets) is None
+    assert texts(ancestry) == ['Once', ' upon upon', ' a time']
+
+
+# The recorded edits must give the text the textbox shows, and must only change the nodes the edits touched. (The
+# diff fallback, distribute_textbox_changes, doesn't always give that text for deletions spanning nodes.)
+def test_random_edits_match_textbox_text():
+    rng = random.Random(0)
+    for _ in range(500):
+        ancestry, offsets = story(*(''.join(rng.choice('abc ') for _ in range(rng.randint(0, 6)))
+                                    for _ in range(rng.randint(1, 6))))
+        text = ''.join(texts(ancestry))
+        edits = []
+        for _ in range(rng.randint(1, 5)):
+            # node boundaries are picked often
+            boundaries = [start for start, _ in offsets] + [len(text)]
+            start = rng.choice(boundaries) if rng.random() < 0.5 else rng.randint(0, len(text))
+            start = min(start, len(text))
+            end = min(len(text), start + (rng.randint(0, 8) if rng.random() < 0.6 else 0))
+            insert = rng.choice(['', 'x', 'xy ', '\n'])
+            if start == end and not insert:
+                insert = 'z'
+            edits.append((start, end, insert))
+            text = text[:start] + insert + text[end:]
+        original = copy(ancestry)
+        changed = apply_textbox_edits(edits, ancestry, offsets)
+
+        assert ''.join(texts(ancestry)) == text
+        assert [ancestor['id'] for ancestor in changed] == \
+               [new['id'] for old, new in zip(original, ancestry) if old['text'] != new['text']]
+        # nodes before the first edited position are untouched
+        first = min(start for start, _, _ in edits)
+        for (start, end), old, new in zip(offsets, original, ancestry):
+            if end < first:
+                assert old['text'] == new['text']
+
+
+# Stands in for the Tk text widget: indices are "1.<offset>" or "end-1c", in a single line of text
+def fake_textbox(text):
+    def char_offset(index):
+        return len(text) if index == "end-1c" else int(index.split('.')[1])
+    return SimpleNamespace(char_offset=char_offset)
+
+
+def test_edit_range():
+    textbox = fake_textbox('Once upon a time')
+    assert TextAware.edit_range(textbox, 'insert', ('1.4', ',', 'tag', ' then', ())) == (4, 4, ', then')
+    assert TextAware.edit_range(textbox, 'delete', ('1.2', '1.7')) == (2, 7, '')
+    # a single index deletes one character, past the end deletes nothing
+    assert TextAware.edit_range(textbox, 'delete', ('1.2',)) == (2, 3, '')
+    assert TextAware.edit_range(textbox, 'delete', ('1.30', '1.40')) == (16, 16, '')
+    assert TextAware.edit_range(textbox, 'replace', ('1.0', '1.4', 'Twice')) == (0, 4, 'Twice')
+    # deleting several ranges at once can't be tracked
+    assert TextAware.edit_range(textbox, 'delete', ('1.0', '1.1', '1.3', '1.4')) is None
@@ -0,0 +1,13 @@
+import json
+
+from util.tree_save import load_tree_file
+
+
+# json.dumps writes NaN and Infinity, which orjson rejects
+def test_load_tree_with_nan(tmp_path):
+    filename = tmp_path / 'tree.json'
+    filename.write_text(json.dumps({'root': {'id': 'root', 'text': '', 'children': [],
+                                             'meta': {'logprob': float('nan'), 'max': float('inf')}}}))
+    tree = load_tree_file(str(filename))
+    assert tree['root']['meta']['max'] == float('inf')
+    assert tree['root']['meta']['logprob'] != tree['root']['meta']['logprob']
@@ -0,0 +1,109 @@
+import os
+
+from util.tree_save import TreeSaver, journal_filename, tree_snapshot, write_tree, load_tree_file
+
+
+def tree():
+    return {'frame': {'generation_settings': {'model': 'a'}},
+            'chapters': {'c': {'title': 'one'}},
+            'root': {'id': 'root', 'text': '', 'children': [
+                {'id': 'a', 'text': ' a', 'children': [], 'meta': {'source': 'prompt'}, 'tags': ['bookmark']}]}}
+
+
+# Edits made on the UI thread after the snapshot, while the saver thread writes it, are not saved
+def test_snapshot_is_not_changed_by_later_edits(tmp_path):
+    data = tree()
+    snapshot = tree_snapshot(data)
+    node = data['root']['children'][0]
+    node['meta']['source'] = 'AI'
+    node['tags'].append('canonical')
+    data['frame']['generation_settings']['model'] = 'b'
+    data['chapters']['c']['title'] = 'two'
+    write_tree(str(tmp_path / 'tree.json'), snapshot)
+    assert load_tree_file(str(tmp_path / 'tree.json')) == tree()
+
+
+def story_tree(n=40):
+    nodes = [{'id': f'n{i}', 'text': f' node {i} ' + 'x' * 200, 'children': []} for i in range(n)]
+    for i, node in enumerate(nodes[1:], 1):
+        nodes[(i - 1) // 2]['children'].append(node)
+    return {'frame': {'generation_settings': {'model': 'a'}}, 'chapters': {},
+            'model_responses': {'r0': {'prompt': 'p', 'completions': [{'text': 't'}]}},
+            'root': nodes[0]}
+
+
+def find(node, node_id):
+    if node['id'] == node_id:
+        return node
+    for child in node['children']:
+        found = find(child, node_id)
+        if found:
+            return found
+
+
+def save(saver, filename, data, journal=True):
+    saver.save(filename, tree_snapshot(data), journal=journal)
+    saver.flush()
+
+
+# edits, each followed by a journal save
+def edits(data):
+    yield lambda: find(data['root'], 'n5')['children'].append({'id': 'new', 'text': ' added', 'children': []})
+    yield lambda: find(data['root'], 'n7').update(text=' edited', meta={'modified': True})
+    yield lambda: find(data['root'], 'n1')['children'].remove(find(data['root'], 'n3'))
+    yield lambda: data['frame']['generation_settings'].update(model='b')
+    yield lambda: data.update(canonical=['n1'])
+    yield lambda: data.pop('chapters')
+    yield lambda: data['model_responses'].update(r1={'prompt': 'q', 'completions': []})
+    yield lambda: data['model_responses'].pop('r0')
+
+
+def test_journal_saves_round_trip(tmp_path):
+    filename = str(tmp_path / 'tree.json')
+    data = story_tree()
+    saver = TreeSaver()
+    save(saver, filename, data, journal=False)
+    for edit in edits(data):
+        edit()
+        save(saver, filename, data)
+        assert load_tree_file(filename) == data
+    assert saver.stats['full_saves'] == 1 and saver.stats['journal_saves'] == 8
+    assert os.path.exists(journal_filename(filename))
+
+    # a full save replaces the journal
+    save(saver, filename, data, journal=False)
+    assert not os.path.exists(journal_filename(filename))
+    assert load_tree_file(filename) == data
+
+
+def test_truncated_journal_line_is_ignored(tmp_path):
+    filename = str(tmp_path / 'tree.json')
+    data = story_tree()
+    saver = TreeSaver()
+    save(saver, filename, data, journal=False)
+    find(data['root'], 'n7')['text'] = ' first edit'
+    save(saver, filename, data)
+    expected = load_tree_file(filename)
+    find(data['root'], 'n8')['text'] = ' second edit'
+    save(saver, filename, data)
+    assert saver.stats['journal_saves'] == 2
+
+    # the last save was cut off while it was written
+    with open(journal_filename(filename), 'rb+') as f:
+        f.truncate(os.path.getsize(journal_filename(filename)) - 10)
+    assert load_tree_file(filename) == expected
+    assert find(expected['root'], 'n7')['text'] == ' first edit'
+
+
+def test_journal_of_an_older_tree_file_is_ignored(tmp_path):
+    filename = str(tmp_path / 'tree.json')
+    data = story_tree()
+    saver = TreeSaver()
+    save(saver, filename, data, journal=False)
+    find(data['root'], 'n7')['text'] = ' edited'
+    save(saver, filename, data)
+
+    # the tree file was written by something else after the journal was started
+    other = story_tree(10)
+    write_tree(filename, tree_snapshot(other))
+    assert load_tree_file(filename) == other
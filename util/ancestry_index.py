@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+
+"""
+Memoized ancestry of tree nodes.
+
+Each node that has been looked up gets an entry holding its parent's entry, its text, the (start, end) offsets of that
+text in the ancestry text and its depth. Looking up a node walks up only to the nearest ancestor that already has an
+entry, so ancestry, text offsets and context window lookups cost O(depth) pointer hops without rebuilding any text,
+and the text of siblings and children of an indexed node costs O(1) new entries.
+
+The full ancestry text of the most recently requested nodes is kept as well. A node's text is built from the nearest
+ancestor whose text is kept plus the segments below it, so moving down the tree appends one segment.
+
+An entry exists for a node only if entries exist for all of its ancestors. Invalidating a node removes the entries
+of its subtree and stops at nodes without an entry. Nodes for which volatile(node) is true (templates, whose text is
+evaluated on every call) and their descendants are never indexed; lookups return None and callers fall back.
+"""
+
+
+class AncestryEntry:
+    __slots__ = ('node', 'parent', 'text', 'start', 'end', 'depth')
+
+    def __init__(self, node, parent, text):
+        self.node = node
+        self.parent = parent
+        self.text = text
+        self.start = parent.end if parent else 0
+        self.end = self.start + len(text)
+        self.depth = parent.depth + 1 if parent else 0
+
+
+class AncestryIndex:
+    def __init__(self, text_callback, volatile=None, max_texts=16):
+        self.text_callback = text_callback
+        self.volatile = volatile
+        self.max_texts = max_texts
+        self.node_dict = {}
+        # {node_id: AncestryEntry}
+        self.entries = {}
+        # {node_id: ancestry text}, most recently used last
+        self.texts = OrderedDict()
+        self.lock = threading.RLock()
+
+    def reset(self, node_dict):
+        with self.lock:
+            self.node_dict = node_dict if node_dict is not None else {}
+            self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.texts.clear()
+
+    def entry(self, node):
+        with self.lock:
+            entry = self.entries.get(node['id'])
+            if entry is not None and entry.node is node:
+                return entry
+            # walk up to the nearest indexed ancestor
+            chain = []
+            entry = None
+            while True:
+                if self.volatile and self.volatile(node):
+                    return None
+                chain.append(node)
+                node = self.node_dict.get(node.get('parent_id'))
+                if node is None:
+                    break
+                entry = self.entries.get(node['id'])
+                if entry is not None and entry.node is node:
+                    break
+                entry = None
+            for n in reversed(chain):
+                entry = AncestryEntry(n, entry, self.text_callback(n))
+                self.entries[n['id']] = entry
+            return entry
+
+    # Removes the entries of node and its descendants. Call after node's text or parent changes.
+    def invalidate(self, node):
+        with self.lock:
+            stack = [node]
+            while stack:
+                n = stack.pop()
+                if self.entries.pop(n['id'], None) is not None:
+                    self.texts.pop(n['id'], None)
+                    stack.extend(n.get('children', []))
+
+    def chain(self, node):
+        entry = self.entry(node)
+        if entry is None:
+            return None
+        chain = [None] * (entry.depth + 1)
+        while entry is not None:
+            chain[entry.depth] = entry
+            entry = entry.parent
+        return chain
+
+    def ancestry(self, node):
+        chain = self.chain(node)
+        return [entry.node for entry in chain] if chain is not None else None
+
+    def text(self, node):
+        with self.lock:
+            entry = self.entry(node)
+            if entry is None:
+                return None
+            segments = []
+            ancestor = entry
+            while ancestor is not None and ancestor.node['id'] not in self.texts:
+                segments.append(ancestor.text)
+                ancestor = ancestor.parent
+            prefix = self.texts[ancestor.node['id']] if ancestor is not None else ''
+            text = prefix + ''.join(reversed(segments))
+            self.texts[entry.node['id']] = text
+            self.texts.move_to_end(entry.node['id'])
+            if ancestor is not None:
+                self.texts.move_to_end(ancestor.node['id'])
+            while len(self.texts) > self.max_texts:
+                self.texts.popitem(last=False)
+            return text
+
+    # Returns the depth of the first ancestor of node whose text ends after the last max_length characters of
+    # node's ancestry text begin, i.e. bisect_left(end offsets, ancestry length - max_length). Walks up only through
+    # the nodes inside the window.
+    def window_start(self, node, max_length):
+        entry = self.entry(node)
+        if entry is None:
+            return None
+        threshold = entry.end - max_length
+        while entry.parent is not None and entry.parent.end >= threshold:
+            entry = entry.parent
+        return entry.depth
+
+    def info(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'texts': len(self.texts)}
@@ -181,10 +181,19 @@ class ClosableNotebook(ttk.Notebook):
 # Wraps text box to create a <<TextModified>> bindable event
 # https://stackoverflow.com/questions/40617515/python-tkinter-text-modified-callback
 class TextAware(tk.Text):
+    # edits recorded before tracking gives up
+    max_tracked_edits = 10000
+
     def __init__(self, *args, **kwargs):
         """A text widget that report on internal widget commands"""
         tk.Text.__init__(self, *args, **kwargs)
 
+        # [(start, end, text)] edits since track_edits, each replacing the characters [start, end) of the text left
+        # by the edits before it. None if edits aren't tracked.
+        self.edits = None
+        # length of the text when tracking started
+        self.edits_length = 0
+
         # create a proxy for the underlying widget
         self._orig = self._w + "_orig"
         self.tk.call("rename", self._w, self._orig)
@@ -192,6 +201,9 @@ class TextAware(tk.Text):
         self.bind("<<Paste>>", self.Paste)
 
     def _proxy(self, command, *args):
+        edit = None
+        if self.edits is not None and command in ("insert", "delete", "replace"):
+            edit = self.edit_range(command, args)
         cmd = (self._orig, command) + args
         try:
             result = self.tk.call(cmd)
@@ -199,10 +211,42 @@ class TextAware(tk.Text):
             return
 
         if command in ("insert", "delete", "replace"):
+            if self.edits is not None:
+                if edit is None or len(self.edits) >= self.max_tracked_edits:
+                    self.edits = None
+                elif edit[0] != edit[1] or edit[2]:
+                    self.edits.append(edit)
             self.event_generate("<<TextModified>>")
 
         return result
 
+    # Starts recording the edits made to the text (see edits), or stops if track is False
+    def track_edits(self, track=True):
+        self.edits = [] if track else None
+        self.edits_length = self.char_offset("end-1c") if track else 0
+
+    def char_offset(self, index):
+        return int(self.tk.call(self._orig, "count", "-chars", "1.0", index) or 0)
+
+    # (start, end, text) of an insert, delete or replace command, None if it can't be tracked
+    def edit_range(self, command, args):
+        try:
+            length = self.char_offset("end-1c")
+            if command == "insert":
+                start = min(self.char_offset(args[0]), length)
+                return start, start, "".join(args[1::2])
+            if command == "delete" and len(args) <= 2:
+                start = min(self.char_offset(args[0]), length)
+                end = min(self.char_offset(args[1]), length) if len(args) == 2 else min(start + 1, length)
+                return start, max(start, end), ""
+            if command == "replace":
+                start = min(self.char_offset(args[0]), length)
+                end = min(self.char_offset(args[1]), length)
+                return start, max(start, end), "".join(args[2::2])
+        except (tk.TclError, ValueError, IndexError, TypeError):
+            pass
+        return None
+
     def Paste(self, event):
         tagranges = self.tag_ranges("sel")
         if tagranges:
@@ -50,4 +50,14 @@ frame_merger_override = Merger(
     # finally, choose the strategies in
     # the case where the types conflict:
     ["override"]
-)
\ No newline at end of file
+)
+
+# Copies the dicts and lists of a frame or state. Faster than deepcopy, which also tracks shared references.
+def copy_frame(value):
+    if isinstance(value, dict):
+        return {key: copy_frame(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_frame(item) for item in value]
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    return deepcopy(value)
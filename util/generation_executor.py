@@ -0,0 +1,249 @@
+import heapq
+import itertools
+import threading
+import time
+
+"""
+Shared executor for model calls. Generation used to start a new thread per request, so repeatedly pressing Generate
+sent every request to the backend at once and nothing could be cancelled.
+
+Requests are queued per endpoint (the model's api_base, or its type for hosted APIs) and run on that endpoint's
+worker threads, at most max_concurrency at a time. Workers are started as requests arrive and then kept for later
+requests. Queued requests run by priority (INTERACTIVE before NORMAL before BATCH) and then in submission order.
+
+A request with a key is not sent again while a request with the same key is queued or running: submit returns the
+pending job and drops the new callback. Keys are chosen by the caller, and only for requests where a repeat means the
+same thing (e.g. pressing a button again), not for requests which sample new continuations.
+
+Cancelling a job calls its callback with the error "cancelled" at once. A queued job never runs; a running job's
+call can't be interrupted, so its result is dropped when it returns.
+"""
+
+INTERACTIVE = 0
+NORMAL = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BATCH: 'batch'}
+
+DEFAULT_ENDPOINT_CONCURRENCY = 4
+CANCELLED = 'cancelled'
+
+
+def endpoint_key(model_info):
+    return model_info.get('api_base') or model_info['type']
+
+
+def endpoint_concurrency(model_info):
+    return max(1, int(model_info.get('max_concurrency', DEFAULT_ENDPOINT_CONCURRENCY)))
+
+
+class GenerationJob:
+    def __init__(self, executor, endpoint, function, args, kwargs, callback, priority, key):
+        self.executor = executor
+        self.endpoint = endpoint
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.priority = priority
+        self.key = key
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.first_output = None
+
+    def cancel(self):
+        self.executor.cancel(self)
+
+    # call when the job's first output (e.g. a streamed token) arrives
+    def output_started(self):
+        self.executor.output_started(self)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class GenerationExecutor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {endpoint: state}, see endpoint_state
+        self.endpoints = {}
+        # {key: job} queued or running jobs which were submitted with a key
+        self.pending = {}
+        self.sequence = itertools.count()
+
+    def endpoint_state(self, endpoint, max_concurrency):
+        state = self.endpoints.get(endpoint)
+        if state is None:
+            state = self.endpoints[endpoint] = {'max_concurrency': max_concurrency,
+                                                # heap of (priority, sequence, job), may hold cancelled jobs
+                                                'queue': [],
+                                                'available': threading.Condition(self.lock),
+                                                'running_jobs': set(),
+                                                'workers': 0,
+                                                'idle': 0,
+                                                'running': 0,
+                                                'queued': {priority: 0 for priority in PRIORITY_NAMES},
+                                                'max_queued': 0,
+                                                'submitted': 0,
+                                                'started': 0,
+                                                'deduplicated': 0,
+                                                'completed': 0,
+                                                'failed': 0,
+                                                'cancelled': 0,
+                                                'wait_time': 0,
+                                                'run_time': 0,
+                                                # jobs which reported output before finishing, see output_started
+                                                'first_outputs': 0,
+                                                'first_output_time': 0}
+        state['max_concurrency'] = max_concurrency
+        return state
+
+    # Queues function(*args, **kwargs), which returns (result, error) like gpt.gen, and returns the GenerationJob.
+    # callback(result, error) is called from a worker thread (or the cancelling thread) when the job finishes.
+    def submit(self, endpoint, function, args=(), kwargs=None, callback=None, priority=NORMAL, key=None,
+               max_concurrency=DEFAULT_ENDPOINT_CONCURRENCY):
+        with self.lock:
+            state = self.endpoint_state(endpoint, max(1, max_concurrency))
+            if key is not None and key in self.pending:
+                state['deduplicated'] += 1
+                return self.pending[key]
+            job = GenerationJob(self, endpoint, function, args, kwargs or {}, callback, priority, key)
+            if key is not None:
+                self.pending[key] = job
+            heapq.heappush(state['queue'], (priority, next(self.sequence), job))
+            state['queued'][priority] += 1
+            state['submitted'] += 1
+            state['max_queued'] = max(state['max_queued'], sum(state['queued'].values()))
+            state['available'].notify()
+            # idle workers may already have been notified for other queued jobs
+            if sum(state['queued'].values()) > state['idle'] and state['workers'] < state['max_concurrency']:
+                state['workers'] += 1
+                threading.Thread(target=self.work, args=(state,), name=f'generation {endpoint}', daemon=True).start()
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job.done.is_set():
+                return
+            job.cancel_event.set()
+            state = self.endpoints[job.endpoint]
+            if job.started is None:
+                # left in the heap and skipped by the worker which pops it
+                state['queued'][job.priority] -= 1
+            state['cancelled'] += 1
+        self.finish(job, None, CANCELLED)
+
+    # Records the time from submitting the job to its first output, once
+    def output_started(self, job):
+        with self.lock:
+            if job.first_output is not None:
+                return
+            job.first_output = time.monotonic()
+            state = self.endpoints[job.endpoint]
+            state['first_outputs'] += 1
+            state['first_output_time'] += job.first_output - job.submitted
+
+    def cancel_all(self, priority=None):
+        with self.lock:
+            jobs = [job for state in self.endpoints.values() for _, _, job in state['queue']
+                    if priority is None or job.priority == priority]
+            jobs.extend(job for state in self.endpoints.values() for job in state['running_jobs']
+                        if priority is None or job.priority == priority)
+        for job in jobs:
+            self.cancel(job)
+
+    # Sets the job's result and calls its callback once
+    def finish(self, job, result, error):
+        with self.lock:
+            if job.done.is_set():
+                return
+            job.result, job.error = result, error
+            if job.key is not None and self.pending.get(job.key) is job:
+                del self.pending[job.key]
+            job.done.set()
+        if job.callback:
+            try:
+                job.callback(result, error)
+            except Exception as e:
+                print(f'generation callback failed: {e}')
+
+    def next_job(self, state):
+        while True:
+            if state['workers'] > state['max_concurrency']:
+                return None
+            while state['queue']:
+                _, _, job = heapq.heappop(state['queue'])
+                if not job.cancelled:
+                    return job
+            state['idle'] += 1
+            state['available'].wait()
+            state['idle'] -= 1
+
+    def work(self, state):
+        while True:
+            with self.lock:
+                job = self.next_job(state)
+                if job is None:
+                    state['workers'] -= 1
+                    return
+                state['queued'][job.priority] -= 1
+                state['running'] += 1
+                state['started'] += 1
+                state['running_jobs'].add(job)
+                job.started = time.monotonic()
+                state['wait_time'] += job.started - job.submitted
+            try:
+                result, error = job.function(*job.args, **job.kwargs)
+            except Exception as e:
+                print(f'generation failed: {e}')
+                result, error = None, str(e)
+            with self.lock:
+                state['running'] -= 1
+                state['running_jobs'].discard(job)
+                state['run_time'] += time.monotonic() - job.started
+                if not job.cancelled:
+                    state['failed' if error else 'completed'] += 1
+            self.finish(job, result, error)
+
+    # {endpoint: metrics}
+    def stats(self):
+        with self.lock:
+            return {endpoint: {name: (dict(value) if isinstance(value, dict) else value)
+                               for name, value in state.items()
+                               if name not in ('queue', 'available', 'running_jobs')}
+                    for endpoint, state in self.endpoints.items()}
+
+
+def generation_report(stats):
+    lines = []
+    for endpoint, state in stats.items():
+        finished = state['started'] - state['running']
+        queued = ', '.join(f'{PRIORITY_NAMES[priority]} {count}' for priority, count in state['queued'].items())
+        lines.append(f"{endpoint}: {state['running']}/{state['max_concurrency']} running, queued {queued} "
+                     f"(max {state['max_queued']}), {state['completed']} done, {state['failed']} failed, "
+                     f"{state['cancelled']} cancelled, {state['deduplicated']} deduplicated, "
+                     f"wait {state['wait_time'] / state['started'] if state['started'] else 0:.2f}s avg, "
+                     f"run {state['run_time'] / finished if finished else 0:.2f}s avg"
+                     + (f", first token {state['first_output_time'] / state['first_outputs']:.2f}s avg"
+                        if state['first_outputs'] else ''))
+    return '\n'.join(lines) if lines else 'no generation requests'
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# The executor shared by all generation calls, so that endpoint limits hold across callers
+def generation_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = GenerationExecutor()
+        return _executor
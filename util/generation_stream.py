@@ -0,0 +1,72 @@
+import threading
+import time
+
+"""
+Buffers streamed continuation text for the Tk thread.
+
+on_text is called from the thread reading the response, once per chunk, with the text of a continuation so far. The
+latest text of each continuation is kept and one flush is posted to the Tk thread for all chunks which arrive before
+it runs. Flushes are at least interval seconds apart, so a fast stream updates the tree a bounded number of times
+per second however many continuations and chunks there are. After close() (when the whole response has arrived or
+failed) pending and later text is dropped, so a late flush can't overwrite the final text.
+
+time_to_first_text is the time from creating the stream (when the request is queued) to the first chunk.
+"""
+
+STREAM_INTERVAL = 0.05
+
+
+class GenerationStream:
+    # apply({index: text}), post(func) and schedule(seconds, func) are called on the Tk thread, except post, which
+    # queues func to run on it. on_first_text() is called once, from the reading thread.
+    def __init__(self, apply, post, schedule, on_first_text=None, interval=STREAM_INTERVAL):
+        self.apply = apply
+        self.post = post
+        self.schedule = schedule
+        self.on_first_text = on_first_text
+        self.interval = interval
+        self.lock = threading.Lock()
+        # {index: latest text} not yet applied
+        self.pending = {}
+        self.scheduled = False
+        self.closed = False
+        self.last_flush = 0
+        self.started = time.perf_counter()
+        self.time_to_first_text = None
+        self.flushes = 0
+
+    def on_text(self, index, text):
+        first = False
+        with self.lock:
+            if self.closed:
+                return
+            if self.time_to_first_text is None:
+                self.time_to_first_text = time.perf_counter() - self.started
+                first = True
+            self.pending[index] = text
+            post = not self.scheduled
+            self.scheduled = True
+        if first and self.on_first_text:
+            self.on_first_text()
+        if post:
+            self.post(self.flush)
+
+    def flush(self):
+        delay = self.last_flush + self.interval - time.perf_counter()
+        if delay > 0:
+            self.schedule(delay, self.flush)
+            return
+        with self.lock:
+            updates, self.pending = self.pending, {}
+            self.scheduled = False
+            if self.closed:
+                return
+        self.last_flush = time.perf_counter()
+        if updates:
+            self.flushes += 1
+            self.apply(updates)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending = {}
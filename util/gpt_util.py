@@ -4,6 +4,7 @@ import numpy as np
 import math
 import codecs
 from util.tokenizer import logit_mask
+from util.logprob_cache import logprob_cache
 
 
 def normalize(probs):
@@ -27,53 +28,54 @@ def total_logprob(response):
     return sum(logprobs)
 
 
+# The endpoint openai requests go to: openai.base_url (openai 1.x) or openai.api_base (0.x), None for the default
+def openai_endpoint():
+    endpoint = getattr(openai, 'base_url', None) or getattr(openai, 'api_base', None)
+    return str(endpoint).rstrip('/') if endpoint else None
+
+
+# Scores prompt with echo=True and returns its logprobs dict (tokens, token_logprobs, text_offset, top_logprobs).
+# Answers are kept in the persistent logprob cache, keyed by the endpoint too, since OpenAI-compatible servers can
+# serve different models under the same engine name. Rescoring the same text doesn't query the model again.
+def echo_logprobs(prompt, engine='ada', logprobs=0):
+    def request():
+        response = openai.Completion.create(
+            engine=engine,
+            prompt=prompt,
+            max_tokens=0,
+            echo=True,
+            n=1,
+            logprobs=logprobs
+        )
+        result = response.choices[0]["logprobs"]
+        top = result.get("top_logprobs")
+        return {'tokens': list(result["tokens"]),
+                'token_logprobs': list(result["token_logprobs"]),
+                'text_offset': list(result["text_offset"]),
+                'top_logprobs': [dict(probs) if probs is not None else None for probs in top] if top else None}
+    params = {'api_base': openai_endpoint(), 'echo': True, 'max_tokens': 0, 'logprobs': logprobs}
+    return logprob_cache().get_or_call(engine, prompt, params, request)
+
+
 def tokenize_ada(prompt):
-    response = openai.Completion.create(
-        engine='ada',
-        prompt=prompt,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    return tokens, positions
+    response = echo_logprobs(prompt, engine='ada')
+    return response["tokens"], response["text_offset"]
 
 
 def prompt_probs(prompt, engine='ada'):
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=prompt,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
-    return logprobs, tokens, positions
+    response = echo_logprobs(prompt, engine)
+    return response["token_logprobs"], response["tokens"], response["text_offset"]
 
 # evaluates logL(prompt+target | prompt)
 def conditional_logprob(prompt, target, engine='ada'):
-    combined = prompt + target
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=combined,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
+    response = echo_logprobs(prompt + target, engine)
+    positions = response["text_offset"]
+    logprobs = response["token_logprobs"]
     word_index = positions.index(len(prompt))
     total_conditional_logprob = sum(logprobs[word_index:])
     return total_conditional_logprob
 
 
-
 # TODO use threading
 # returns the conditional probabilities for each event happening after prompt
 def event_probs(prompt, events, engine='ada'):
@@ -136,16 +138,9 @@ def substring_probs(preprompt, content, target, engine='ada', quiet=0):
 # returns a list of substrings of content
 # logL(substring+target | substring) for each substring
 def token_conditional_logprob(content, target, engine='ada'):
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=content,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=100
-    )
-    tokens = response.choices[0]['logprobs']['tokens']
-    top_logprobs = response.choices[0]['logprobs']['top_logprobs']
+    response = echo_logprobs(content, engine, logprobs=100)
+    tokens = response['tokens']
+    top_logprobs = response['top_logprobs']
     logprobs = []
     substrings = []
     substring = ''
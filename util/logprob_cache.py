@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent cache of model logprob queries, keyed by (engine, prompt, request params).
+# Scoring and wavefunction exploration re-send identical prompts whenever the user re-propagates, renormalizes or
+# rescores, so cached answers are served from an SQLite file and survive restarts.
+# Entries are evicted least recently used first when either max_entries or max_bytes is exceeded.
+
+DEFAULT_CACHE_PATH = os.environ.get('LOOM_LOGPROB_CACHE', os.path.join('data', 'cache', 'logprobs.sqlite'))
+DEFAULT_MAX_ENTRIES = 200000
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def cache_key(engine, prompt, params):
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    params_json = json.dumps(params, sort_keys=True)
+    return f'{engine}:{prompt_hash}:{hashlib.sha256(params_json.encode("utf-8")).hexdigest()[:16]}'
+
+
+class LogprobCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'key TEXT PRIMARY KEY, engine TEXT, value TEXT, size INTEGER, last_access REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+        self.db.commit()
+        self.num_entries, self.num_bytes = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+
+    def get(self, engine, prompt, params):
+        key = cache_key(engine, prompt, params)
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, engine, prompt, params, value):
+        key = cache_key(engine, prompt, params)
+        value_json = json.dumps(value)
+        with self.lock:
+            old = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if old:
+                self.num_entries -= 1
+                self.num_bytes -= old[0]
+            self.db.execute('INSERT OR REPLACE INTO entries (key, engine, value, size, last_access) '
+                            'VALUES (?, ?, ?, ?, ?)', (key, engine, value_json, len(value_json), time.time()))
+            self.num_entries += 1
+            self.num_bytes += len(value_json)
+            self.evict()
+            self.db.commit()
+
+    # Returns the cached value, or calls request() and caches its result
+    def get_or_call(self, engine, prompt, params, request):
+        value = self.get(engine, prompt, params)
+        if value is None:
+            value = request()
+            self.put(engine, prompt, params, value)
+        return value
+
+    # must hold self.lock
+    def evict(self):
+        while self.num_entries > self.max_entries or self.num_bytes > self.max_bytes:
+            excess = max(self.num_entries - self.max_entries, 1)
+            rows = self.db.execute('SELECT key, size FROM entries ORDER BY last_access LIMIT ?',
+                                   (max(excess, 64),)).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.num_entries -= 1
+                self.num_bytes -= size
+                self.stats['evictions'] += 1
+                if self.num_entries <= self.max_entries and self.num_bytes <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM entries')
+            self.db.commit()
+            self.num_entries = 0
+            self.num_bytes = 0
+
+    def info(self):
+        with self.lock:
+            return {**self.stats, 'entries': self.num_entries, 'bytes': self.num_bytes, 'path': self.path}
+
+
+_logprob_cache = None
+_logprob_cache_lock = threading.Lock()
+
+
+def logprob_cache():
+    global _logprob_cache
+    with _logprob_cache_lock:
+        if _logprob_cache is None:
+            _logprob_cache = LogprobCache()
+        return _logprob_cache
+
+
+def configure_logprob_cache(path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+    global _logprob_cache
+    with _logprob_cache_lock:
+        _logprob_cache = LogprobCache(path, max_entries, max_bytes)
+        return _logprob_cache
@@ -0,0 +1,59 @@
+import queue
+import threading
+import weakref
+
+"""
+Runs functions posted from background threads on the Tk thread.
+
+Every tab's TreeModel is built on the same Tk root, so there is one dispatcher per root: one queue and one
+<<MainThreadCall>> binding, shared by all tabs. A binding per model would be replaced by the next tab's, leaving the
+other tabs' calls undrained. Calls are queued with the owner which posted them, and calls of a closed owner (see
+close) are dropped instead of run.
+"""
+
+EVENT = "<<MainThreadCall>>"
+
+
+class MainThreadDispatcher:
+    def __init__(self, root):
+        self.root = root
+        # (owner, func)
+        self.calls = queue.Queue()
+        self.closed_owners = weakref.WeakSet()
+        root.bind(EVENT, lambda _: self.run_calls(), add="+")
+
+    def post(self, func, owner=None):
+        self.calls.put((owner, func))
+        self.root.event_generate(EVENT, when="tail")
+
+    # posted calls of owner which haven't run yet are dropped, and so are later ones
+    def close(self, owner):
+        self.closed_owners.add(owner)
+
+    def closed(self, owner):
+        return owner in self.closed_owners
+
+    def run_calls(self):
+        while True:
+            try:
+                owner, func = self.calls.get_nowait()
+            except queue.Empty:
+                return
+            if owner is not None and owner in self.closed_owners:
+                continue
+            try:
+                func()
+            except Exception as e:
+                print(f'main thread call failed: {e}')
+
+
+_lock = threading.Lock()
+
+
+# The dispatcher of the Tk root (or anything with bind and event_generate), created on first use
+def main_thread_dispatcher(root):
+    with _lock:
+        dispatcher = getattr(root, 'main_thread_dispatcher', None)
+        if dispatcher is None:
+            dispatcher = root.main_thread_dispatcher = MainThreadDispatcher(root)
+        return dispatcher
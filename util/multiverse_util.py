@@ -1,7 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import openai
 import numpy as np
 from util.tokenizer import tokenize, token_to_word
 from util.gpt_util import logprobs_to_probs, get_correct_key
+from util.logprob_cache import logprob_cache
 import os
 
 
@@ -17,50 +20,66 @@ def generate(prompt, engine, api_base, api_key):
                                         model=engine).dict()
     return response
 
-# TODO multiple "ground truth" trajectories
-def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_amplitude=1, unnormalized_threshold=0.1,
-                           engine='davinci-002', model_type='openai', api_base=None):
-    if isinstance(ground_truth, str):
-        ground_truth = tokenize(ground_truth)
-        ground_truth = [token_to_word(token).replace('Ġ', ' ') for token in ground_truth]
-    if max_depth == 0:
-        return {}, ground_truth
-    api_key, _ = get_correct_key(model_type)
-    response = generate(prompt, engine, api_base, api_key)
-    logprobs = response['choices'][0]["logprobs"]["top_logprobs"][0]
+
+# Top next-token logprobs after prompt. Answers are kept in the persistent logprob cache, shared by all propagations,
+# so re-propagating from the same prefix, reaching the same prefix along two paths, or reopening the wavefunction
+# after a restart doesn't query the model again
+def next_token_logprobs(prompt, engine, api_base, api_key):
+    def request():
+        response = generate(prompt, engine, api_base, api_key)
+        return response['choices'][0]["logprobs"]["top_logprobs"][0]
+    params = {'api_base': api_base, 'max_tokens': 1, 'temperature': 0, 'logprobs': 100}
+    return logprob_cache().get_or_call(engine, prompt, params, request)
+
+
+# Branches of one expanded prefix. Returns (multiverse, [(token, ground_truth), ...]) where the list holds the
+# tokens to expand next and the ground truth to follow below each of them.
+def expand_prefix(logprobs, ground_truth, unnormalized_amplitude, unnormalized_threshold):
     probs = {k: logprobs_to_probs(v) for k, v in sorted(logprobs.items(), key=lambda item: item[1], reverse=True)}
-    multiverse = {token: {'normalized_prob': prob, 'unnormalized_prob': prob * unnormalized_amplitude, 'children': {}} for token, prob in probs.items()}
+    multiverse = {token: {'normalized_prob': prob, 'unnormalized_prob': prob * unnormalized_amplitude, 'children': {}}
+                  for token, prob in probs.items()}
     ground_truth_token = ground_truth[0] if ground_truth else 'NO GROUND TRUTH'
     done_ground_truth = False
-    for token in multiverse.items():
-        if token[1]['unnormalized_prob'] > unnormalized_threshold:
-            token[1]['children'], _ = greedy_word_multiverse(prompt + token[0], ground_truth='', max_depth=max_depth-1,
-                                                             unnormalized_threshold=unnormalized_threshold,
-                                                             unnormalized_amplitude=token[1]['unnormalized_prob'],
-                                                             engine=engine,
-                                                             api_base=api_base)
-        elif token[0] == ground_truth_token:
-            token[1]['children'], _ = greedy_word_multiverse(prompt + token[0], ground_truth=ground_truth[1:],
-                                                             max_depth=max_depth-1,
-                                                             unnormalized_threshold=unnormalized_threshold,
-                                                             unnormalized_amplitude=token[1]['unnormalized_prob'],
-                                                             engine=engine,
-                                                             api_base=api_base)
-
-
+    branches = {}
+    for token, branch in multiverse.items():
+        if branch['unnormalized_prob'] > unnormalized_threshold:
+            branches[token] = ''
+        elif token == ground_truth_token:
+            branches[token] = ground_truth[1:]
             done_ground_truth = True
         else:
             break
-    if not done_ground_truth:
-        if ground_truth_token in multiverse:
-            multiverse[ground_truth_token]['children'], _ = greedy_word_multiverse(prompt + ground_truth_token,
-                                                                                   ground_truth=ground_truth[1:],
-                                                                                   max_depth=max_depth-1,
-                                                                                   unnormalized_threshold=unnormalized_threshold,
-                                                                                   unnormalized_amplitude=multiverse[ground_truth_token]['unnormalized_prob'],
-                                                                                   engine=engine,
-                                                                                   api_base=api_base,
-                                                                                   api_key=api_key)
-    return multiverse, ground_truth
+    if not done_ground_truth and ground_truth_token in multiverse:
+        branches[ground_truth_token] = ground_truth[1:]
+    return multiverse, list(branches.items())
 
 
+# Propagates the multiverse one level at a time. All prefixes in a level are queried concurrently, with at most
+# max_in_flight requests outstanding. Branch order within each level of the result is by descending probability,
+# independent of the order in which requests complete.
+# TODO multiple "ground truth" trajectories
+def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_amplitude=1, unnormalized_threshold=0.1,
+                           engine='davinci-002', model_type='openai', api_base=None, max_in_flight=8):
+    if isinstance(ground_truth, str):
+        ground_truth = tokenize(ground_truth)
+        ground_truth = [token_to_word(token).replace('Ġ', ' ') for token in ground_truth]
+    api_key, _ = get_correct_key(model_type)
+    root = {}
+    # (prompt, ground_truth, unnormalized_amplitude, dict to fill with the prompt's branches)
+    frontier = [(prompt, ground_truth, unnormalized_amplitude, root)]
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix='multiverse') as executor:
+        for _ in range(max_depth):
+            if not frontier:
+                break
+            prompts = list(dict.fromkeys(item[0] for item in frontier))
+            futures = {p: executor.submit(next_token_logprobs, p, engine, api_base, api_key) for p in prompts}
+            next_frontier = []
+            for item_prompt, item_ground_truth, amplitude, target in frontier:
+                multiverse, branches = expand_prefix(futures[item_prompt].result(), item_ground_truth, amplitude,
+                                                     unnormalized_threshold)
+                target.update(multiverse)
+                for token, branch_ground_truth in branches:
+                    next_frontier.append((item_prompt + token, branch_ground_truth,
+                                          multiverse[token]['unnormalized_prob'], multiverse[token]['children']))
+            frontier = next_frontier
+    return root, ground_truth
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+
+from util.token_data import token_data_json, token_data_hook, compact_response
+
+"""
+Model responses kept out of the tree file.
+
+post_generation keeps the full formatted response of every request, including the counterfactuals of every token,
+and get_request_info is the only thing that reads them back. Instead of living in tree['model_responses'], where
+they are parsed on every open and written on every save, responses are stored in a sidecar SQLite file next to the
+tree (<tree file>.responses.sqlite) and read one at a time by response id.
+
+Responses are content addressed: the blobs table holds each distinct compressed response once, keyed by the
+sha256 of its JSON, and the responses table maps response ids to blobs. Token logprobs are stored as TokenData
+arrays (util/token_data.py).
+
+Trees saved before the sidecar existed still have their responses inline. ResponseStore reads those too, and
+migrate_inline moves them into the sidecar, which TreeModel.save_tree does when it saves the tree to its own file.
+To migrate trees without opening them:
+
+    python -m util.response_store data/tree.json [...]
+"""
+
+RESPONSES_SUFFIX = '.responses.sqlite'
+
+
+def response_store_filename(tree_filename):
+    return os.path.splitext(tree_filename)[0] + RESPONSES_SUFFIX
+
+
+def encode_response(response):
+    response_json = json.dumps(response, separators=(',', ':'), default=token_data_json)
+    return hashlib.sha256(response_json.encode('utf-8')).hexdigest(), zlib.compress(response_json.encode('utf-8'))
+
+
+# Token lists of responses stored before TokenData are compacted as they are read
+def decode_response(data):
+    return compact_response(json.loads(zlib.decompress(data), object_hook=token_data_hook))
+
+
+class ResponseStore:
+    def __init__(self, path=None, inline=None, max_cached=32):
+        self.max_cached = max_cached
+        self.lock = threading.RLock()
+        self.db = None
+        self.path = None
+        self.inline = {}
+        # {response_id: (hash, data)}, responses not yet written because the tree has no file
+        self.pending = {}
+        # {response_id: response}, most recently read last
+        self.cache = OrderedDict()
+        self.reset(path, inline)
+
+    # Switches to the responses of another tree. The sidecar is only created once something is written to it.
+    def reset(self, path=None, inline=None):
+        with self.lock:
+            self.close()
+            self.path = path
+            self.inline = inline if inline is not None else {}
+            self.pending.clear()
+            self.cache.clear()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def connection(self, create=False):
+        if self.db is None and self.path and (create or os.path.isfile(self.path)):
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB, size INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, hash TEXT)')
+            self.db.commit()
+        return self.db
+
+    def get(self, response_id, default=None):
+        with self.lock:
+            if response_id in self.inline:
+                return self.inline[response_id]
+            if response_id in self.cache:
+                self.cache.move_to_end(response_id)
+                return self.cache[response_id]
+            if response_id in self.pending:
+                response = decode_response(self.pending[response_id][1])
+            else:
+                db = self.connection()
+                row = db.execute('SELECT blobs.data FROM responses JOIN blobs ON responses.hash = blobs.hash '
+                                 'WHERE responses.id = ?', (response_id,)).fetchone() if db else None
+                if row is None:
+                    return default
+                response = decode_response(row[0])
+            self.cache[response_id] = response
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+            return response
+
+    def __getitem__(self, response_id):
+        response = self.get(response_id)
+        if response is None:
+            raise KeyError(response_id)
+        return response
+
+    def __contains__(self, response_id):
+        return self.get(response_id) is not None
+
+    def __setitem__(self, response_id, response):
+        self.put({response_id: response})
+
+    # Stores {response_id: response}. Called from generation threads.
+    def put(self, responses):
+        encoded = [(response_id, *encode_response(response)) for response_id, response in responses.items()]
+        with self.lock:
+            for response_id, _, _ in encoded:
+                self.cache.pop(response_id, None)
+            db = self.connection(create=True)
+            if db is None:
+                for response_id, response_hash, data in encoded:
+                    self.pending[response_id] = (response_hash, data)
+                return
+            self.write(db, encoded)
+
+    def write(self, db, encoded):
+        db.executemany('INSERT OR IGNORE INTO blobs (hash, data, size) VALUES (?, ?, ?)',
+                       [(response_hash, data, len(data)) for _, response_hash, data in encoded])
+        db.executemany('INSERT OR REPLACE INTO responses (id, hash) VALUES (?, ?)',
+                       [(response_id, response_hash) for response_id, response_hash, _ in encoded])
+        db.commit()
+
+    # Moves the store to path, e.g. when a new tree is saved for the first time or saved under another name.
+    # Whatever was at path before is replaced.
+    def attach(self, path):
+        with self.lock:
+            if path == self.path and not self.pending:
+                return
+            old_db = self.connection()
+            if path != self.path:
+                for filename in (path, path + '-wal', path + '-shm'):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                self.path = path
+                self.db = None
+                if old_db is not None:
+                    old_db.backup(self.connection(create=True))
+                    old_db.close()
+            if self.pending:
+                self.write(self.connection(create=True),
+                           [(response_id, *value) for response_id, value in self.pending.items()])
+                self.pending.clear()
+
+    # Moves responses still stored in the tree into the store. Returns how many were moved.
+    def migrate_inline(self):
+        with self.lock:
+            if not self.inline:
+                return 0
+            moved = len(self.inline)
+            self.put(self.inline)
+            self.inline.clear()
+            return moved
+
+    def clear(self):
+        with self.lock:
+            self.inline.clear()
+            self.pending.clear()
+            self.cache.clear()
+            db = self.connection()
+            if db is not None and db.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]:
+                db.execute('DELETE FROM responses')
+                db.execute('DELETE FROM blobs')
+                db.commit()
+                db.execute('VACUUM')
+
+    # Copies every response to a new SQLite file at filename
+    def backup(self, filename):
+        with self.lock:
+            if not len(self):
+                return
+            store = ResponseStore(filename)
+            db = self.connection()
+            if db is not None:
+                db.backup(store.connection(create=True))
+            store.put(self.inline)
+            if self.pending:
+                store.write(store.connection(create=True),
+                            [(response_id, *value) for response_id, value in self.pending.items()])
+            store.close()
+
+    def __len__(self):
+        with self.lock:
+            db = self.connection()
+            stored = db.execute('SELECT COUNT(*) FROM responses').fetchone()[0] if db else 0
+            return stored + len(self.pending) + len(self.inline)
+
+    def info(self):
+        with self.lock:
+            db = self.connection()
+            blobs, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone() if db else (0, 0)
+            return {'path': self.path, 'responses': len(self), 'inline': len(self.inline),
+                    'pending': len(self.pending), 'blobs': blobs, 'bytes': size}
+
+
+# Moves the responses stored in a tree file into its sidecar and rewrites the tree file without them, keeping the
+# old tree file as <tree file>.bak. Returns how many responses were moved.
+def migrate_tree_file(filename):
+    from util.tree_save import load_tree_file, tree_snapshot, write_tree, journal_filename
+    tree = load_tree_file(filename)
+    responses = tree.get('model_responses')
+    if not responses:
+        return 0
+    store = ResponseStore(response_store_filename(filename), responses)
+    moved = store.migrate_inline()
+    store.close()
+    write_tree(filename, tree_snapshot(tree), backup_filename=filename + '.bak')
+    # the journal, if any, was applied above
+    if os.path.exists(journal_filename(filename)):
+        os.remove(journal_filename(filename))
+    return moved
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('usage: python -m util.response_store tree.json [...]')
+    for tree_filename in sys.argv[1:]:
+        print(f'{tree_filename}: moved {migrate_tree_file(tree_filename)} model responses to '
+              f'{response_store_filename(tree_filename)}')
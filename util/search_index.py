@@ -0,0 +1,264 @@
+import re
+import threading
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+"""
+Inverted word index of node text, with a trigram index of the words.
+
+words maps each word (a run of \\w characters, case folded) to the ids of the nodes whose text contains it, and
+trigrams maps each three character substring of a word to the words containing it. Both are built from the node dict
+on first use and then kept up to date: TreeModel reports added and removed subtrees, and text_changed (called for
+every text edit, update_text included) marks a node as changed. Changed nodes are indexed again before the next
+query, only if their text is not the text they were indexed with. Updates which may have edited text anywhere
+(tree_updated without saying what changed) make the next query compare every node's text with its indexed text.
+
+A query is reduced to the literal fragments every match must contain: the whole pattern for plain text searches, and
+the runs of literal characters which are not optional for regular expressions. Each word in a fragment must be a word
+of the node's text if it is surrounded by non-word characters within the fragment, and otherwise a prefix, suffix or
+substring of one. Words matching a prefix, suffix or substring are found through the trigram index (or by scanning
+the vocabulary for fragments shorter than three characters). The candidate nodes are the nodes which satisfy every
+requirement; the caller still runs the pattern over their text, so candidates only need to be a superset of the
+matching nodes. Patterns without a usable requirement (e.g. "a|b" or ".*") have no candidates and are run over every
+node.
+
+Building the index takes seconds for a large tree, so it can be built in a background thread (build_in_background)
+from a snapshot of the node text, taken on the calling thread. The result is installed by the next update() on the
+calling thread, which then compares every node's text with the snapshot to catch edits made during the build.
+
+Case insensitive regular expressions match the letters İ, ı, ſ and K (Kelvin sign) to ASCII letters; text and
+fragments are mapped to those before case folding, so that they can't be missed.
+"""
+
+WORD = re.compile(r'\w+')
+# non-ASCII letters which case insensitive regular expressions match to ASCII letters
+ASCII_FOLDS = str.maketrans({'İ': 'i', 'ı': 'i', 'ſ': 's', 'K': 'k'})
+# fragments shorter than this are not used as substring requirements, they match too many words
+MIN_INFIX_LENGTH = 2
+
+
+def fold(text):
+    return text.translate(ASCII_FOLDS).casefold()
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+# Literal strings which every match of a parsed pattern contains
+def required_literals(parsed):
+    literals = []
+    run = []
+    for op, av in parsed:
+        name = str(op)
+        if name == 'LITERAL':
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = []
+        if name == 'SUBPATTERN':
+            literals.extend(required_literals(av[-1]))
+        elif name == 'ATOMIC_GROUP':
+            literals.extend(required_literals(av))
+        elif name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') and av[0] >= 1:
+            literals.extend(required_literals(av[2]))
+    if run:
+        literals.append(''.join(run))
+    return literals
+
+
+# [(kind, word)] which a text containing fragment must satisfy, kind is "word", "prefix", "suffix" or "infix"
+def fragment_requirements(fragment):
+    requirements = []
+    for match in WORD.finditer(fold(fragment)):
+        starts_word, ends_word = match.start() > 0, match.end() < len(match.string)
+        if starts_word and ends_word:
+            requirements.append(('word', match.group()))
+        elif starts_word:
+            requirements.append(('prefix', match.group()))
+        elif ends_word:
+            requirements.append(('suffix', match.group()))
+        elif len(match.group()) >= MIN_INFIX_LENGTH:
+            requirements.append(('infix', match.group()))
+    return requirements
+
+
+# ({word: set of node ids}, {trigram: set of words}, {node_id: (text, set of words)}) of [(node_id, text)]
+def build_index(texts):
+    words = {}
+    node_words = {}
+    for node_id, text in texts:
+        text_words = set(WORD.findall(fold(text)))
+        node_words[node_id] = (text, text_words)
+        for word in text_words:
+            ids = words.get(word)
+            if ids is None:
+                ids = words[word] = set()
+            ids.add(node_id)
+    trigram_index = {}
+    for word in words:
+        for trigram in trigrams(word):
+            trigram_index.setdefault(trigram, set()).add(word)
+    return words, trigram_index, node_words
+
+
+class SearchIndex:
+    def __init__(self):
+        self.node_dict = {}
+        # {word: set of node ids}, None until built
+        self.words = None
+        # {trigram: set of words}
+        self.trigrams = {}
+        # {node_id: (indexed text, set of words)}
+        self.node_words = {}
+        # ids of nodes whose text may have changed
+        self.changed = set()
+        # whether text may have changed in nodes which aren't in changed
+        self.unverified = False
+        # incremented by reset, so that a background build of an old tree is dropped
+        self.generation = 0
+        self.building = False
+        # (generation, build_index result) from a background build, not yet installed
+        self.built = None
+
+    def reset(self, node_dict):
+        self.node_dict = node_dict if node_dict is not None else {}
+        self.words = None
+        self.trigrams = {}
+        self.node_words = {}
+        self.changed = set()
+        self.unverified = False
+        self.generation += 1
+        self.building = False
+        self.built = None
+
+    # whether queries can be answered without building the index
+    def ready(self):
+        return self.words is not None or (self.built is not None and self.built[0] == self.generation)
+
+    def build_in_background(self):
+        if self.ready() or self.building:
+            return
+        self.building = True
+        generation = self.generation
+        texts = [(node_id, node.get('text', '')) for node_id, node in self.node_dict.items()]
+
+        def build():
+            index = build_index(texts)
+            # dropped if the index was built on the calling thread or reset meanwhile
+            if self.words is None and self.generation == generation:
+                self.built = (generation, index)
+        threading.Thread(target=build, name='search index', daemon=True).start()
+
+    def node_changed(self, node):
+        if self.words is not None:
+            self.changed.add(node['id'])
+
+    # call when nodes enter or leave the tree
+    def nodes_added(self, nodes):
+        if self.words is not None:
+            self.changed.update(node['id'] for node in nodes)
+
+    def nodes_removed(self, nodes):
+        self.nodes_added(nodes)
+
+    # call when text may have been edited anywhere
+    def texts_changed(self):
+        self.unverified = True
+
+    def update(self):
+        if self.words is None:
+            if self.built is not None and self.built[0] == self.generation:
+                self.words, self.trigrams, self.node_words = self.built[1]
+                # text may have been edited and nodes added or removed since the snapshot
+                self.unverified = True
+            else:
+                self.words, self.trigrams, self.node_words = build_index(
+                    (node_id, node.get('text', '')) for node_id, node in self.node_dict.items())
+                self.unverified = False
+            self.building = False
+            self.built = None
+            self.changed.clear()
+        if self.unverified:
+            node_words = self.node_words
+            self.changed.update(node_id for node_id, node in self.node_dict.items()
+                                if node_id not in node_words or node_words[node_id][0] is not node.get('text', ''))
+            self.changed.update(node_id for node_id in self.node_words if node_id not in self.node_dict)
+            self.unverified = False
+        for node_id in self.changed:
+            self.index_node(node_id)
+        self.changed.clear()
+
+    def index_node(self, node_id):
+        node = self.node_dict.get(node_id)
+        text = node.get('text', '') if node is not None else None
+        indexed_text, old_words = self.node_words.get(node_id, (None, set()))
+        if text is not None and indexed_text is not None and (text is indexed_text or text == indexed_text):
+            self.node_words[node_id] = (text, old_words)
+            return
+        new_words = set(WORD.findall(fold(text))) if text is not None else set()
+        for word in old_words - new_words:
+            ids = self.words[word]
+            ids.discard(node_id)
+            if not ids:
+                del self.words[word]
+                for trigram in trigrams(word):
+                    self.trigrams[trigram].discard(word)
+                    if not self.trigrams[trigram]:
+                        del self.trigrams[trigram]
+        for word in new_words - old_words:
+            ids = self.words.get(word)
+            if ids is None:
+                ids = self.words[word] = set()
+                for trigram in trigrams(word):
+                    self.trigrams.setdefault(trigram, set()).add(word)
+            ids.add(node_id)
+        if text is None:
+            self.node_words.pop(node_id, None)
+        else:
+            self.node_words[node_id] = (text, new_words)
+
+    # words of the index which satisfy (kind, word)
+    def matching_words(self, kind, word):
+        if kind == 'word':
+            return [word] if word in self.words else []
+        if len(word) >= 3:
+            sets = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams(word)), key=len)
+            words = sets[0].intersection(*sets[1:])
+        else:
+            words = self.words
+        if kind == 'prefix':
+            return [candidate for candidate in words if candidate.startswith(word)]
+        if kind == 'suffix':
+            return [candidate for candidate in words if candidate.endswith(word)]
+        return [candidate for candidate in words if word in candidate]
+
+    # ids of the nodes whose text may contain a match of pattern (a superset of the nodes with a match), or None if
+    # the pattern has no requirement the index can check. Raises re.error for invalid regular expressions.
+    def candidates(self, pattern, regex=True):
+        self.update()
+        fragments = required_literals(sre_parse.parse(pattern)) if regex else [pattern]
+        requirements = {requirement for fragment in fragments for requirement in fragment_requirements(fragment)}
+        if not requirements:
+            return None
+        postings = []
+        for kind, word in requirements:
+            sets = [self.words[matching] for matching in self.matching_words(kind, word)]
+            if not sets:
+                return set()
+            postings.append(sets)
+        # intersect the requirements with the fewest postings first
+        postings.sort(key=lambda sets: sum(len(ids) for ids in sets))
+        ids = set().union(*postings[0])
+        for sets in postings[1:]:
+            if not ids:
+                break
+            if len(ids) * len(sets) < sum(len(posting) for posting in sets):
+                ids = {node_id for node_id in ids if any(node_id in posting for posting in sets)}
+            else:
+                ids &= set().union(*sets)
+        return ids
@@ -0,0 +1,115 @@
+"""
+Inverted index of node tags.
+
+tagged maps each tag to the ids of the nodes whose "tags" attribute contains it. It is built from the node dict on
+first use and then kept up to date by TreeModel.tag_node, untag_node and the indexing of added and removed subtrees.
+
+For each tag the index also keeps its closure, the ids of the nodes for which TreeModel.has_tag is true given the
+tag's scope:
+
+    node        the tagged nodes
+    subtree     the tagged nodes and their descendants
+    ancestry    the tagged nodes and their ancestors
+
+A closure is computed when it is first needed, in time proportional to its size: subtrees are not descended into
+and ancestries are not walked up past nodes already in the closure. Tagging or untagging a node drops the closure of
+that tag, and structural edits drop the closures of subtree and ancestry scoped tags. Closures remember the scope they
+were computed for, so changing a tag's scope in place is picked up.
+"""
+
+
+class TagIndex:
+    def __init__(self):
+        self.node_dict = {}
+        # {tag: set of node ids}, None until built
+        self.tagged = None
+        # {tag: (scope, set of node ids)}
+        self.closures = {}
+        # incremented whenever a closure may have changed
+        self.version = 0
+
+    def reset(self, node_dict):
+        self.node_dict = node_dict if node_dict is not None else {}
+        self.tagged = None
+        self.closures.clear()
+        self.version += 1
+
+    def tagged_ids(self, tag):
+        if self.tagged is None:
+            self.tagged = {}
+            for node in self.node_dict.values():
+                for node_tag in node.get('tags') or ():
+                    self.tagged.setdefault(node_tag, set()).add(node['id'])
+        return self.tagged.get(tag, set())
+
+    def add(self, node, tag):
+        if self.tagged is not None:
+            self.tagged.setdefault(tag, set()).add(node['id'])
+        self.tag_changed(tag)
+
+    def remove(self, node, tag):
+        if self.tagged is not None and tag in self.tagged:
+            self.tagged[tag].discard(node['id'])
+        self.tag_changed(tag)
+
+    # call after replacing the tags attribute of node
+    def node_changed(self, node):
+        if self.tagged is not None:
+            for tag, ids in self.tagged.items():
+                if node['id'] in ids and tag not in (node.get('tags') or ()):
+                    ids.discard(node['id'])
+                    self.tag_changed(tag)
+        for tag in node.get('tags') or ():
+            self.add(node, tag)
+
+    # call when nodes enter or leave the tree
+    def nodes_added(self, nodes):
+        for node in nodes:
+            for tag in node.get('tags') or ():
+                self.add(node, tag)
+        self.structure_changed()
+
+    def nodes_removed(self, nodes):
+        for node in nodes:
+            for tag in node.get('tags') or ():
+                self.remove(node, tag)
+        self.structure_changed()
+
+    def tag_changed(self, tag):
+        self.closures.pop(tag, None)
+        self.version += 1
+
+    # call when parents change
+    def structure_changed(self):
+        for tag, (scope, _) in list(self.closures.items()):
+            if scope != 'node':
+                del self.closures[tag]
+        self.version += 1
+
+    # ids of the nodes which have tag with the given scope. Don't modify.
+    def closure(self, tag, scope):
+        cached = self.closures.get(tag)
+        if cached is not None and cached[0] == scope:
+            return cached[1]
+        tagged = self.tagged_ids(tag)
+        if scope == 'subtree':
+            ids = set()
+            for node_id in tagged:
+                if node_id in ids or node_id not in self.node_dict:
+                    continue
+                stack = [self.node_dict[node_id]]
+                while stack:
+                    node = stack.pop()
+                    ids.add(node['id'])
+                    stack.extend(child for child in node.get('children', []) if child['id'] not in ids)
+        elif scope == 'ancestry':
+            ids = set()
+            for node_id in tagged:
+                node = self.node_dict.get(node_id)
+                while node is not None and node['id'] not in ids:
+                    ids.add(node['id'])
+                    node = self.node_dict.get(node.get('parent_id'))
+        else:
+            ids = {node_id for node_id in tagged if node_id in self.node_dict}
+        self.closures[tag] = (scope, ids)
+        return ids
@@ -34,6 +34,49 @@ def apply_diff(old_text, position, diff):
     return old_text[:position - len(diff[1])] + old_text[position:]
 
 
+# given edits [(start, end, text)] recorded by TextAware in a textbox filled with the ancestry's text, each replacing
+# [start, end) of the text left by the edits before it, and the (start, end) indices of the ancestors' text
+# (model.ancestor_text_indices), applies the edits to the ancestors they touch and returns the modified ancestors, or
+# None if the indices don't match the ancestors' text. An insertion at the boundary of two nodes goes into the later
+# one, like in distribute_textbox_changes
+def apply_textbox_edits(edits, ancestry, offsets):
+    # {ancestor index: edited text}
+    texts = {}
+
+    # start of ancestor i in the edited text
+    def start_of(i):
+        return offsets[i][0] + sum(len(text) - len(ancestry[j]['text']) for j, text in texts.items() if j < i)
+
+    for edit_start, edit_end, text in edits:
+        # last ancestor starting at or before edit_start
+        low, high = 0, len(ancestry)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if start_of(middle) <= edit_start:
+                low = middle
+            else:
+                high = middle
+        i = low
+        node_start = start_of(i)
+        while i < len(ancestry) and (i == low or node_start < edit_end):
+            if i not in texts:
+                if len(ancestry[i]['text']) != offsets[i][1] - offsets[i][0]:
+                    return None
+                texts[i] = ancestry[i]['text']
+            node_text = texts[i]
+            cut_start = min(max(edit_start - node_start, 0), len(node_text))
+            cut_end = min(max(edit_end - node_start, 0), len(node_text))
+            texts[i] = node_text[:cut_start] + (text if i == low else '') + node_text[cut_end:]
+            node_start += len(node_text)
+            i += 1
+    changed_ancestors = []
+    for i in sorted(texts):
+        if ancestry[i]['text'] != texts[i]:
+            ancestry[i]['text'] = texts[i]
+            changed_ancestors.append(ancestry[i])
+    return changed_ancestors
+
+
 # given a new textbox state and node ancestry, computes changes to nodes in ancestry
 # and returns a list of modified ancestors
 def distribute_textbox_changes(new_text, ancestry):
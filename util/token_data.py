@@ -0,0 +1,203 @@
+import base64
+import math
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+"""
+Columnar token logprob data.
+
+The formatters in gpt.py used to produce one dict per token ({'generatedToken': {'token', 'logprob'},
+'position': {'start', 'end'}, 'counterfactuals': {token: logprob}}), several hundred bytes of Python objects per token.
+TokenData keeps the tokens of one prompt or completion in parallel arrays instead:
+
+    vocab                     every distinct token string (generated or counterfactual), once
+    token_ids                 int32 index into vocab of each generated token
+    logprobs                  float32 logprob of each generated token, NaN where the API returned none
+    starts, ends              int32 character offsets of each token
+    counterfactual_ids        int32 (tokens, k) matrix of vocab indices of the top k alternatives, -1 past the end
+    counterfactual_logprobs   float32 (tokens, k) matrix of their logprobs
+
+It is a Sequence whose items are read-only dict views in the old format, so code that indexes or iterates tokens
+and reads token_data['generatedToken']['logprob'], token_data['position']['start'] or token_data['counterfactuals']
+works unchanged. Each view builds its dicts when they are read.
+
+In JSON (the responses sidecar) TokenData is written as {'__token_data__': ...} with its arrays base64 encoded, see
+token_data_json and token_data_hook.
+"""
+
+
+class TokenData(Sequence):
+    __slots__ = ('vocab', 'token_ids', 'logprobs', 'starts', 'ends', 'counterfactual_ids', 'counterfactual_logprobs',
+                 'has_counterfactuals')
+
+    # tokens, logprobs, starts and ends are parallel lists. counterfactuals, if given, is a parallel list of
+    # {token: logprob} dicts (or None), in the order they should be read back.
+    def __init__(self, tokens, logprobs, starts, ends, counterfactuals=None):
+        vocab_index = {}
+        self.token_ids = np.fromiter((vocab_index.setdefault(token, len(vocab_index)) for token in tokens),
+                                     dtype=np.int32, count=len(tokens))
+        self.logprobs = np.array([math.nan if logprob is None else logprob for logprob in logprobs], dtype=np.float32)
+        self.starts = np.array(starts, dtype=np.int32)
+        self.ends = np.array(ends, dtype=np.int32)
+        self.has_counterfactuals = counterfactuals is not None
+        k = max((len(c) for c in counterfactuals if c), default=0) if counterfactuals else 0
+        self.counterfactual_ids = np.full((len(tokens), k), -1, dtype=np.int32)
+        self.counterfactual_logprobs = np.full((len(tokens), k), math.nan, dtype=np.float32)
+        for i, alternatives in enumerate(counterfactuals or []):
+            if not alternatives:
+                continue
+            self.counterfactual_ids[i, :len(alternatives)] = [vocab_index.setdefault(token, len(vocab_index))
+                                                              for token in alternatives]
+            self.counterfactual_logprobs[i, :len(alternatives)] = list(alternatives.values())
+        self.vocab = list(vocab_index)
+
+    # From a list of token dicts in the old format
+    @classmethod
+    def from_dicts(cls, token_dicts):
+        tokens, logprobs, starts, ends, counterfactuals = [], [], [], [], []
+        for token_dict in token_dicts:
+            token = token_dict['generatedToken']['token']
+            position = token_dict['position']
+            if not isinstance(position, dict):
+                # older OpenAI responses stored only the end offset
+                position = {'start': position - len(token), 'end': position}
+            tokens.append(token)
+            logprobs.append(token_dict['generatedToken']['logprob'])
+            starts.append(position['start'])
+            ends.append(position['end'])
+            counterfactuals.append(token_dict.get('counterfactuals'))
+        has_counterfactuals = any(c is not None for c in counterfactuals)
+        return cls(tokens, logprobs, starts, ends, counterfactuals if has_counterfactuals else None)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [TokenView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        return TokenView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TokenView(self, i)
+
+    def token(self, i):
+        return self.vocab[self.token_ids[i]]
+
+    def logprob(self, i):
+        logprob = float(self.logprobs[i])
+        return None if math.isnan(logprob) else logprob
+
+    def counterfactuals(self, i):
+        if not self.has_counterfactuals:
+            return None
+        return {self.vocab[token_id]: float(logprob)
+                for token_id, logprob in zip(self.counterfactual_ids[i].tolist(), self.counterfactual_logprobs[i].tolist())
+                if token_id >= 0}
+
+    def to_dicts(self):
+        return [dict(token_view) for token_view in self]
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.token_ids, self.logprobs, self.starts, self.ends,
+                                              self.counterfactual_ids, self.counterfactual_logprobs))
+
+    def to_json(self):
+        encode = lambda array: base64.b64encode(array.astype(array.dtype.newbyteorder('<')).tobytes()).decode('ascii')
+        return {'__token_data__': {'vocab': self.vocab,
+                                   'k': self.counterfactual_ids.shape[1],
+                                   'has_counterfactuals': self.has_counterfactuals,
+                                   'token_ids': encode(self.token_ids),
+                                   'logprobs': encode(self.logprobs),
+                                   'starts': encode(self.starts),
+                                   'ends': encode(self.ends),
+                                   'counterfactual_ids': encode(self.counterfactual_ids),
+                                   'counterfactual_logprobs': encode(self.counterfactual_logprobs)}}
+
+    @classmethod
+    def from_json(cls, data):
+        decode = lambda key, dtype: np.frombuffer(base64.b64decode(data[key]), dtype=np.dtype(dtype).newbyteorder('<'))\
+            .astype(dtype)
+        token_data = cls.__new__(cls)
+        token_data.vocab = data['vocab']
+        token_data.has_counterfactuals = data['has_counterfactuals']
+        token_data.token_ids = decode('token_ids', np.int32)
+        token_data.logprobs = decode('logprobs', np.float32)
+        token_data.starts = decode('starts', np.int32)
+        token_data.ends = decode('ends', np.int32)
+        shape = (len(token_data.token_ids), data['k'])
+        token_data.counterfactual_ids = decode('counterfactual_ids', np.int32).reshape(shape)
+        token_data.counterfactual_logprobs = decode('counterfactual_logprobs', np.float32).reshape(shape)
+        return token_data
+
+    def __repr__(self):
+        return f'TokenData({len(self)} tokens, top {self.counterfactual_ids.shape[1]})'
+
+
+# Read-only view of one token in the old dict format
+class TokenView(Mapping):
+    __slots__ = ('data', 'index')
+    KEYS = ('generatedToken', 'position', 'counterfactuals')
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __getitem__(self, key):
+        data, i = self.data, self.index
+        if key == 'generatedToken':
+            return {'token': data.token(i), 'logprob': data.logprob(i)}
+        if key == 'position':
+            return {'start': int(data.starts[i]), 'end': int(data.ends[i])}
+        if key == 'counterfactuals':
+            return data.counterfactuals(i)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# Start offsets of tokens, which may be TokenData or a list of token dicts
+def token_starts(tokens):
+    if isinstance(tokens, TokenData):
+        return tokens.starts.tolist()
+    return [token_data['position']['start'] for token_data in tokens]
+
+
+# json.dumps(..., default=token_data_json)
+def token_data_json(obj):
+    if isinstance(obj, TokenData):
+        return obj.to_json()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+# json.loads(..., object_hook=token_data_hook)
+def token_data_hook(obj):
+    if '__token_data__' in obj:
+        return TokenData.from_json(obj['__token_data__'])
+    return obj
+
+
+# Replaces lists of token dicts in a formatted response (saved before TokenData) with TokenData, in place
+def compact_response(response):
+    parts = list(response.get('completions') or [])
+    if isinstance(response.get('prompt'), dict):
+        parts.append(response['prompt'])
+    for part in parts:
+        if isinstance(part.get('tokens'), list) and part['tokens']:
+            part['tokens'] = TokenData.from_dicts(part['tokens'])
+    return response
@@ -1,20 +1,88 @@
-from transformers import GPT2Tokenizer
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
-tok = None
+# The GPT-2 tokenizer is loaded once per process, on first use, and shared between threads.
+# Encoded strings are kept in an LRU cache because the same prompts and tokens are tokenized repeatedly.
 
+ENCODE_CACHE_SIZE = 8192
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+# {text: tuple(token ids)}, most recently used last
+_encode_cache = OrderedDict()
+_encode_cache_lock = threading.Lock()
+_encode_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import GPT2Tokenizer
+                _tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+    return _tokenizer
+
+
+def _cache_get(text):
+    with _encode_cache_lock:
+        ids = _encode_cache.get(text)
+        if ids is None:
+            _encode_cache_stats['misses'] += 1
+            return None
+        _encode_cache.move_to_end(text)
+        _encode_cache_stats['hits'] += 1
+        return ids
+
+
+def _cache_put(text, ids):
+    with _encode_cache_lock:
+        _encode_cache[text] = ids
+        _encode_cache.move_to_end(text)
+        while len(_encode_cache) > ENCODE_CACHE_SIZE:
+            _encode_cache.popitem(last=False)
+
+
+def encode_cache_info():
+    with _encode_cache_lock:
+        return {**_encode_cache_stats, 'size': len(_encode_cache), 'max_size': ENCODE_CACHE_SIZE}
+
+
+def clear_encode_cache():
+    with _encode_cache_lock:
+        _encode_cache.clear()
+        _encode_cache_stats['hits'] = 0
+        _encode_cache_stats['misses'] = 0
+
+
+# Returns a list of token ids for a string, or a list of lists for a list of strings
 def tokenize(input):
-    tokenizer = tok if tok else GPT2Tokenizer.from_pretrained("gpt2")
-    return tokenizer(input)['input_ids']
+    if isinstance(input, str):
+        return tokenize_batch([input])[0]
+    return tokenize_batch(input)
+
+
+# Tokenizes a list of strings, encoding all cache misses in a single tokenizer call
+def tokenize_batch(texts):
+    results = [_cache_get(text) for text in texts]
+    missing = list(dict.fromkeys(text for text, ids in zip(texts, results) if ids is None))
+    if missing:
+        encoded = {text: tuple(ids) for text, ids in zip(missing, get_tokenizer()(missing)['input_ids'])}
+        for text, ids in encoded.items():
+            _cache_put(text, ids)
+        results = [ids if ids is not None else encoded[text] for text, ids in zip(texts, results)]
+    return [list(ids) for ids in results]
 
 
 def detokenize(tokens):
-    tokenizer = tok if tok else GPT2Tokenizer.from_pretrained("gpt2")
-    return tokenizer.convert_tokens_to_string(tokens)
+    return get_tokenizer().convert_tokens_to_string(tokens)
 
 
+@lru_cache(maxsize=ENCODE_CACHE_SIZE)
 def token_to_word(token):
-    tokenizer = tok if tok else GPT2Tokenizer.from_pretrained("gpt2")
-    return tokenizer.convert_ids_to_tokens([token])[0]
+    return get_tokenizer().convert_ids_to_tokens([token])[0]
 
 
 def logit_mask(mask):
@@ -25,4 +93,4 @@ def logit_mask(mask):
         else:
             token_id = tokenize([token])[0][0]
         id_mask[token_id] = mask[token]
-    return id_mask
\ No newline at end of file
+    return id_mask
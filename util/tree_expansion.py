@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Spaces out request starts so that no more than requests_per_second are sent to one backend
+class RateLimiter:
+    def __init__(self, requests_per_second=None):
+        self.min_interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_start = 0
+        self.lock = threading.Lock()
+
+    def wait(self, cancel_event=None):
+        if not self.min_interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        delay = start - now
+        if delay > 0:
+            if cancel_event:
+                cancel_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+# {backend key: RateLimiter}, shared by all expansions so that concurrent expansions respect the same limit
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def backend_rate_limiter(key, requests_per_second=None):
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None or limiter.min_interval != (1 / requests_per_second if requests_per_second else 0):
+            limiter = RateLimiter(requests_per_second)
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+class ExpansionCancelled(Exception):
+    pass
+
+
+"""
+Expands a tree breadth first. Every node in a frontier level is requested concurrently on a bounded worker pool,
+then results are applied in frontier order before the next level starts.
+
+    prepare(frontier) -> list of handles, one per frontier node, e.g. placeholder children (expansion thread)
+    request(node) -> result (worker threads; this is where the model is called)
+    apply(node, handle, result) -> list of new nodes to expand in the next level (expansion thread)
+    on_level(level, frontier, stats) -> progress callback after each level (expansion thread)
+"""
+class TreeExpansion:
+    def __init__(self, request, apply, prepare=None, max_depth=3, stop_condition=None, max_workers=4,
+                 rate_limiter=None, on_level=None):
+        self.request = request
+        self.apply = apply
+        self.prepare = prepare
+        self.max_depth = max_depth
+        self.stop_condition = stop_condition
+        self.max_workers = max(1, max_workers)
+        self.rate_limiter = rate_limiter
+        self.on_level = on_level
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'levels': 0,
+                      'requests': 0,
+                      'failed': 0,
+                      'cancelled': False,
+                      'wall_time': 0,
+                      # sum of request latencies, i.e. roughly the wall time of expanding one node at a time
+                      'sequential_time': 0}
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def timed_request(self, node):
+        if self.rate_limiter:
+            self.rate_limiter.wait(self.cancel_event)
+        if self.cancelled:
+            raise ExpansionCancelled()
+        start = time.perf_counter()
+        try:
+            return self.request(node)
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.stats['sequential_time'] += duration
+
+    def run(self, root):
+        try:
+            return self.expand(root)
+        finally:
+            self.done.set()
+
+    def expand(self, root):
+        start = time.perf_counter()
+        frontier = [root]
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tree-expansion') as executor:
+            for level in range(self.max_depth):
+                if self.stop_condition:
+                    frontier = [node for node in frontier if not self.stop_condition(node)]
+                if not frontier or self.cancelled:
+                    break
+                handles = self.prepare(frontier) if self.prepare else [None] * len(frontier)
+                futures = [executor.submit(self.timed_request, node) for node in frontier]
+                next_frontier = []
+                for node, handle, future in zip(frontier, handles, futures):
+                    try:
+                        result = future.result()
+                        self.stats['requests'] += 1
+                    except ExpansionCancelled as e:
+                        result = e
+                    except Exception as e:
+                        print(f'tree expansion request failed: {e}')
+                        self.stats['requests'] += 1
+                        self.stats['failed'] += 1
+                        result = e
+                    next_frontier.extend(self.apply(node, handle, result) or [])
+                self.stats['levels'] += 1
+                if self.on_level:
+                    self.on_level(level, next_frontier, self.stats)
+                frontier = next_frontier
+        self.stats['cancelled'] = self.cancelled
+        self.stats['wall_time'] = time.perf_counter() - start
+        return self.stats
+
+
+def expansion_report(stats):
+    speedup = stats['sequential_time'] / stats['wall_time'] if stats['wall_time'] else 0
+    return f"{stats['requests']} requests in {stats['levels']} levels: {stats['wall_time']:.2f}s wall time, " \
+           f"{stats['sequential_time']:.2f}s sequential ({speedup:.1f}x)" \
+           + (' (cancelled)' if stats['cancelled'] else '')
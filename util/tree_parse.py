@@ -0,0 +1,108 @@
+import gc
+import json
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+Fast tree file parsing.
+
+Tree files are parsed with orjson when it is installed, otherwise (or if orjson rejects the file, e.g. for NaN
+values) with the json module. Both parsers recurse once per level of nesting, and a tree nests two levels per node, so
+parsing runs on a thread with a large stack (and, for json, a raised recursion limit) to open deep trees. That thread
+is started on first use and kept, so the process wide thread stack size is only changed once.
+"""
+
+PARSE_STACK_SIZE = 1 << 29
+
+
+# Parsing allocates a container per node and value, which triggers cyclic garbage collections that traverse everything
+# allocated so far. None of it is garbage, so collection is paused while a tree is built.
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+_parse_lock = threading.Lock()
+# queue of (func, args, result, done) for the parse thread, None until it is started
+_parse_calls = None
+
+
+def parse_thread_calls():
+    global _parse_calls
+    with _parse_lock:
+        if _parse_calls is None:
+            calls = queue.Queue()
+
+            def work():
+                while True:
+                    func, args, result, done = calls.get()
+                    try:
+                        result['value'] = func(*args)
+                    except BaseException as e:
+                        result['error'] = e
+                    done.set()
+
+            # threading.stack_size is process wide, so it is changed once, for the one parse thread. Threads started
+            # meanwhile by other modules may get the large stack too, which only costs address space.
+            old_stack_size = threading.stack_size()
+            threading.stack_size(PARSE_STACK_SIZE)
+            try:
+                threading.Thread(target=work, name='tree-parse', daemon=True).start()
+            finally:
+                threading.stack_size(old_stack_size)
+            _parse_calls = calls
+        return _parse_calls
+
+
+# Calls func(*args) on the parse thread, which has a PARSE_STACK_SIZE stack, and returns its result
+def call_with_deep_stack(func, *args):
+    result = {}
+    done = threading.Event()
+    parse_thread_calls().put((func, args, result, done))
+    done.wait()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def json_loads_deep(data):
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, 1000000))
+    try:
+        return json.loads(data)
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+
+def json_loads(data):
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN and Infinity, which json.dumps writes (e.g. in logprobs)
+            pass
+    return json_loads_deep(data)
+
+
+def parse_tree_json(data):
+    with gc_paused():
+        return call_with_deep_stack(json_loads, data)
+
+
+# Returns the data in a tree file
+def read_tree_file(filename):
+    with open(filename, 'rb') as f:
+        return parse_tree_json(f.read())
@@ -0,0 +1,306 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from util.util_tree import preorder
+from util.frames_util import copy_frame
+from util.tree_parse import read_tree_file
+
+"""
+Tree saving off the UI thread.
+
+tree_snapshot copies the tree on the UI thread: a dict of each node's fields, with nested dicts and lists (meta, tags,
+generation, ...) copied too, plus the ids of its children, and copies of the other top-level values. That is much
+cheaper than serializing it, and nothing the saver thread encodes can change under it. A TreeSaver then writes snapshots on its own thread, one at a time. A save requested
+while another one for the same file is waiting replaces it.
+
+Full saves stream JSON to a temporary file in the same directory, flush it to disk and rename it over the tree file,
+so a crash or failed save never leaves a partial tree file. Nodes are written one at a time without recursion and
+model_responses one response at a time.
+
+Journal saves append one line to <tree file>.journal with only the nodes, responses and other top-level values that
+changed since the last save. Nodes are compared by their encoded fields and children ids. The first line of the
+journal records the size and modification time of the tree file it applies to. load_tree_file replays it. After
+compact_every journal saves, or once the journal is half the size of the tree file, the next save is a full save,
+which removes the journal.
+
+Tree files are read through util/tree_parse.py.
+"""
+
+JOURNAL_SUFFIX = '.journal'
+COMPACT_EVERY = 50
+
+
+def journal_filename(filename):
+    return filename + JOURNAL_SUFFIX
+
+
+def tree_snapshot(tree):
+    nodes = []
+    for node in preorder(tree['root']):
+        nodes.append(({key: copy_frame(value) if isinstance(value, (dict, list)) else value
+                       for key, value in node.items() if key != 'children'},
+                      [child['id'] for child in node.get('children', [])]))
+    values = {key: copy_frame(value) for key, value in tree.items() if key != 'root'}
+    return {'values': values, 'nodes': nodes}
+
+
+# Returns [(node id, fields json without braces, children ids)] in preorder
+def encode_nodes(snapshot):
+    return [(fields.get('id'), json.dumps(fields)[1:-1], child_ids) for fields, child_ids in snapshot['nodes']]
+
+
+def node_hash(fields_json, child_ids):
+    return hash((fields_json, tuple(child_ids)))
+
+
+def iter_tree_json(values, encoded_nodes):
+    yield '{'
+    for key, value in values.items():
+        if isinstance(value, dict) and value:
+            # one item at a time, model_responses is often most of the file
+            separator = f'{json.dumps(key)}: {{'
+            for item_key, item in value.items():
+                yield separator + json.dumps({item_key: item})[1:-1]
+                separator = ', '
+            yield '}, '
+        else:
+            yield f'{json.dumps(key)}: {json.dumps(value)}, '
+    yield '"root": '
+    # children still to be written for each open node
+    remaining = []
+    for _, fields_json, child_ids in encoded_nodes:
+        chunk = '{' + fields_json + (', ' if fields_json else '') + '"children": ['
+        if child_ids:
+            remaining.append(len(child_ids))
+            yield chunk
+            continue
+        chunk += ']}'
+        while remaining:
+            remaining[-1] -= 1
+            if remaining[-1]:
+                chunk += ', '
+                break
+            remaining.pop()
+            chunk += ']}'
+        yield chunk
+    yield '}'
+
+
+# Writes chunks to filename atomically. If backup_filename is given, the file being replaced is kept there.
+def write_atomic(filename, chunks, backup_filename=None):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix=f'.{os.path.basename(filename)}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if backup_filename and os.path.isfile(filename):
+            try:
+                os.link(filename, backup_filename)
+            except OSError:
+                shutil.copy2(filename, backup_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def write_tree(filename, snapshot, backup_filename=None):
+    encoded = encode_nodes(snapshot)
+    write_atomic(filename, iter_tree_json(snapshot['values'], encoded), backup_filename)
+    return encoded
+
+
+# What was last written to a tree file, used to find changes for journal saves
+class SavedState:
+    def __init__(self, snapshot, encoded):
+        self.node_hashes = {node_id: node_hash(fields_json, child_ids) for node_id, fields_json, child_ids in encoded}
+        self.value_hashes = {key: hash(json.dumps(value)) for key, value in snapshot['values'].items()
+                             if key != 'model_responses'}
+        self.response_ids = set(snapshot['values'].get('model_responses', {}) or {})
+        self.journal_saves = 0
+
+
+class TreeSaver:
+    def __init__(self, compact_every=COMPACT_EVERY):
+        self.compact_every = compact_every
+        self.condition = threading.Condition()
+        # {filename: job}, in request order
+        self.pending = {}
+        self.busy = False
+        # {filename: SavedState}
+        self.saved = {}
+        # {filename: error of its last save}
+        self.errors = {}
+        self.thread = None
+        self.stats = {'full_saves': 0, 'journal_saves': 0, 'failed': 0, 'coalesced': 0, 'last_save_time': 0}
+
+    def save(self, filename, snapshot, backup_filename=None, journal=False, on_done=None):
+        with self.condition:
+            job = {'filename': filename, 'snapshot': snapshot, 'backup_filename': backup_filename,
+                   'journal': journal, 'on_done': [on_done] if on_done else []}
+            old_job = self.pending.pop(filename, None)
+            if old_job:
+                self.stats['coalesced'] += 1
+                job['backup_filename'] = old_job['backup_filename'] or backup_filename
+                job['journal'] = old_job['journal'] and journal
+                job['on_done'] = old_job['on_done'] + job['on_done']
+            self.pending[filename] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='tree-saver', daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    # Waits until every requested save has been written
+    def flush(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.pending, timeout=5):
+                    self.thread = None
+                    return
+                filename = next(iter(self.pending))
+                job = self.pending.pop(filename)
+                self.busy = True
+            try:
+                start = time.perf_counter()
+                self.write(job)
+                self.stats['last_save_time'] = time.perf_counter() - start
+                self.errors.pop(filename, None)
+                for on_done in job['on_done']:
+                    on_done()
+            except Exception as e:
+                self.stats['failed'] += 1
+                self.errors[filename] = e
+                # next save is a full save
+                self.saved.pop(filename, None)
+                print(f'ERROR saving {filename}: {e}')
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def write(self, job):
+        filename, snapshot = job['filename'], job['snapshot']
+        saved = self.saved.get(filename)
+        if job['journal'] and saved and not job['backup_filename'] and os.path.isfile(filename) \
+                and saved.journal_saves < self.compact_every \
+                and self.journal_size(filename) < os.path.getsize(filename) / 2:
+            self.write_journal(filename, snapshot, saved)
+            return
+        encoded = write_tree(filename, snapshot, job['backup_filename'])
+        if os.path.exists(journal_filename(filename)):
+            os.remove(journal_filename(filename))
+        self.saved[filename] = SavedState(snapshot, encoded)
+        self.stats['full_saves'] += 1
+
+    def journal_size(self, filename):
+        journal = journal_filename(filename)
+        return os.path.getsize(journal) if os.path.exists(journal) else 0
+
+    def write_journal(self, filename, snapshot, saved):
+        record = {'time': time.time(), 'root_id': snapshot['nodes'][0][0]['id'], 'nodes': {}, 'deleted': [],
+                  'values': {}, 'deleted_values': [], 'model_responses': {}, 'deleted_model_responses': []}
+        node_hashes = {}
+        for (fields, child_ids), (node_id, fields_json, _) in zip(snapshot['nodes'], encode_nodes(snapshot)):
+            node_hashes[node_id] = node_hash(fields_json, child_ids)
+            if saved.node_hashes.get(node_id) != node_hashes[node_id]:
+                record['nodes'][node_id] = {**fields, 'children': child_ids}
+        record['deleted'] = [node_id for node_id in saved.node_hashes if node_id not in node_hashes]
+
+        values = snapshot['values']
+        value_hashes = {}
+        for key, value in values.items():
+            if key == 'model_responses':
+                continue
+            value_hashes[key] = hash(json.dumps(value))
+            if saved.value_hashes.get(key) != value_hashes[key]:
+                record['values'][key] = value
+        record['deleted_values'] = [key for key in saved.value_hashes if key not in value_hashes]
+        responses = values.get('model_responses') or {}
+        record['model_responses'] = {key: response for key, response in responses.items()
+                                     if key not in saved.response_ids}
+        record['deleted_model_responses'] = [key for key in saved.response_ids if key not in responses]
+
+        journal = journal_filename(filename)
+        with open(journal, 'a', encoding='utf-8') as f:
+            if f.tell() == 0:
+                stat = os.stat(filename)
+                f.write(json.dumps({'base': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}}) + '\n')
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        saved.node_hashes = node_hashes
+        saved.value_hashes = value_hashes
+        saved.response_ids = set(responses)
+        saved.journal_saves += 1
+        self.stats['journal_saves'] += 1
+
+
+# Applies the journal of filename to tree, the data loaded from filename. Returns the number of records applied.
+def apply_journal(tree, filename):
+    journal = journal_filename(filename)
+    if not os.path.isfile(journal):
+        return 0
+    with open(journal, encoding='utf-8') as f:
+        lines = f.readlines()
+    try:
+        base = json.loads(lines[0])['base']
+    except (IndexError, ValueError, KeyError):
+        print(f'ignoring unreadable journal {journal}')
+        return 0
+    stat = os.stat(filename)
+    if base != {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}:
+        print(f'ignoring journal {journal}, {filename} was written after it')
+        return 0
+    node_dict = {node['id']: node for node in preorder(tree['root'])}
+    applied = 0
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # last record was cut off
+            break
+        known = set(node_dict) | set(record['nodes'])
+        if record['root_id'] not in known or \
+                any(child_id not in known for node in record['nodes'].values() for child_id in node['children']):
+            print(f'journal {journal} is inconsistent with {filename}, stopped after {applied} records')
+            break
+        for node_id, fields in record['nodes'].items():
+            node = node_dict.setdefault(node_id, {})
+            node.clear()
+            node.update(fields)
+        for node_id, fields in record['nodes'].items():
+            node_dict[node_id]['children'] = [node_dict[child_id] for child_id in fields['children']]
+        for node_id in record['deleted']:
+            node_dict.pop(node_id, None)
+        tree['root'] = node_dict[record['root_id']]
+        tree.update(record['values'])
+        for key in record['deleted_values']:
+            tree.pop(key, None)
+        if record['model_responses'] or record['deleted_model_responses']:
+            responses = tree.setdefault('model_responses', {})
+            responses.update(record['model_responses'])
+            for key in record['deleted_model_responses']:
+                responses.pop(key, None)
+        applied += 1
+    return applied
+
+
+def load_tree_file(filename):
+    tree = read_tree_file(filename)
+    if 'root' in tree:
+        applied = apply_journal(tree, filename)
+        if applied:
+            print(f'applied {applied} journal saves to {filename}')
+    return tree
@@ -15,14 +15,85 @@ def new_node(node_id=None, text='', mutable=True):
     return node
 
 
+#################################
+#   Traversal
+#################################
+
+# The traversals below use explicit stacks and yield nodes lazily, so they work on chains of any depth.
+# Children are visited in order (reversed if reverse=True). filter(child) excludes a child and its subtree, the
+# root is always visited. max_depth is the number of levels visited: 1 visits only the root, 0 nothing, None all.
+# Children lists are read when a node's children are about to be visited, so consumers may edit a node they have
+# just received, including its children list.
+
+# Yields (node, parent, depth below root) in preorder
+def walk(root, filter=None, max_depth=None, reverse=False):
+    if max_depth == 0:
+        return
+    stack = [(root, None, 0)]
+    while stack:
+        node, parent, level = stack.pop()
+        yield node, parent, level
+        if max_depth is None or level + 1 < max_depth:
+            children = filtered_children(node, filter) if filter else node.get('children', [])
+            stack.extend((child, node, level + 1) for child in (children if reverse else reversed(children)))
+
+
+def preorder(root, filter=None, max_depth=None, reverse=False):
+    if filter is None and max_depth is None:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            yield node
+            children = node.get('children')
+            if children:
+                stack.extend(children if reverse else reversed(children))
+        return
+    for node, _, _ in walk(root, filter, max_depth, reverse):
+        yield node
+
+
+# Yields each node after all of its descendants
+def postorder(root, filter=None, max_depth=None):
+    if max_depth == 0:
+        return
+    stack = [(root, 0, False)]
+    while stack:
+        node, level, expanded = stack.pop()
+        if expanded:
+            yield node
+            continue
+        stack.append((node, level, True))
+        if max_depth is None or level + 1 < max_depth:
+            children = filtered_children(node, filter) if filter else node.get('children', [])
+            stack.extend((child, level + 1, False) for child in reversed(children))
+
+
+# Copies the tree below root keeping only ids and children, plus copy_attributes
+def copy_tree(root, filter=None, max_depth=None, copy_attributes=()):
+    copies = {}
+    for node, parent, _ in walk(root, filter, max_depth):
+        copy = {'id': node['id'], 'children': []}
+        for attribute in copy_attributes:
+            if attribute in node:
+                copy[attribute] = node[attribute]
+        copies[id(node)] = copy
+        if parent is not None:
+            copies[id(parent)]['children'].append(copy)
+    return copies[id(root)]
+
+
 # Height of d, root has the greatest height, minimum is 1
 def height(d):
-    return 1 + max([0, *[height(c) for c in d["children"]]])
+    return 1 + max(level for _, _, level in walk(d))
 
 
 # Depth of d, root is 0 depth
 def depth(d, node_dict):
-    return 0 if "parent_id" not in d else (1 + depth(node_dict[d["parent_id"]], node_dict))
+    level = 0
+    while "parent_id" in d:
+        d = node_dict[d["parent_id"]]
+        level += 1
+    return level
 
 
 def num_descendents(root, filter=None):
@@ -46,55 +117,54 @@ def antifiltered_children(self, node, filter=None):
 
 
 def subtree_list(root, filter=None, depth_limit=None):
-    if depth_limit == 0:
-        return []
-    sub_list = [root]
-    children = filtered_children(root, filter)
-    for child in children:
-        sub_list += subtree_list(child, filter, depth_limit - 1 if depth_limit else None)
-    return sub_list
+    return list(preorder(root, filter, depth_limit))
 
 
 def depth_limited_tree(root, depth_limit):
-    new_root = {'id': root['id'], 'children': []}
-    if depth_limit == 0:
-        return new_root
-    if 'children' in root:
-        for child in root['children']:
-            new_root['children'].append(depth_limited_tree(child, depth_limit - 1))
-    return new_root
+    return copy_tree(root, max_depth=depth_limit + 1)
 
 
 def limited_branching_tree(ancestry, root, depth_limit):
     # returns a subset of tree which only contains nodes no more than depth_limit levels from a node in ancestry
-    if len(ancestry) <= 1:
-        return depth_limited_tree(root, depth_limit)
-    child_in_ancestry = ancestry[1]
     new_root = {'id': root['id'], 'children': []}
-    for child in root['children']:
-        if child['id'] == child_in_ancestry['id']:
-            new_root['children'].append(limited_branching_tree(ancestry[1:], child, depth_limit))
-        elif depth_limit > 0:
-            new_root['children'].append(depth_limited_tree(child, depth_limit-1))
+    new_node, node = new_root, root
+    for child_in_ancestry in ancestry[1:]:
+        next_node = next_new_node = None
+        for child in node['children']:
+            if child['id'] == child_in_ancestry['id']:
+                next_node, next_new_node = child, {'id': child['id'], 'children': []}
+                new_node['children'].append(next_new_node)
+            elif depth_limit > 0:
+                new_node['children'].append(depth_limited_tree(child, depth_limit-1))
+        if next_node is None:
+            return new_root
+        new_node, node = next_new_node, next_node
+    new_node['children'] = depth_limited_tree(node, depth_limit)['children']
     return new_root
 
 # TODO option for no depth limit
 def collapsed_wavefunction(ancestry, root, current_node, depth_limit):
-    if len(ancestry) <= 1 or root['id'] == current_node['id']:
-        return depth_limited_tree(root, depth_limit)
-    child_in_ancestry = ancestry[1]
     new_root = {'id': root['id'], 'children': []}
-    for child in root['children']:
-        if child['id'] == child_in_ancestry['id']:
-            new_root['children'].append(collapsed_wavefunction(ancestry[1:], child, current_node, depth_limit))
+    new_node, node = new_root, root
+    for child_in_ancestry in ancestry[1:]:
+        if node['id'] == current_node['id']:
+            break
+        next_node = next((child for child in node['children'] if child['id'] == child_in_ancestry['id']), None)
+        if next_node is None:
+            return new_root
+        new_node['children'].append({'id': next_node['id'], 'children': []})
+        new_node, node = new_node['children'][-1], next_node
+    new_node['children'] = depth_limited_tree(node, depth_limit)['children']
     return new_root
 
-def limited_distance_tree(root, reference_node, distance_limit, node_dict):
-    condition = lambda node: path_distance(reference_node, node, node_dict) <= distance_limit
+# index is an AncestorIndex containing root's tree, built from root if not given
+def limited_distance_tree(root, reference_node, distance_limit, node_dict, index=None):
+    index = index if index is not None else AncestorIndex(root)
+    condition = lambda node: index.path_distance(reference_node, node) <= distance_limit
     if not condition(root):
         # root is node in reference node's ancestry distance_limit removed
-        ancestry = node_ancestry(reference_node, node_dict)
-        root = ancestry[-(distance_limit + 1)]
+        ancestor = index.ancestor(reference_node, distance_limit)
+        root = node_dict.get(ancestor['id'], ancestor)
     return tree_subset(root, condition)
 
 # given a root node and include condition, returns a new tree which contains only nodes who satisfy
@@ -109,16 +179,7 @@ def limited_distance_tree(root, reference_node, distance_limit, node_dict):
 def tree_subset(root, filter=None, copy_attributes=None):
     if not filter:
         return root
-    if not copy_attributes:
-        copy_attributes = []
-    new_root = {'id': root['id'], 'children': []}
-    if 'children' in root:
-        for child in filtered_children(root, filter):
-            new_root['children'].append(tree_subset(child, filter, copy_attributes))
-    for attribute in copy_attributes:
-        if attribute in root:
-            new_root[attribute] = root[attribute]
-    return new_root
+    return copy_tree(root, filter, copy_attributes=copy_attributes or ())
 
 
 def stochastic_transition(node, mode='descendents', filter=None):
@@ -160,9 +221,10 @@ def node_ancestry(node, node_dict):
     while "parent_id" in node:
         if node['parent_id'] in node_dict:
             node = node_dict[node["parent_id"]]
-            ancestry.insert(0, node)
+            ancestry.append(node)
         else:
             break
+    ancestry.reverse()
     return ancestry
 
 # returns node ancestry starting from root
@@ -203,22 +265,113 @@ def ancestry_plaintext(ancestry, text_callback=None):
     else:
         return "".join(ancestor_text_list(ancestry))
 
+def parent_in(node, node_dict):
+    return node_dict.get(node["parent_id"]) if "parent_id" in node else None
+
+# Number of ancestors of node in node_dict
+def ancestry_depth(node, node_dict):
+    depth = 0
+    node = parent_in(node, node_dict)
+    while node is not None:
+        depth += 1
+        node = parent_in(node, node_dict)
+    return depth
+
+# Returns (nearest common ancestor, its depth). Walks up from the deeper node to equal depth, then from both.
+# For repeated queries on an unchanging tree use AncestorIndex.
 def nearest_common_ancestor(node_a, node_b, node_dict):
-    ancestry_a = node_ancestry(node_a, node_dict)
-    ancestry_b = node_ancestry(node_b, node_dict)
-    #print('ancestry a:', [n['id'] for n in ancestry_a])
-    #print('ancestry b:', [n['id'] for n in ancestry_b])
-    for i in range(1, len(ancestry_a)):
-        if i > (len(ancestry_b) - 1) or ancestry_a[i] is not ancestry_b[i]:
-            return ancestry_a[i-1], i-1
-    return ancestry_a[-1], len(ancestry_a) - 1
+    depth_a = ancestry_depth(node_a, node_dict)
+    depth_b = ancestry_depth(node_b, node_dict)
+    while depth_a > depth_b:
+        node_a, depth_a = parent_in(node_a, node_dict), depth_a - 1
+    while depth_b > depth_a:
+        node_b, depth_b = parent_in(node_b, node_dict), depth_b - 1
+    while node_a is not node_b and depth_a > 0:
+        node_a, node_b, depth_a = parent_in(node_a, node_dict), parent_in(node_b, node_dict), depth_a - 1
+    return node_a, depth_a
 
 def path_distance(node_a, node_b, node_dict):
-    nca, _ = nearest_common_ancestor(node_a, node_b, node_dict)
-    #print('nca:', nca['id'])
-    a_distance = len(ancestry_in_range(nca, node_a, node_dict))
-    b_distance = len(ancestry_in_range(nca, node_b, node_dict))
-    return (a_distance - 1) + (b_distance - 1)
+    _, nca_depth = nearest_common_ancestor(node_a, node_b, node_dict)
+    depth_a = ancestry_depth(node_a, node_dict)
+    depth_b = ancestry_depth(node_b, node_dict)
+    return (depth_a - nca_depth) + (depth_b - nca_depth)
+
+
+"""
+Depth-annotated ancestor index over the tree below root, built in O(n log n).
+Nodes are looked up by id. Ancestor tests are O(1) using each node's preorder position and the position after its
+subtree (Euler tour). k-th ancestor,
+nearest common ancestor and path distance are O(log n) using binary lifting.
+Rebuild it after structural edits.
+"""
+class AncestorIndex:
+    def __init__(self, root):
+        # {node_id: position}
+        self.positions = {}
+        self.nodes = []
+        self.depths = []
+        # preorder position of the first node after each node's subtree
+        self.exit = []
+        parents = []
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            if node is None:
+                self.exit[parent] = len(self.nodes)
+                continue
+            i = len(self.nodes)
+            self.positions[node['id']] = i
+            self.nodes.append(node)
+            parents.append(parent if parent >= 0 else i)
+            self.depths.append(self.depths[parent] + 1 if parent >= 0 else 0)
+            self.exit.append(i + 1)
+            stack.append((None, i))
+            stack.extend((child, i) for child in reversed(node.get('children', [])))
+        # up[k][i] is the 2^k-th ancestor of i, or the root
+        self.up = [parents]
+        for _ in range(1, max(1, max(self.depths, default=0).bit_length())):
+            prev = self.up[-1]
+            self.up.append([prev[j] for j in prev])
+
+    def __contains__(self, node):
+        return node['id'] in self.positions
+
+    def depth(self, node):
+        return self.depths[self.positions[node['id']]]
+
+    # True if a is b or an ancestor of b
+    def is_ancestor(self, a, b):
+        i, j = self.positions[a['id']], self.positions[b['id']]
+        return i <= j < self.exit[i]
+
+    # Returns the ancestor k levels above node, or None
+    def ancestor(self, node, k):
+        i = self.positions[node['id']]
+        if k > self.depths[i]:
+            return None
+        level = 0
+        while k:
+            if k & 1:
+                i = self.up[level][i]
+            k >>= 1
+            level += 1
+        return self.nodes[i]
+
+    def nearest_common_ancestor(self, node_a, node_b):
+        i, j = self.positions[node_a['id']], self.positions[node_b['id']]
+        if i <= j < self.exit[i]:
+            return self.nodes[i]
+        if j <= i < self.exit[j]:
+            return self.nodes[j]
+        for level in reversed(range(len(self.up))):
+            k = self.up[level][i]
+            if not k <= j < self.exit[k]:
+                i = k
+        return self.nodes[self.up[0][i]]
+
+    def path_distance(self, node_a, node_b):
+        nca = self.nearest_common_ancestor(node_a, node_b)
+        return self.depth(node_a) + self.depth(node_b) - 2 * self.depth(nca)
 
 # Returns True if a is ancestor of b
 def in_ancestry(a, b, node_dict):
@@ -250,17 +403,20 @@ def get_inherited_attribute(attribute, node, tree_node_dict):
             return lineage_node[attribute]
     return None
 
-# recursively called on subtree
+# Sets attribute to new_value on node and its descendants, stopping at nodes whose value is neither old_value nor
+# new_value. Returns the nodes where it stopped.
 def overwrite_subtree(node, attribute, new_value, old_value=None, force_overwrite=False):
-    if force_overwrite or (attribute not in node) or old_value is None or (node[attribute] == old_value) \
-            or (node[attribute] == new_value):
-        node[attribute] = new_value
-        terminal_nodes_list = []
-        for child in node['children']:
-            terminal_nodes_list += overwrite_subtree(child, attribute, new_value, old_value, force_overwrite)
-        return terminal_nodes_list
-    else:
-        return [node]
+    terminal_nodes_list = []
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if force_overwrite or (attribute not in n) or old_value is None or (n[attribute] == old_value) \
+                or (n[attribute] == new_value):
+            n[attribute] = new_value
+            stack.extend(reversed(n['children']))
+        else:
+            terminal_nodes_list.append(n)
+    return terminal_nodes_list
 
 
 
@@ -274,19 +430,18 @@ def search(root, pattern, text=True, text_attribute_name='text', tags=False, cas
             or (filter_set is not None and root['id'] not in filter_set)\
             or max_depth == 0:
         return []
-    if text:
-        matches_iter = re.finditer(pattern, root[text_attribute_name]) if case_sensitive \
-            else re.finditer(pattern, root[text_attribute_name], re.IGNORECASE)
-        for match in matches_iter:
-            matches.append({'node_id': root['id'],
-                            'span': match.span(),
-                            'match': match.group()})
-    if tags:
-        # search for pattern in root['tags']
-        pass
-    for child in root['children']:
-        matches += search(child, pattern, text, text_attribute_name, tags, case_sensitive, regex, filter_set,
-                          max_depth-1 if max_depth else None)
+    filter = (lambda child: child['id'] in filter_set) if filter_set is not None else None
+    for node in preorder(root, filter, max_depth):
+        if text:
+            matches_iter = re.finditer(pattern, node[text_attribute_name]) if case_sensitive \
+                else re.finditer(pattern, node[text_attribute_name], re.IGNORECASE)
+            for match in matches_iter:
+                matches.append({'node_id': node['id'],
+                                'span': match.span(),
+                                'match': match.group()})
+        if tags:
+            # search for pattern in node['tags']
+            pass
     return matches
 
 
@@ -305,16 +460,14 @@ def search(root, pattern, text=True, text_attribute_name='text', tags=False, cas
 # }
 # Adds an ID field and a parent ID field to each dict in a recursive tree with "children"
 def flatten_tree(d, reverse=False):
-    if "id" not in d:
-        d["id"] = str(uuid.uuid1())
-
-    children = d.get("children", [])
-    flat_children = []
-    for child in (reversed(children) if reverse else children):
-        child["parent_id"] = d["id"]
-        flat_children.extend(flatten_tree(child, reverse))
-
-    return [d, *flat_children]
+    flat = []
+    for node in preorder(d, reverse=reverse):
+        if "id" not in node:
+            node["id"] = str(uuid.uuid1())
+        for child in node.get("children", []):
+            child["parent_id"] = node["id"]
+        flat.append(node)
+    return flat
 
 
 def flatten_tree_revisit_parents(d, parent=None):
@@ -331,16 +484,20 @@ def flatten_tree_revisit_parents(d, parent=None):
 
 
 # Remove html and random double newlines from Miro
-def fix_miro_tree(flat_data):
-    # Otherwise it will randomly insert line breaks....
-    h = html2text.HTML2Text()
-    h.body_width = 0
-
-    id_to_node = {d["id"]: d for d in flat_data}
+# node_dict is used to look up parents outside of flat_data
+def fix_miro_tree(flat_data, node_dict=None):
+    h = None
+    id_to_node = node_dict
     for d in flat_data:
         # Only fix miro text
-        if "text" not in d or all([tag not in d["text"] for tag in ["<p>", "</p"]]):
+        if "text" not in d or ("<p>" not in d["text"] and "</p" not in d["text"]):
             continue
+        if h is None:
+            h = html2text.HTML2Text()
+            # Otherwise it will randomly insert line breaks....
+            h.body_width = 0
+        if id_to_node is None:
+            id_to_node = {d["id"]: d for d in flat_data}
 
         d["text"] = h.handle(d["text"])
 
@@ -362,6 +519,26 @@ def fix_miro_tree(flat_data):
             d["text"] = " " + d["text"]
 
 
+# Import-time normalization of node data from files. Opened trees record the version of the normalization they went
+# through in tree["normalized"], so it runs once per tree instead of on every rebuild. Bump NORMALIZED_VERSION when
+# adding a stage to normalize_nodes.
+NORMALIZED_VERSION = 1
+
+
+# flat is a list of nodes with parent_id set, node_dict must contain their parents
+def normalize_nodes(flat, node_dict=None):
+    fix_miro_tree(flat, node_dict)
+
+
+# Returns True if the tree needed normalizing
+def normalize_tree(tree, flat=None, node_dict=None):
+    if tree.get("normalized") == NORMALIZED_VERSION:
+        return False
+    normalize_nodes(flat if flat is not None else flatten_tree(tree["root"]), node_dict)
+    tree["normalized"] = NORMALIZED_VERSION
+    return True
+
+
 def add_immutable_root(tree):
     if tree['root'].get('mutable', True):
         old_root = tree['root']
@@ -377,20 +554,26 @@ def add_immutable_root(tree):
 def make_simple_tree(tree):
     if 'root' in tree:
         tree = tree['root']
-    simple_tree = {}
-    simple_tree['text'] = tree['text']
-    simple_tree['children'] = [make_simple_tree(child) for child in tree['children']]
-    return simple_tree
+    copies = {}
+    for node, parent, _ in walk(tree):
+        simple_tree = {'text': node['text'], 'children': []}
+        copies[id(node)] = simple_tree
+        if parent is not None:
+            copies[id(parent)]['children'].append(simple_tree)
+    return copies[id(tree)]
 
 # add empty children attribute to nodes without children
+# the subtree of a node with a legacy parentId is left as it is
 def fix_tree(tree):
     if 'root' in tree:
         tree = tree['root']
-    if 'children' not in tree:
-        tree['children'] = []
-    if 'parentId' in tree:
-        tree['parent_id'] = tree['parentId']
-        del tree['parentId']
-    else:
-        for child in tree['children']:
-            fix_tree(child)
\ No newline at end of file
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if 'children' not in node:
+            node['children'] = []
+        if 'parentId' in node:
+            node['parent_id'] = node['parentId']
+            del node['parentId']
+        else:
+            stack.extend(node['children'])
\ No newline at end of file
@@ -297,7 +297,8 @@ class Display:
             self.open_menu(txt=textbox, event=event)
 
     def inline_generate(self, textbox):
-        textbox.inline_generate(self.state.inline_generation_settings, self.state.model_config)
+        textbox.inline_generate(self.state.inline_generation_settings, self.state.model_config,
+                                self.state.post_to_main_thread)
 
     def insert_inline_completion(self, textbox, step=1):
         textbox.insert_inline_completion(step)
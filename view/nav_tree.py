@@ -0,0 +1,193 @@
+import tkinter as tk
+
+"""
+Lazily populated nav tree.
+
+The nav tree used to insert an item into the ttk.Treeview for every visible node and to read every item's open state
+back into the nodes on each selection change. NavTree keeps track of which nodes are in the nav (members) without
+creating their items. An item is only inserted once all of its ancestors are open. A closed item whose children are
+in the nav gets a single empty placeholder child, so that the Treeview still draws an expand indicator, and its
+children are inserted when it is first opened. Open state is recorded in node["open"] from the Treeview's
+<<TreeviewOpen>> and <<TreeviewClose>> events rather than polled.
+
+Membership follows what the nav tree used to contain: build adds the nodes it is given whose parent is in the nav,
+add and remove patch single nodes (add does not check visibility, so hidden nodes can be revealed), and exists is
+true for members whether or not their item has been inserted.
+"""
+
+PLACEHOLDER_SUFFIX = ' (placeholder)'
+
+
+class NavTree:
+    # node(node_id) returns the node or None, item_options(node) the text, tags and image of its item
+    def __init__(self, treeview, node, item_options):
+        self.treeview = treeview
+        self.node = node
+        self.item_options = item_options
+        # {node_id: parent node_id, '' for top level items}
+        self.members = {}
+        # {node_id: set of child node_ids in members}
+        self.member_children = {}
+        # node_ids whose member children have been inserted
+        self.populated = set()
+        treeview.bind("<<TreeviewOpen>>", lambda event: self.opened(treeview.focus()), add="+")
+        treeview.bind("<<TreeviewClose>>", lambda event: self.closed(treeview.focus()), add="+")
+
+    def exists(self, node_id):
+        return node_id in self.members
+
+    # whether node_id has an item in the Treeview
+    def materialized(self, node_id):
+        return node_id in self.members and self.treeview.exists(node_id)
+
+    # Replaces the nav with nodes (in preorder). Nodes whose parent isn't in nodes are left out.
+    def build(self, nodes):
+        self.treeview.delete(*self.treeview.get_children())
+        self.members = {}
+        self.member_children = {}
+        self.populated = set()
+        for node in nodes:
+            parent_id = node.get("parent_id") or ''
+            if parent_id and parent_id not in self.members:
+                continue
+            self.members[node["id"]] = parent_id
+            self.member_children.setdefault(parent_id, set()).add(node["id"])
+        for node_id in list(self.member_children.get('', ())):
+            self.insert(node_id)
+
+    # Adds node to the nav (replacing it and its descendants if it was already in it) if its parent is in the nav
+    def add(self, node):
+        parent_id = node.get("parent_id") or ''
+        if parent_id and parent_id not in self.members:
+            return
+        if node["id"] in self.members:
+            self.remove(node["id"])
+        self.members[node["id"]] = parent_id
+        self.member_children.setdefault(parent_id, set()).add(node["id"])
+        if not parent_id or parent_id in self.populated:
+            if not parent_id or self.treeview.exists(parent_id):
+                self.insert(node["id"], self.insert_index(node))
+        elif self.treeview.exists(parent_id):
+            self.add_placeholder(parent_id)
+
+    # Removes node_id and its descendants from the nav
+    def remove(self, node_id):
+        if node_id not in self.members:
+            return
+        parent_id = self.members[node_id]
+        stack = [node_id]
+        while stack:
+            removed_id = stack.pop()
+            self.members.pop(removed_id, None)
+            self.populated.discard(removed_id)
+            stack.extend(self.member_children.pop(removed_id, ()))
+        siblings = self.member_children.get(parent_id)
+        if siblings is not None:
+            siblings.discard(node_id)
+        if self.treeview.exists(node_id):
+            self.treeview.delete(node_id)
+        if parent_id and not siblings and self.treeview.exists(parent_id + PLACEHOLDER_SUFFIX):
+            self.treeview.delete(parent_id + PLACEHOLDER_SUFFIX)
+
+    # Updates the item of node, if it has one
+    def refresh(self, node):
+        if not self.materialized(node["id"]):
+            return
+        self.treeview.item(node["id"], open=node.get("open", False), **self.item_options(node))
+        if node.get("open", False):
+            self.populate(node["id"])
+
+    def set_open(self, node, open=True):
+        node["open"] = open
+        if self.materialized(node["id"]):
+            self.treeview.item(node["id"], open=open)
+            if open:
+                self.populate(node["id"])
+
+    # Opens the ancestors of node_id so that it has an item. Returns False if it isn't in the nav.
+    def reveal(self, node_id):
+        if node_id not in self.members:
+            return False
+        ancestor_ids = []
+        parent_id = self.members[node_id]
+        while parent_id:
+            ancestor_ids.append(parent_id)
+            parent_id = self.members.get(parent_id, '')
+        for ancestor_id in reversed(ancestor_ids):
+            ancestor = self.node(ancestor_id)
+            if ancestor is not None and not (ancestor.get("open", False) and ancestor_id in self.populated):
+                self.set_open(ancestor, True)
+        return self.treeview.exists(node_id)
+
+    def opened(self, node_id):
+        node = self.node(node_id) if node_id in self.members else None
+        if node is not None:
+            node["open"] = True
+            self.populate(node_id)
+
+    def closed(self, node_id):
+        node = self.node(node_id) if node_id in self.members else None
+        if node is not None:
+            node["open"] = False
+
+    # Position of node among the items of its parent
+    def insert_index(self, node):
+        parent = self.node(node.get("parent_id")) if node.get("parent_id") else None
+        if parent is None:
+            return "end"
+        index = 0
+        for sibling in parent["children"]:
+            if sibling is node:
+                return index
+            if sibling["id"] in self.members:
+                index += 1
+        return "end"
+
+    # Inserts the item of node_id and, below open items, the items of its member descendants
+    def insert(self, node_id, index="end"):
+        stack = [(node_id, index)]
+        while stack:
+            item_id, item_index = stack.pop()
+            node = self.node(item_id)
+            if node is None:
+                continue
+            parent_id = self.members[item_id]
+            open = node.get("open", False)
+            self.treeview.insert(parent=parent_id, index=item_index, iid=item_id, open=open,
+                                 **self.item_options(node))
+            children = self.children_ids(node)
+            if open:
+                self.populated.add(item_id)
+                stack.extend((child_id, "end") for child_id in reversed(children))
+            elif children:
+                self.add_placeholder(item_id)
+
+    # Inserts the items of the member children of node_id, replacing its placeholder
+    def populate(self, node_id):
+        if node_id in self.populated or not self.treeview.exists(node_id):
+            return
+        if self.treeview.exists(node_id + PLACEHOLDER_SUFFIX):
+            self.treeview.delete(node_id + PLACEHOLDER_SUFFIX)
+        self.populated.add(node_id)
+        node = self.node(node_id)
+        for child_id in self.children_ids(node) if node is not None else ():
+            if not self.treeview.exists(child_id):
+                self.insert(child_id)
+
+    def add_placeholder(self, node_id):
+        if not self.treeview.exists(node_id + PLACEHOLDER_SUFFIX):
+            try:
+                self.treeview.insert(parent=node_id, index="end", iid=node_id + PLACEHOLDER_SUFFIX, text='')
+            except tk.TclError as e:
+                print(f'nav placeholder error: {e}')
+
+    # ids of the children of node which are in the nav, in order
+    def children_ids(self, node):
+        member_children = self.member_children.get(node["id"])
+        if not member_children:
+            return []
+        return [child["id"] for child in node["children"] if child["id"] in member_children]
+
+    # ids of the inserted items, excluding placeholders
+    def item_ids(self):
+        return [node_id for node_id, parent_id in self.members.items() if not parent_id or parent_id in self.populated]
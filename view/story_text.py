@@ -0,0 +1,73 @@
+"""
+Incremental rendering of the Read mode textbox.
+
+refresh_textbox used to delete all text of the textbox on every selection change, insert the text of the selected
+node's ancestry again and tag every prompt span again. StoryText remembers the segments (the text of each ancestor,
+then the active append text) and the tag ranges it rendered last. On the next render the leading segments that are
+the same in both renderings stay in the widget and only the text after them is deleted and inserted, so moving to a
+sibling replaces one node's text and moving to a child appends one. Tags are only removed from and added to the
+ranges which changed.
+
+The widget's modified flag is reset after each render. If something else changes the text in between (editing in
+editable mode or Edit mode, counterfactual tokens, inline completions) the flag is set and the next render replaces
+all of the text. Tags that StoryText doesn't render (search matches, the selection, modified tokens) are removed from
+the text it keeps, as they used to be removed with the text.
+"""
+
+
+def text_index(offset):
+    return f"1.0 + {offset} chars"
+
+
+class StoryText:
+    def __init__(self, textbox):
+        self.textbox = textbox
+        # segments of the rendered text, None if the text must be replaced
+        self.segments = None
+        # {tag: [(start, end)]} character ranges of the rendered tags
+        self.tag_ranges = {}
+
+    def invalidate(self):
+        self.segments = None
+        self.tag_ranges = {}
+
+    # Shows the concatenation of segments, with tag_ranges {tag: [(start, end)]}. Tags of overlapping ranges must be
+    # distinct. Returns the offset from which text was inserted.
+    def render(self, segments, tag_ranges):
+        textbox = self.textbox
+        kept, first_changed = 0, 0
+        if self.segments is not None and not textbox.edit_modified():
+            for old, new in zip(self.segments, segments):
+                if old != new:
+                    break
+                kept += len(new)
+                first_changed += 1
+            if first_changed < len(self.segments):
+                textbox.delete(text_index(kept), "end-1c")
+            for tag in textbox.tag_names():
+                if tag not in self.tag_ranges and tag not in tag_ranges:
+                    textbox.tag_remove(tag, "1.0", "end")
+            old_ranges = self.tag_ranges
+        else:
+            textbox.delete("1.0", "end")
+            old_ranges = {}
+        inserted = "".join(segments[first_changed:])
+        if inserted:
+            textbox.insert("end-1c", inserted, ())
+
+        for tag in set(old_ranges) | set(tag_ranges):
+            # what is left of the old ranges after the delete
+            old = {(start, min(end, kept)) for start, end in old_ranges.get(tag, ()) if start < kept}
+            new = [(start, end) for start, end in tag_ranges.get(tag, ()) if start < end]
+            new_set = set(new)
+            removed = [(start, end) for start, end in old if (start, end) not in new_set]
+            for start, end in removed:
+                textbox.tag_remove(tag, text_index(start), text_index(end))
+            for start, end in new:
+                if (start, end) not in old or any(start < r_end and r_start < end for r_start, r_end in removed):
+                    textbox.tag_add(tag, text_index(start), text_index(end))
+
+        textbox.edit_modified(False)
+        self.segments = list(segments)
+        self.tag_ranges = {tag: list(ranges) for tag, ranges in tag_ranges.items()}
+        return kept
@@ -13,6 +13,7 @@ from view.colors import vis_bg_color, visited_node_bg_color, unvisited_node_bg_c
     active_text_color, selected_line_color, active_line_color, inactive_line_color, BLUE, expand_button_color, \
     edit_color
 from view.icons import Icons
+from view.vis_layout import VisLayout
 
 # TODO add to vis params
 fixed_level_width = False
@@ -22,6 +23,10 @@ smooth_line_offset = 50
 leaf_padding = 50
 min_edit_box_height = 100
 canvas_padding = 100
+# margin around node boxes for the buttons drawn around them, when culling
+cull_margin = 40
+# nodes are drawn this many screens beyond the view in each direction
+cull_padding = 0.5
 
 # TODO custom
 chapter_leaf_distance = 20
@@ -90,6 +95,17 @@ class TreeVis:
 
         self.active = []
 
+        self.layout = VisLayout(self.measure_node)
+        # {node_id: {'node', 'key', 'position', 'line'}} for the nodes with canvas items, when drawn from the layout
+        self.drawn = {}
+        self.retained = False
+        self.draw_settings = None
+        # {node_id: [resize icon event]}
+        self.resize_icon_events = {}
+        # canvas coordinates of (0, 0). Items are at their layout coordinates * scroll_ratio + origin.
+        self.origin = (0, 0)
+        self.cull_scheduled = False
+
         #TODO instead of root width, long textboxes should have scrollbars
         #if not possible, multiple pages (!)
         self.root_width = self.state.visualization_settings['text_width']
@@ -121,8 +137,8 @@ class TreeVis:
         vbar.config(command=self.canvas.yview)
 
         self.canvas.config(
-            xscrollcommand=hbar.set,
-            yscrollcommand=vbar.set
+            xscrollcommand=lambda *args: self.view_changed(hbar.set, *args),
+            yscrollcommand=lambda *args: self.view_changed(vbar.set, *args)
         )
         
         self.canvas.pack(side=tkinter.LEFT, expand=True, fill=tkinter.BOTH)
@@ -150,31 +166,16 @@ class TreeVis:
         def zoomer(event):
             if event.delta > 0:
                 zoom_in(event)
-                self.scroll_ratio *= 1.1
-                self.canvas.scale("all", event.x, event.y, 1.1, 1.1)
             elif event.delta < 0:
                 zoom_out(event)
-                self.scroll_ratio *= 0.9
-                self.canvas.scale("all", event.x, event.y, 0.9, 0.9)
-            self.canvas.configure(scrollregion=self.canvas.bbox("all"))#self.canvas_bbox_padding(self.canvas.bbox("all")))
-            self.fix_text_zoom()
-            self.fix_image_zoom()
 
         # # linux zoom
         def zoom_in(event):
-            self.scroll_ratio *= 1.1
-            self.canvas.scale("all", event.x, event.y, 1.1, 1.1)
-            self.canvas.configure(scrollregion=self.canvas.bbox("all"))#self.canvas_bbox_padding(self.canvas.bbox("all")))
-            self.fix_text_zoom()
-            self.fix_image_zoom()
+            self.zoom(event.x, event.y, 1.1)
 
         def zoom_out(event):
-            self.scroll_ratio *= 0.9
-            self.canvas.scale("all", event.x, event.y, 0.9, 0.9)
-            self.canvas.configure(scrollregion=self.canvas.bbox("all"))#self.canvas_bbox_padding(self.canvas.bbox("all")))
             # self.showtext = event.text > 0.8
-            self.fix_text_zoom()
-            self.fix_image_zoom()
+            self.zoom(event.x, event.y, 0.9)
 
         # Mac and then linux scrolls
         self.canvas.bind("<MouseWheel>", zoomer)
@@ -185,6 +186,14 @@ class TreeVis:
         # root.bind_all("<MouseWheel>", zoomer)
 
 
+    def zoom(self, x, y, factor):
+        self.scroll_ratio *= factor
+        self.canvas.scale("all", x, y, factor, factor)
+        self.origin = (x + (self.origin[0] - x) * factor, y + (self.origin[1] - y) * factor)
+        self.canvas.configure(scrollregion=self.scroll_region())
+        self.fix_text_zoom()
+        self.fix_image_zoom()
+
     def fix_text_zoom(self):
         size = self.get_text_size()
         if size == 0:
@@ -220,8 +229,9 @@ class TreeVis:
                 # self.old_icons.append(self.icons[icon]["icon"])
                 # self.icons.icons[icon]["icon"] = ImageTk.PhotoImage(self.icons.icons[icon]["img"].resize((new_size, new_size)))
                 _ = self.icons.get_icon(icon, new_size)
-            for resize_event in self.resize_icon_events:
-                resize_event()
+            for resize_events in self.resize_icon_events.values():
+                for resize_event in resize_events:
+                    resize_event()
 
 
     # TODO save default widths (because some nodes have different widths)
@@ -352,7 +362,6 @@ class TreeVis:
     #   Old
     #################################
 
-    # TODO Slow for big tree; do not redraw everything?
     def draw(self, root_node, selected_node, center_on_selection=False):
         # pprint(self.state.visualization_settings)
         if self.state.visualization_settings["chapter_mode"]:
@@ -360,8 +369,6 @@ class TreeVis:
         else:
             self.root = root_node
 
-        self.canvas.delete('data')
-
         self.selected_node = selected_node
         self.delete_textbox()
 
@@ -375,11 +382,23 @@ class TreeVis:
                 #TODO also expand ancestors
                 self.expand_node(self.selected_node)
 
-        self.node_coords = {}
-        self.resize_icon_events = []
-
         self.active = self.get_active()
 
+        if self.state.visualization_settings["chapter_mode"]:
+            self.draw_all()
+        else:
+            self.draw_retained()
+
+        self.canvas.configure(scrollregion=self.scroll_region())
+
+        if center_on_selection:
+            self.center_view_on_node(self.selected_node)
+
+    # Deletes all items and draws the whole tree. Used for chapter trees.
+    def draw_all(self):
+        self.clear()
+        self.node_coords = {}
+
         # self.compute_tree_coordinates(self.root, 100, 100, level=0)
         # self.center_about_ancestry(self.state.ancestry(self.selected_node))
         # self.draw_precomputed_tree(self.root)
@@ -387,18 +406,193 @@ class TreeVis:
         self.draw_tree(self.root, 100, 100)
 
         self.canvas.scale("all", 0, 0, self.scroll_ratio, self.scroll_ratio)
-
-        region = self.canvas_bbox_padding(self.canvas.bbox("all"))
-        self.canvas.configure(scrollregion=region)
         self.fix_text_zoom()
         self.fix_image_zoom()
 
-        if center_on_selection:
-            self.center_view_on_node(self.selected_node)
+    # Updates the items of the open tree from the retained layout: only nodes whose layout or appearance changed are
+    # drawn again, moved nodes are moved, and only nodes near the view are drawn.
+    def draw_retained(self):
+        layout_settings = self.layout_settings()
+        draw_settings = (layout_settings, self.state.visualization_settings['show_buttons'])
+        if not self.retained or draw_settings != self.draw_settings:
+            self.clear()
+            self.retained = True
+            self.draw_settings = draw_settings
+        self.layout.update(self.root, layout_settings)
+        self.update_canvas()
+
+    def clear(self):
+        self.canvas.delete('data')
+        self.layout.reset()
+        self.drawn = {}
+        self.retained = False
+        self.draw_settings = None
+        self.resize_icon_events = {}
+        self.textbox_events = {}
+        self.origin = (0, 0)
+
+    def layout_settings(self):
+        settings = self.state.visualization_settings
+        display_text = settings['display_text'] and self.showtext
+        return {'level_distance': settings['level_distance'], 'leaf_distance': settings['leaf_distance'],
+                'collapsed_offset': collapsed_offset,
+                'level_width': settings['text_width'] if display_text and fixed_level_width else None,
+                'padding': 10 if display_text else 0,
+                'display_text': display_text, 'text_width': settings['text_width'], 'root_width': self.root_width,
+                'text_size': settings['text_size'], 'font': self.font, 'overflow_display': self.overflow_display}
+
+    # (displayed text, box) of a node's textbox or expand button, relative to its position. Measured at scroll ratio 1.
+    def measure_node(self, node, open, is_root):
+        settings = self.state.visualization_settings
+        if not open:
+            text_id = self.canvas.create_text(-4, -6, font=(self.font, settings['text_size']), text='+',
+                                              anchor=tkinter.NW)
+            padding = (-5, -5, 5, 5)
+            text = None
+        elif settings['display_text'] and self.showtext:
+            text = self.split_text(node) if self.overflow_display == 'PAGE' else node['text']
+            text_id = self.canvas.create_text(0, 0, font=(self.font, settings['text_size']),
+                                              width=self.root_width if is_root else settings['text_width'],
+                                              text=text, anchor=tkinter.NW)
+            padding = (-10, -10, 10, 10)
+        else:
+            return None, (0, 0, 0, 0)
+        bbox = self.canvas.bbox(text_id)
+        self.canvas.delete(text_id)
+        return text, tuple(map(lambda i, j: i + j, padding, bbox))
+
+    # Region of the canvas in view, in layout coordinates, extended by cull_padding screens
+    def view_region(self):
+        width = max(self.canvas.winfo_width(), self.canvas.winfo_reqwidth())
+        height = max(self.canvas.winfo_height(), self.canvas.winfo_reqheight())
+        x = (self.canvas.canvasx(0) - self.origin[0]) / self.scroll_ratio
+        y = (self.canvas.canvasy(0) - self.origin[1]) / self.scroll_ratio
+        width /= self.scroll_ratio
+        height /= self.scroll_ratio
+        return (x - width * cull_padding, y - height * cull_padding,
+                x + width * (1 + cull_padding), y + height * (1 + cull_padding))
+
+    def scroll_region(self):
+        bounds = self.layout.bounds() if self.retained else None
+        if bounds is None:
+            bbox = self.canvas.bbox("all")
+            return self.canvas_bbox_padding(bbox) if bbox else ''
+        return self.canvas_bbox_padding(self.canvas_coords(*bounds))
+
+    # Canvas coordinates of points given in layout coordinates (x1, y1, x2, y2, ...)
+    def canvas_coords(self, *coords):
+        return tuple(c * self.scroll_ratio + self.origin[i % 2] for i, c in enumerate(coords))
+
+    # Appearance of a node's items, apart from their position
+    def node_key(self, record, active_ids):
+        node = record['node']
+        parent = self.state.tree_node_dict.get(node.get('parent_id'))
+        return (record['text'], record['display_text'], record['open'], record['box'], node['id'] == self.root['id'],
+                node['id'] in active_ids, self.node_selected(node), node.get('visited', False),
+                self.state.has_tag(node, 'bookmark'), len(node['children']) > 0,
+                parent is not None and len(parent['children']) > 1)
+
+    def update_canvas(self):
+        visible = self.layout.visible(self.view_region(), margin=cull_margin)
+        active_ids = {node['id'] for node in self.active}
+        seen = set()
+        for node_id, x, y, line in visible:
+            record = self.layout.records[node_id]
+            key = self.node_key(record, active_ids)
+            seen.add(node_id)
+            drawn = self.drawn.get(node_id)
+            if drawn is not None and drawn['node'] is record['node'] and drawn['key'] == key:
+                old_x, old_y = drawn['position']
+                if (old_x, old_y) != (x, y):
+                    self.canvas.move(f'node-{node_id}', (x - old_x) * self.scroll_ratio,
+                                     (y - old_y) * self.scroll_ratio)
+                if drawn['line'] != line:
+                    if line is None:
+                        self.canvas.delete(f'lines-{node_id}')
+                    elif drawn['line'] is None:
+                        self.draw_node_line(record['node'], line)
+                    else:
+                        self.canvas.coords(f'lines-{node_id}', *self.canvas_coords(*self.line_points(*line)))
+                drawn['position'] = (x, y)
+                drawn['line'] = line
+                continue
+            if drawn is not None:
+                self.delete_node_items(node_id)
+            self.draw_node_items(record, x, y)
+            if line is not None:
+                self.draw_node_line(record['node'], line)
+            self.drawn[node_id] = {'node': record['node'], 'key': key, 'position': (x, y), 'line': line}
+        for node_id in [node_id for node_id in self.drawn if node_id not in seen]:
+            self.delete_node_items(node_id)
+
+    def draw_node_items(self, record, x, y):
+        node = record['node']
+        if not record['open']:
+            self.draw_expand_node_button(node, x, y)
+        elif record['display_text'] is not None:
+            box = record['box']
+            self.draw_textbox(node, x, y, box=(box[0] + x, box[1] + y, box[2] + x, box[3] + y),
+                              text=record['display_text'])
+        self.transform_items(f'node-{node["id"]}')
+
+    # Line from the parent of node, line = (x1, y1, x2, y2) in layout coordinates
+    def draw_node_line(self, node, line):
+        if self.node_selected(node):
+            color = selected_line_color()
+            width = 2
+        else:
+            active = node in self.active
+            color = active_line_color() if active else inactive_line_color()
+            width = 2 if active else 1
+        self.draw_line(*line, name=f'lines-{node["id"]}',
+                       fill=color, activefill=BLUE, width=width, offset=smooth_line_offset, smooth=True,
+                       method=lambda event, node_id=node["id"]: self.controller.nav_select(node_id=node_id))
+        self.transform_items(f'lines-{node["id"]}')
+
+    def line_points(self, x1, y1, x2, y2):
+        return x1, y1, x1 + smooth_line_offset, y1, x2 - smooth_line_offset, y2, x2, y2
+
+    # Moves items drawn in layout coordinates to canvas coordinates
+    def transform_items(self, tag):
+        if self.scroll_ratio != 1:
+            self.canvas.scale(tag, 0, 0, self.scroll_ratio, self.scroll_ratio)
+        if self.origin != (0, 0):
+            self.canvas.move(tag, *self.origin)
+
+    def delete_node_items(self, node_id):
+        self.canvas.delete(f'node-{node_id}', f'lines-{node_id}')
+        self.drawn.pop(node_id, None)
+        self.resize_icon_events.pop(node_id, None)
+        self.textbox_events.pop(node_id, None)
+
+    # The canvas calls this when the view scrolls, zooms or is resized
+    def view_changed(self, scrollbar_set, *args):
+        scrollbar_set(*args)
+        if self.retained and not self.cull_scheduled:
+            self.cull_scheduled = True
+            self.canvas.after_idle(self.cull)
+
+    def cull(self):
+        self.cull_scheduled = False
+        if self.retained:
+            self.update_canvas()
+
+    # (x, y) of a drawn node in layout coordinates, None if it isn't in the drawn tree
+    def node_position(self, node_id):
+        if self.retained:
+            return self.layout.position(node_id)
+        return self.node_coords.get(node_id)
+
+    # Box of a node's textbox in canvas coordinates
+    def node_box(self, node_id):
+        position = self.layout.position(node_id)
+        box = self.layout.records[node_id]['box']
+        return self.canvas_coords(box[0] + position[0], box[1] + position[1], box[2] + position[0],
+                                  box[3] + position[1])
 
 
     def refresh_selection(self, root_node, selected_node):
-        if self.selected_node["id"] not in self.node_coords:
+        if self.node_position(self.selected_node["id"]) is None:
             self.draw(self.root, self.selected_node, center_on_selection=True)
         self.selected_node = selected_node
         if not self.selected_node.get("open", False):
@@ -564,28 +758,31 @@ class TreeVis:
         return text
 
 
-    def draw_textbox(self, node, nodex, nodey):
+    # box and text are given when drawing from the layout, otherwise the text is measured
+    def draw_textbox(self, node, nodex, nodey, box=None, text=None):
         active = node in self.active
         text_color = active_text_color() if active else inactive_text_color()
         width = self.root_width if node['id'] == self.root['id'] else self.state.visualization_settings['text_width']
 
         if self.state.visualization_settings["chapter_mode"]:
             text = node["chapter"]["title"]
-        else:
+        elif text is None:
             text = self.split_text(node) if self.overflow_display == 'PAGE' else node['text']
 
 
         text_id = self.canvas.create_text(
             nodex, nodey, fill=text_color, activefill=BLUE,
             font=(self.font, self.get_text_size()),
-            width=width,
+            width=width if box is None else math.floor(width * self.scroll_ratio),
             text=text,
-            tags=[f'text-{node["id"]}', 'data', 'text'],
+            tags=[f'text-{node["id"]}', f'node-{node["id"]}', 'data', 'text'],
+            state='hidden' if self.text_hidden else 'normal',
             anchor=tkinter.NW
         )
-        padding = (-10, -10, 10, 10)
-        bbox = self.canvas.bbox(text_id)
-        box = tuple(map(lambda i, j: i + j, padding, bbox))
+        if box is None:
+            padding = (-10, -10, 10, 10)
+            bbox = self.canvas.bbox(text_id)
+            box = tuple(map(lambda i, j: i + j, padding, bbox))
 
         # TODO different for chapter mode
         fill = visited_node_bg_color() if node.get("visited", False) else unvisited_node_bg_color()
@@ -593,7 +790,8 @@ class TreeVis:
             (active_line_color() if active else inactive_line_color())
         width = 2 if active else 1
         rect_id = round_rectangle(x1=box[0], x2=box[2], y1=box[1], y2=box[3], canvas=self.canvas, outline=outline_color,
-                                  width=width, activeoutline=BLUE, fill=fill, tags=[f'box-{node["id"]}', 'data'])
+                                  width=width, activeoutline=BLUE, fill=fill,
+                                  tags=[f'box-{node["id"]}', f'node-{node["id"]}', 'data'])
         self.canvas.tag_raise(text_id, rect_id)
 
         if self.state.visualization_settings["chapter_mode"]:
@@ -606,15 +804,14 @@ class TreeVis:
                     node_id=node_id))
         else:
             self.canvas.tag_bind(
-                f'text-{node["id"]}', "<Button-1>", lambda event, node_id=node["id"]: self.edit_node(node_id=node_id,
-                                                                                                     box=box,
-                                                                                                     text=node['text'])
+                f'text-{node["id"]}', "<Button-1>", lambda event, node_id=node["id"]: self.edit_node(
+                    node_id=node_id, box=self.node_box(node_id), text=node['text'])
             )
             self.textbox_events[node["id"]] = lambda node_id=node["id"]: self.edit_node(node_id=node_id,
-                                                                                        box=box,
+                                                                                        box=self.node_box(node_id),
                                                                                         text=node['text'])
             self.canvas.tag_bind(
-                f'box-{node["id"]}', "<Button-1>", self.box_click(node["id"], box, node["text"]))
+                f'box-{node["id"]}', "<Button-1>", self.box_click(node["id"], node["text"]))
 
         # TODO collapsing and buttons for chapters...
 
@@ -638,7 +835,8 @@ class TreeVis:
             nodex - 4, nodey - 6, fill='white', activefill=BLUE,
             font=(self.font, self.get_text_size()),
             text='+',
-            tags=[f'expand-{node["id"]}', 'data', 'text'],
+            tags=[f'expand-{node["id"]}', f'node-{node["id"]}', 'data', 'text'],
+            state='hidden' if self.text_hidden else 'normal',
             anchor=tkinter.NW
         )
         padding = (-5, -5, 5, 5)
@@ -648,7 +846,7 @@ class TreeVis:
         fill = visited_node_bg_color() if ghost else expand_button_color()
         rect_id = self.canvas.create_rectangle(box, outline=outline_color,
                                                activeoutline=BLUE, fill=fill,
-                                               tags=[f'expand-box-{node["id"]}', 'data'])
+                                               tags=[f'expand-box-{node["id"]}', f'node-{node["id"]}', 'data'])
         self.canvas.tag_raise(text_id, rect_id)
         self.canvas.tag_bind(
             f'expand-{node["id"]}', "<Button-1>", lambda event, _node=node:
@@ -704,8 +902,10 @@ class TreeVis:
             name = icon_name
         icon_id = self.canvas.create_image(x_pos, y_pos,
                                            image=self.icons.get_icon(icon_name),
-                                           tags=[f'{name}-{node["id"]}', 'data', 'image'])
-        self.resize_icon_events.append(lambda: self.canvas.itemconfig(icon_id, image=self.icons.get_icon(icon_name)))
+                                           tags=[f'{name}-{node["id"]}', f'node-{node["id"]}', 'data', 'image'],
+                                           state='hidden' if self.buttons_hidden else 'normal')
+        self.resize_icon_events.setdefault(node["id"], []).append(
+            lambda: self.canvas.itemconfig(icon_id, image=self.icons.get_icon(icon_name)))
         self.canvas.tag_bind(
             f'{name}-{node["id"]}', "<Button-1>", method)
         return icon_id
@@ -917,9 +1117,9 @@ class TreeVis:
     #################################
 
 
-    def box_click(self, node_id, box, text):
+    def box_click(self, node_id, text):
         if text == '':
-            return lambda event, node_id=node_id, box=box: self.edit_node(node_id=node_id, box=box, text=text)
+            return lambda event, node_id=node_id: self.edit_node(node_id=node_id, box=self.node_box(node_id), text=text)
         else:
             return lambda event, node_id=node_id: self.select_node(node_id=node_id)
 
@@ -993,9 +1193,9 @@ class TreeVis:
 
     def center_view_on_node(self, node):
         if not self.state.visualization_settings["chapter_mode"]:
-            self.center_view_on_canvas_coords(*self.node_coords[node["id"]])
+            self.center_view_on_canvas_coords(*self.canvas_coords(*self.node_position(node["id"])))
         else:
-            self.center_view_on_canvas_coords(*self.node_coords[self.state.chapter(node)["id"]])
+            self.center_view_on_canvas_coords(*self.canvas_coords(*self.node_position(self.state.chapter(node)["id"])))
 
     def center_view(self, x, y):
         x = x * self.scroll_ratio
@@ -1016,8 +1216,9 @@ class TreeVis:
     def reset_zoom(self):
         # TODO unknown bug, fix
         self.canvas.scale("all", 0, 0, 1 / self.scroll_ratio, 1 / self.scroll_ratio)
-        self.canvas.configure(scrollregion=self.canvas_bbox_padding(self.canvas.bbox("all")))
+        self.origin = (self.origin[0] / self.scroll_ratio, self.origin[1] / self.scroll_ratio)
         self.scroll_ratio = 1
+        self.canvas.configure(scrollregion=self.scroll_region())
         self.fix_text_zoom()
         self.fix_image_zoom()
 
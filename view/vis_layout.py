@@ -0,0 +1,162 @@
+"""
+Retained layout of the tree visualization.
+
+TreeVis used to delete every canvas item and lay out and draw the whole open tree on each tree update. VisLayout keeps
+the layout of each node between draws: the box of its textbox (or expand button), the offsets of its children and the
+extent and bounds of its subtree, all relative to the node's position. update() walks the open tree and compares each
+node's text, open state and children with what its layout was computed from. Only changed nodes and their ancestors
+are laid out again, and a box is only measured again when its node's text or open state changes.
+
+Positions are not stored: position() adds up offsets from the root, and visible() descends from the root only into
+subtrees whose bounds intersect a region, so drawing doesn't need to visit nodes outside the view.
+
+The layout is the same as TreeVis.draw_tree's: children are stacked below each other to the right of their parent, a
+closed node takes settings['collapsed_offset'] and an open node without children the height of its box.
+"""
+from operator import itemgetter
+
+get_id = itemgetter('id')
+
+
+def intersects(box, x, y, region):
+    return box[0] + x <= region[2] and box[2] + x >= region[0] and box[1] + y <= region[3] and box[3] + y >= region[1]
+
+
+class VisLayout:
+    # measure(node, open, is_root) returns (displayed text or None, box relative to the node's position)
+    def __init__(self, measure, root_position=(100, 100)):
+        self.measure = measure
+        self.root_position = root_position
+        # level_distance, leaf_distance, collapsed_offset, level_width (None unless fixed), padding (of lines) and
+        # anything else the boxes depend on. Layout is discarded when they change.
+        self.settings = None
+        self.root_id = None
+        # {node_id: (key, text, box)}
+        self.boxes = {}
+        # {node_id: {'node', 'text', 'open', 'child_ids', 'display_text', 'box', 'children': [(child_id, dx, dy)],
+        #  'extent', 'bounds'}} for the nodes of the open tree
+        self.records = {}
+        # {node_id: (parent_id, dx, dy)}
+        self.offsets = {}
+
+    def reset(self):
+        self.settings = None
+        self.root_id = None
+        self.boxes = {}
+        self.records = {}
+        self.offsets = {}
+
+    # Lays out the open tree under root. Returns the ids of the nodes whose layout changed.
+    def update(self, root, settings):
+        if settings != self.settings or root['id'] != self.root_id:
+            self.reset()
+            self.settings = dict(settings)
+            self.root_id = root['id']
+        # the open tree in preorder, so that in reverse children are laid out before their parent
+        laid_out = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            laid_out.append(node)
+            if node.get('open', False):
+                stack.extend(node['children'])
+        changed = set()
+        records = self.records
+        for node in reversed(laid_out):
+            open = node.get('open', False)
+            child_ids = tuple(map(get_id, node['children'])) if open else ()
+            record = records.get(node['id'])
+            if record is not None and record['node'] is node and record['open'] == open \
+                    and record['text'] == node['text'] and record['child_ids'] == child_ids \
+                    and changed.isdisjoint(child_ids):
+                continue
+            records[node['id']] = self.layout_node(node, open, child_ids)
+            changed.add(node['id'])
+        if len(records) > len(laid_out):
+            laid_out_ids = set(map(get_id, laid_out))
+            for node_id in [node_id for node_id in records if node_id not in laid_out_ids]:
+                del records[node_id]
+                self.boxes.pop(node_id, None)
+                self.offsets.pop(node_id, None)
+        return changed
+
+    def layout_node(self, node, open, child_ids):
+        is_root = node['id'] == self.root_id
+        key = (node['text'], open, is_root)
+        cached = self.boxes.get(node['id'])
+        if cached is None or cached[0] != key:
+            display_text, box = self.measure(node, open, is_root)
+            cached = (key, display_text, tuple(box))
+            self.boxes[node['id']] = cached
+        box = cached[2]
+        record = {'node': node, 'text': node['text'], 'open': open, 'child_ids': child_ids,
+                  'display_text': cached[1], 'box': box, 'children': [], 'bounds': box}
+        if not open:
+            record['extent'] = self.settings['collapsed_offset']
+            return record
+        level_width = self.settings['level_width'] if self.settings['level_width'] is not None else box[2] - box[0]
+        dx = self.settings['level_distance'] + level_width
+        x1, y1, x2, y2 = box
+        child_offset = 0
+        for child_id in child_ids:
+            child = self.records[child_id]
+            dy = child_offset
+            record['children'].append((child_id, dx, dy))
+            self.offsets[child_id] = (node['id'], dx, dy)
+            child_offset += self.settings['leaf_distance'] + child['extent']
+            bounds = child['bounds']
+            x1, y1 = min(x1, bounds[0] + dx), min(y1, bounds[1] + dy)
+            x2, y2 = max(x2, bounds[2] + dx), max(y2, bounds[3] + dy)
+        record['extent'] = box[3] - box[1] if child_offset == 0 else child_offset
+        record['bounds'] = (x1, y1, x2, y2)
+        return record
+
+    def contains(self, node_id):
+        return node_id in self.records
+
+    # (x, y) of a node in the open tree, None if it isn't laid out
+    def position(self, node_id):
+        if node_id not in self.records:
+            return None
+        x, y = self.root_position
+        while node_id != self.root_id:
+            node_id, dx, dy = self.offsets[node_id]
+            x += dx
+            y += dy
+        return x, y
+
+    # (x1, y1, x2, y2) of the open tree, None if nothing is laid out
+    def bounds(self):
+        if self.root_id not in self.records:
+            return None
+        x, y = self.root_position
+        bounds = self.records[self.root_id]['bounds']
+        return bounds[0] + x, bounds[1] + y, bounds[2] + x, bounds[3] + y
+
+    # Line from the parent of a node at (x, y) to it. Its parent is at (parent_x, parent_y).
+    def line(self, parent_id, parent_x, parent_y, x, y):
+        box = self.records[parent_id]['box']
+        padding = self.settings['padding']
+        return parent_x + box[2] - box[0] - padding, parent_y - padding, x - padding, y - padding
+
+    # [(node_id, x, y, line)] of the nodes whose box, extended by margin, or line from their parent intersects
+    # region = (x1, y1, x2, y2). line is None for the root.
+    def visible(self, region, margin=0):
+        if self.root_id not in self.records:
+            return []
+        boxes_region = (region[0] - margin, region[1] - margin, region[2] + margin, region[3] + margin)
+        found = []
+        stack = [(self.root_id, self.root_position[0], self.root_position[1], None)]
+        while stack:
+            node_id, x, y, line = stack.pop()
+            record = self.records[node_id]
+            line_visible = line is not None and intersects((min(line[0], line[2]), min(line[1], line[3]),
+                                                            max(line[0], line[2]), max(line[1], line[3])),
+                                                           0, 0, region)
+            if intersects(record['box'], x, y, boxes_region) or line_visible:
+                found.append((node_id, x, y, line))
+            elif not intersects(record['bounds'], x, y, boxes_region):
+                continue
+            for child_id, dx, dy in reversed(record['children']):
+                stack.append((child_id, x + dx, y + dy, self.line(node_id, x, y, x + dx, y + dy)))
+        return found